@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+# Compares the tiles/sec of disk_to_mbtiles with batched writes against
+# the old one-statement-per-tile path.
+#
+# $ python bench/bench_import.py [tiles] [batch_size]
+
+import os, sys, time, shutil, tempfile, hashlib, sqlite3
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from generate import make_tile_directory
+from mbutil import disk_to_mbtiles, mbtiles_connect, mbtiles_setup, optimize_connection
+
+
+def legacy_import(directory_path, mbtiles_file):
+    con = mbtiles_connect(mbtiles_file, True)
+    cur = con.cursor()
+    optimize_connection(cur, False)
+    mbtiles_setup(cur)
+
+    for r1, zs, ignore in os.walk(os.path.join(directory_path, "tiles")):
+        for z in zs:
+            for r2, xs, ignore in os.walk(os.path.join(r1, z)):
+                for x in xs:
+                    for r2, ignore, ys in os.walk(os.path.join(r1, z, x)):
+                        for y in ys:
+                            y, extension = y.split('.')
+                            f = open(os.path.join(r1, z, x, y) + '.' + extension, 'rb')
+                            tile_data = f.read()
+                            f.close()
+
+                            m = hashlib.md5()
+                            m.update(tile_data)
+                            tile_id = m.hexdigest()
+
+                            cur.execute("""INSERT OR IGNORE INTO images (tile_id, tile_data) VALUES (?, ?)""",
+                                (tile_id, sqlite3.Binary(tile_data)))
+                            cur.execute("""REPLACE INTO map (zoom_level, tile_column, tile_row, tile_id) VALUES (?, ?, ?, ?)""",
+                                (z, x, y, tile_id))
+    con.close()
+
+
+def run(name, tiles, function, *args, **kwargs):
+    start_time = time.time()
+    function(*args, **kwargs)
+    duration = time.time() - start_time
+    print "%-28s %8.1f tiles/sec (%.2f sec)" % (name, tiles / duration, duration)
+
+
+if __name__ == '__main__':
+    tiles = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+
+    work_dir = tempfile.mkdtemp(prefix="mbutil_bench_")
+    try:
+        make_tile_directory(work_dir, tiles, duplicates=0.25)
+
+        run("per-tile (auto-commit)", tiles, legacy_import,
+            work_dir, os.path.join(work_dir, 'legacy.mbtiles'))
+        run("batched (auto-commit)", tiles, disk_to_mbtiles,
+            work_dir, os.path.join(work_dir, 'batched_auto.mbtiles'), auto_commit=True, batch_size=batch_size)
+        run("batched", tiles, disk_to_mbtiles,
+            work_dir, os.path.join(work_dir, 'batched.mbtiles'), batch_size=batch_size)
+    finally:
+        shutil.rmtree(work_dir)
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+# Compares the standard and the optimized table layout (--layout): import
+# speed, random tile lookups through the tiles view, a full scan in map
+# order and the file size, on the same synthetic tiles (see generate.py).
+#
+# $ python bench/bench_layout.py [options]
+
+import os, sys, time, shutil, tempfile, random, sqlite3, logging
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from generate import make_tile_directory, add_generator_options, generator_options
+from mbutil import disk_to_mbtiles
+
+
+def bench_layout(layout, directory_path, work_dir, lookups):
+    mbtiles_file = os.path.join(work_dir, '%s.mbtiles' % (layout))
+
+    start_time = time.time()
+    disk_to_mbtiles(directory_path, mbtiles_file, layout=layout)
+    import_time = time.time() - start_time
+
+    con = sqlite3.connect(mbtiles_file)
+    con.execute("""PRAGMA wal_checkpoint(TRUNCATE)""")
+    keys = con.execute("""SELECT zoom_level, tile_column, tile_row FROM map""").fetchall()
+    random.Random(1).shuffle(keys)
+    keys = keys[:lookups]
+
+    start_time = time.time()
+    for key in keys:
+        con.execute("""SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?""", key).fetchone()
+    lookup_time = time.time() - start_time
+
+    start_time = time.time()
+    scanned = 0
+    for t in con.execute("""SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles ORDER BY zoom_level, tile_column, tile_row"""):
+        scanned = scanned + 1
+    scan_time = time.time() - start_time
+    con.close()
+
+    print "%-10s import %10.1f tiles/sec   lookup %10.1f tiles/sec   scan %10.1f tiles/sec   %8.2f MB" % (layout,
+        scanned / import_time, len(keys) / lookup_time, scanned / scan_time, os.path.getsize(mbtiles_file) / 1048576.0)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+
+    parser = OptionParser(usage="usage: %prog [options]")
+    add_generator_options(parser)
+    parser.add_option("--lookups", dest="lookups", type="int", default=20000,
+        help='''Number of random tile lookups. Default is 20000.''')
+    (options, args) = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="mbutil_bench_")
+    try:
+        directory_path = os.path.join(work_dir, 'directory')
+        make_tile_directory(directory_path, options.tiles, **generator_options(options))
+
+        for layout in ('standard', 'optimized'):
+            bench_layout(layout, directory_path, work_dir, options.lookups)
+    finally:
+        shutil.rmtree(work_dir)
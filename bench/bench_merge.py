@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+
+# Compares the tiles/sec of merge_mbtiles inside SQLite (ATTACH) against
+# the tile by tile merge in python.
+#
+# $ python bench/bench_merge.py [tiles]
+
+import os, sys, time, shutil, tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from generate import make_mbtiles
+from mbutil import mbtiles_create, merge_mbtiles
+
+
+def run(name, tiles, mbtiles_file, source_file, **kwargs):
+    mbtiles_create(mbtiles_file)
+    start_time = time.time()
+    merge_mbtiles(mbtiles_file, source_file, command_list=None, **kwargs)
+    duration = time.time() - start_time
+    print "%-28s %8.1f tiles/sec (%.2f sec)" % (name, tiles / duration, duration)
+
+
+if __name__ == '__main__':
+    tiles = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+
+    work_dir = tempfile.mkdtemp(prefix="mbutil_bench_")
+    try:
+        source_file = os.path.join(work_dir, 'source.mbtiles')
+        make_mbtiles(source_file, tiles, duplicates=0.25)
+
+        run("row by row", tiles, os.path.join(work_dir, 'rows.mbtiles'), source_file, sql_merge=False)
+        run("sql (attach)", tiles, os.path.join(work_dir, 'sql.mbtiles'), source_file)
+        run("row by row --no-overwrite", tiles, os.path.join(work_dir, 'rows_no_overwrite.mbtiles'), source_file, sql_merge=False, no_overwrite=True)
+        run("sql --no-overwrite", tiles, os.path.join(work_dir, 'sql_no_overwrite.mbtiles'), source_file, no_overwrite=True)
+    finally:
+        shutil.rmtree(work_dir)
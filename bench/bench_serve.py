@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+# Load test of mb-util --serve on localhost: requests/sec for cold tiles
+# (read from SQLite), hot tiles (from the LRU cache) and revalidations
+# with If-None-Match (304 without the image).
+#
+# $ python bench/bench_serve.py [tiles] [clients] [requests per client]
+
+import os, sys, time, shutil, tempfile, threading, random, httplib, sqlite3
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from generate import make_mbtiles
+from mbutil import create_tile_server
+
+
+def client(port, paths, etags, results):
+    con = httplib.HTTPConnection('127.0.0.1', port)
+    statuses = {}
+    for path in paths:
+        headers = {'If-None-Match': etags[path]} if etags is not None else {}
+        con.request('GET', path, headers=headers)
+        response = con.getresponse()
+        response.read()
+        statuses[response.status] = statuses.get(response.status, 0) + 1
+        if etags is None:
+            results.setdefault('etags', {})[path] = response.getheader('ETag')
+    con.close()
+    results.setdefault('statuses', []).append(statuses)
+
+
+def run(name, port, clients, paths_per_client, etags=None):
+    results = {}
+    threads = [threading.Thread(target=client, args=(port, paths, etags, results)) for paths in paths_per_client]
+    start_time = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.time() - start_time
+
+    requests = sum([len(paths) for paths in paths_per_client])
+    statuses = {}
+    for s in results['statuses']:
+        for status, count in s.items():
+            statuses[status] = statuses.get(status, 0) + count
+    print "%-28s %8.1f requests/sec (%.2f sec, %s)" % (name, requests / duration, duration,
+        ', '.join(["%d x %d" % (count, status) for status, count in sorted(statuses.items())]))
+    return results.get('etags', {})
+
+
+if __name__ == '__main__':
+    tiles = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    clients = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    requests = int(sys.argv[3]) if len(sys.argv) > 3 else 1000
+
+    work_dir = tempfile.mkdtemp(prefix="mbutil_bench_")
+    try:
+        mbtiles_file = os.path.join(work_dir, 'serve.mbtiles')
+        make_mbtiles(mbtiles_file, tiles, duplicates=0.25)
+
+        server = create_tile_server(mbtiles_file, port=0, workers=clients)
+        port = server.server_address[1]
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+
+        # Every client asks for different tiles, then all of them again
+        con = sqlite3.connect(mbtiles_file)
+        all_paths = ["/%d/%d/%d.png" % t for t in con.execute("SELECT zoom_level, tile_column, tile_row FROM map")]
+        con.close()
+        random.shuffle(all_paths)
+        paths_per_client = [all_paths[i::clients][:requests] for i in range(clients)]
+
+        etags = run("cold", port, clients, paths_per_client)
+        run("hot (lru cache)", port, clients, paths_per_client)
+        run("revalidate (If-None-Match)", port, clients, paths_per_client, etags)
+
+        server.shutdown()
+        server.server_close()
+        server.store.close()
+    finally:
+        shutil.rmtree(work_dir)
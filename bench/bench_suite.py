@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+
+# Runs every mb-util command on synthetic data (see generate.py) and
+# reports tiles/sec, peak RSS and output size. Every benchmark runs in its
+# own process, so the peak RSS is its own. The results can be saved as a
+# JSON baseline and later runs compared against it:
+#
+# $ python bench/bench_suite.py --tiles 50000 --save baseline.json
+# $ python bench/bench_suite.py --tiles 50000 --compare baseline.json
+
+import os, sys, time, shutil, tempfile, json, resource, platform, multiprocessing, logging
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from generate import make_mbtiles, make_tile_directory, zoom_level_tiles, add_generator_options, generator_options
+from mbutil import disk_to_mbtiles, mbtiles_to_disk, compact_mbtiles, merge_mbtiles, check_mbtiles, \
+    execute_commands_on_mbtiles, mbtiles_create, reorder_mbtiles, split_mbtiles
+
+
+def timed(function, *args, **kwargs):
+    start_time = time.time()
+    function(*args, **kwargs)
+    return time.time() - start_time
+
+
+def bench_import(sources, work_dir):
+    mbtiles_file = os.path.join(work_dir, 'import.mbtiles')
+    return timed(disk_to_mbtiles, sources['directory'], mbtiles_file), mbtiles_file
+
+def bench_export(sources, work_dir):
+    directory_path = os.path.join(work_dir, 'export')
+    return timed(mbtiles_to_disk, sources['compacted'], directory_path), directory_path
+
+def bench_compact(sources, work_dir):
+    mbtiles_file = os.path.join(work_dir, 'compact.mbtiles')
+    shutil.copyfile(sources['flat'], mbtiles_file)
+    return timed(compact_mbtiles, mbtiles_file), mbtiles_file
+
+def bench_merge(sources, work_dir, **kwargs):
+    mbtiles_file = os.path.join(work_dir, 'merge.mbtiles')
+    mbtiles_create(mbtiles_file)
+    return timed(merge_mbtiles, mbtiles_file, sources['compacted'], **kwargs), mbtiles_file
+
+def bench_merge_rows(sources, work_dir):
+    return bench_merge(sources, work_dir, sql_merge=False)
+
+def bench_check(sources, work_dir):
+    return timed(check_mbtiles, sources['compacted']), sources['compacted']
+
+def bench_process(sources, work_dir):
+    mbtiles_file = os.path.join(work_dir, 'process.mbtiles')
+    shutil.copyfile(sources['compacted'], mbtiles_file)
+    return timed(execute_commands_on_mbtiles, mbtiles_file, transform_list=['zlib:compress']), mbtiles_file
+
+def bench_reorder(sources, work_dir):
+    mbtiles_file = os.path.join(work_dir, 'reorder.mbtiles')
+    return timed(reorder_mbtiles, sources['compacted'], mbtiles_file), mbtiles_file
+
+def bench_split(sources, work_dir):
+    directory_path = os.path.join(work_dir, 'split')
+    return timed(split_mbtiles, sources['compacted'], directory_path, grid_zoom=1), directory_path
+
+
+benchmarks = [
+    ('import', bench_import),
+    ('export', bench_export),
+    ('compact', bench_compact),
+    ('merge', bench_merge),
+    ('merge_rows', bench_merge_rows),
+    ('check', bench_check),
+    ('process', bench_process),
+    ('reorder', bench_reorder),
+    ('split', bench_split)
+]
+
+
+def path_size(path):
+    if os.path.isfile(path):
+        size = os.path.getsize(path)
+        if os.path.isfile(path + '-wal'):
+            size += os.path.getsize(path + '-wal')
+        return size
+
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            size += os.path.getsize(os.path.join(root, f))
+    return size
+
+
+def run_benchmark(benchmark, sources, work_dir, results):
+    duration, output = benchmark(sources, work_dir)
+
+    # ru_maxrss is in KB on Linux, the pools of --process/--compact are children
+    peak_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    if sys.platform == 'darwin':
+        peak_rss = peak_rss / 1024
+
+    results.put((duration, peak_rss / 1024.0, path_size(output) / 1048576.0))
+
+
+def run(name, benchmark, tiles, sources, work_dir):
+    benchmark_dir = os.path.join(work_dir, name)
+    os.mkdir(benchmark_dir)
+
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=run_benchmark, args=(benchmark, sources, benchmark_dir, results))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        sys.stderr.write("Benchmark %s failed\n" % (name))
+        sys.exit(1)
+
+    duration, peak_rss, output_size = results.get()
+    shutil.rmtree(benchmark_dir)
+
+    print "%-12s %10.1f tiles/sec %8.2f sec %8.1f MB peak RSS %8.1f MB output" % (name, tiles / duration, duration, peak_rss, output_size)
+    return {
+        'seconds' : duration,
+        'tiles_per_sec' : tiles / duration,
+        'peak_rss_mb' : peak_rss,
+        'output_mb' : output_size
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Prints the change against the baseline, returns False on regressions."""
+    ok = True
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        old, new = baseline[name]['tiles_per_sec'], result['tiles_per_sec']
+        change = (new - old) / old
+        regression = change < -tolerance
+        ok = ok and not regression
+        print "%-12s %10.1f -> %10.1f tiles/sec (%+.1f%%)%s" % (name, old, new, change * 100.0, ' REGRESSION' if regression else '')
+    return ok
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+
+    parser = OptionParser(usage="usage: %prog [options]")
+    add_generator_options(parser)
+    parser.add_option("--only", dest="only", action="append", default=None,
+        help='''Run only this benchmark (%s), may be repeated.''' % (', '.join([b[0] for b in benchmarks])))
+    parser.add_option("--save", dest="save", metavar="FILE", default=None,
+        help='''Save the results as a JSON baseline.''')
+    parser.add_option("--compare", dest="compare", metavar="FILE", default=None,
+        help='''Compare the tiles/sec against a JSON baseline, exits with 1 on regressions.''')
+    parser.add_option("--tolerance", dest="tolerance", type="float", default=0.2,
+        help='''Slowdown against the baseline counted as a regression. Default is 0.2 (20%).''')
+    (options, args) = parser.parse_args()
+
+    tiles = sum([n for z, n in zoom_level_tiles(options.tiles, options.min_zoom, options.max_zoom)])
+    generator = generator_options(options)
+
+    work_dir = tempfile.mkdtemp(prefix="mbutil_bench_")
+    try:
+        sources = {
+            'compacted' : os.path.join(work_dir, 'compacted.mbtiles'),
+            'flat' : os.path.join(work_dir, 'flat.mbtiles'),
+            'directory' : os.path.join(work_dir, 'directory')
+        }
+        make_mbtiles(sources['compacted'], options.tiles, True, **generator)
+        make_mbtiles(sources['flat'], options.tiles, False, **generator)
+        make_tile_directory(sources['directory'], options.tiles, **generator)
+
+        results = {}
+        for name, benchmark in benchmarks:
+            if options.only and name not in options.only:
+                continue
+            results[name] = run(name, benchmark, tiles, sources, work_dir)
+    finally:
+        shutil.rmtree(work_dir)
+
+    report = {
+        'tiles' : tiles,
+        'generator' : generator,
+        'python' : platform.python_version(),
+        'platform' : platform.platform(),
+        'results' : results
+    }
+
+    if options.save:
+        f = open(options.save, 'w')
+        json.dump(report, f, indent=4, sort_keys=True)
+        f.close()
+
+    if options.compare:
+        baseline = json.load(open(options.compare))
+        if baseline.get('tiles') != tiles or baseline.get('generator') != generator:
+            sys.stderr.write("The baseline was generated with different data\n")
+        if not compare(results, baseline['results'], options.tolerance):
+            sys.exit(1)
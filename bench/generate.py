@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+# Generates synthetic mbtiles databases and tile directories for the
+# benchmarks. The tiles fill the zoom levels from min_zoom to max_zoom
+# like a regional extract: the low zoom levels completely, the rest of the
+# tiles spread evenly over the higher zoom levels. A share of the tiles
+# (--duplicates) reuses a handful of images, like blank sea or land tiles.
+#
+# $ python bench/generate.py [options] file.mbtiles|directory
+
+import os, sys, random, hashlib, sqlite3, json
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from mbutil import mbtiles_connect, mbtiles_setup, optimize_connection
+
+
+def zoom_level_tiles(tiles, min_zoom, max_zoom):
+    """Returns [(zoom, number of tiles)] for tiles spread over the zoom levels."""
+    result = []
+    remaining = tiles
+    for z in range(min_zoom, max_zoom + 1):
+        share = (remaining + (max_zoom - z)) / (max_zoom - z + 1)
+        n = min(4**z, share)
+        result.append((z, n))
+        remaining -= n
+    return result
+
+
+def generate_tiles(tiles, min_zoom=0, max_zoom=14, duplicates=0.3, tile_size=512, seed=1):
+    """Yields (z, x, y, tile_data) in TMS order, deterministic for a seed."""
+    rnd = random.Random(seed)
+    padding = ''.join([chr(rnd.getrandbits(8)) for i in range(tile_size)])
+    shared_images = ['shared %d ' % (i) + padding for i in range(8)]
+
+    for z, n in zoom_level_tiles(tiles, min_zoom, max_zoom):
+        # A square block of tiles, like an extract of a region
+        width = 1
+        while width * width < n:
+            width += 1
+
+        for i in range(n):
+            x, y = i % width, i / width
+            if rnd.random() < duplicates:
+                tile_data = shared_images[rnd.randrange(len(shared_images))]
+            else:
+                tile_data = '%d/%d/%d ' % (z, x, y) + padding
+            yield (z, x, y, tile_data[:max(tile_size, 32)])
+
+
+def make_mbtiles(mbtiles_file, tiles, compacted=True, **kwargs):
+    con = mbtiles_connect(mbtiles_file)
+    cur = con.cursor()
+    optimize_connection(cur, False)
+
+    if compacted:
+        mbtiles_setup(cur)
+    else:
+        cur.execute("""CREATE TABLE metadata (name TEXT, value TEXT)""")
+        cur.execute("""CREATE UNIQUE INDEX name ON metadata (name)""")
+        cur.execute("""CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB)""")
+        cur.execute("""CREATE UNIQUE INDEX tile_index ON tiles (zoom_level, tile_column, tile_row)""")
+
+    cur.executemany("""INSERT INTO metadata (name, value) VALUES (?, ?)""",
+        [('name', 'synthetic'), ('format', 'png'), ('minzoom', str(kwargs.get('min_zoom', 0))), ('maxzoom', str(kwargs.get('max_zoom', 14)))])
+
+    batch = []
+    for z, x, y, tile_data in generate_tiles(tiles, **kwargs):
+        batch.append((z, x, y, tile_data))
+        if len(batch) >= 10000:
+            write_batch(cur, batch, compacted)
+            batch = []
+    write_batch(cur, batch, compacted)
+
+    con.commit()
+    con.close()
+
+
+def write_batch(cur, batch, compacted):
+    if compacted:
+        tile_ids = [hashlib.md5(tile_data).hexdigest() for z, x, y, tile_data in batch]
+        cur.executemany("""INSERT OR IGNORE INTO images (tile_id, tile_data) VALUES (?, ?)""",
+            [(tile_id, sqlite3.Binary(t[3])) for tile_id, t in zip(tile_ids, batch)])
+        cur.executemany("""REPLACE INTO map (zoom_level, tile_column, tile_row, tile_id) VALUES (?, ?, ?, ?)""",
+            [(t[0], t[1], t[2], tile_id) for tile_id, t in zip(tile_ids, batch)])
+    else:
+        cur.executemany("""REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?)""",
+            [(z, x, y, sqlite3.Binary(tile_data)) for z, x, y, tile_data in batch])
+
+
+def make_tile_directory(directory_path, tiles, **kwargs):
+    """Writes metadata.json and tiles/z/x/y.png below directory_path."""
+    os.makedirs(os.path.join(directory_path, 'tiles'))
+    json.dump({'name': 'synthetic', 'format': 'png'}, open(os.path.join(directory_path, 'metadata.json'), 'w'))
+
+    created_dirs = set()
+    for z, x, y, tile_data in generate_tiles(tiles, **kwargs):
+        tile_dir = os.path.join(directory_path, 'tiles', str(z), str(x))
+        if tile_dir not in created_dirs:
+            os.makedirs(tile_dir)
+            created_dirs.add(tile_dir)
+        f = open(os.path.join(tile_dir, '%d.png' % (y)), 'wb')
+        f.write(tile_data)
+        f.close()
+
+
+def add_generator_options(parser):
+    parser.add_option("--tiles", dest="tiles", type="int", default=20000,
+        help='''Number of tiles. Default is 20000.''')
+    parser.add_option("--min-zoom", dest="min_zoom", type="int", default=0,
+        help='''Lowest zoom level. Default is 0.''')
+    parser.add_option("--max-zoom", dest="max_zoom", type="int", default=14,
+        help='''Highest zoom level. Default is 14.''')
+    parser.add_option("--duplicates", dest="duplicates", type="float", default=0.3,
+        help='''Share of the tiles using one of 8 shared images. Default is 0.3.''')
+    parser.add_option("--tile-size", dest="tile_size", type="int", default=512,
+        help='''Size of every tile in bytes. Default is 512.''')
+    parser.add_option("--seed", dest="seed", type="int", default=1,
+        help='''Random seed. Default is 1.''')
+
+
+def generator_options(options):
+    return dict(min_zoom=options.min_zoom, max_zoom=options.max_zoom,
+        duplicates=options.duplicates, tile_size=options.tile_size, seed=options.seed)
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage="usage: %prog [options] file.mbtiles|directory")
+    add_generator_options(parser)
+    parser.add_option("--flat", dest="flat", action="store_true", default=False,
+        help='''Write a flat tiles table instead of a compacted database.''')
+    (options, args) = parser.parse_args()
+
+    if len(args) != 1 or os.path.exists(args[0]):
+        parser.error("give one mbtiles file or directory that doesn't exist yet")
+
+    if args[0].endswith('.mbtiles'):
+        make_mbtiles(args[0], options.tiles, not options.flat, **generator_options(options))
+    else:
+        make_tile_directory(args[0], options.tiles, **generator_options(options))
@@ -1,7 +1,14 @@
 from util import *
+from util_metrics import *
+from util_archive import *
+from util_cache import *
 from util_check import *
 from util_compact import *
+from util_delete import *
 from util_export import *
 from util_import import *
 from util_merge import *
 from util_process import *
+from util_reorder import *
+from util_serve import *
+from util_split import *
@@ -1,12 +1,141 @@
-import sqlite3, uuid, sys, logging, time, os, json, zlib, hashlib, tempfile
+import sqlite3, uuid, sys, logging, time, os, json, zlib, hashlib, tempfile, importlib, shlex, subprocess, threading, array, bisect, math
 
 logger = logging.getLogger(__name__)
 
+try:
+    from hashlib import blake2b
+except ImportError:
+    try:
+        from pyblake2 import blake2b
+    except ImportError:
+        blake2b = None
+
 
 def flip_y(zoom, y):
     return (2**zoom-1) - y
 
 
+# Deeper tiles are smaller than a centimetre, --bbox ignores them
+max_bbox_zoom = 30
+
+
+def bbox_tile_range(zoom, bbox, xyz=False):
+    """Returns (min_x, min_y, max_x, max_y) of the tiles of zoom covering
+    bbox (min_lon, min_lat, max_lon, max_lat), with TMS rows like in
+    mbtiles databases, or XYZ rows if xyz."""
+    min_lon, min_lat, max_lon, max_lat = bbox
+    n = 2**zoom
+
+    def column(lon):
+        return min(n - 1, max(0, int(math.floor((lon + 180.0) / 360.0 * n))))
+
+    def row(lat):
+        # Web Mercator ends at 85.0511 degrees north and south
+        lat = math.radians(min(85.0511, max(-85.0511, lat)))
+        y = (1.0 - math.log(math.tan(lat) + 1.0 / math.cos(lat)) / math.pi) / 2.0 * n
+        return min(n - 1, max(0, int(math.floor(y))))
+
+    # XYZ rows count from the north
+    min_y, max_y = row(max_lat), row(min_lat)
+    if not xyz:
+        min_y, max_y = flip_y(zoom, max_y), flip_y(zoom, min_y)
+    return (column(min_lon), min_y, column(max_lon), max_y)
+
+
+def tile_range_condition(min_zoom, max_zoom, tile_range=None, bbox=None, xyz=False):
+    """Returns the WHERE condition and its parameters selecting the tiles
+    from min_zoom to max_zoom, inside tile_range (min_x, min_y, max_x, max_y)
+    and inside bbox (min_lon, min_lat, max_lon, max_lat) if given. The
+    condition is answered by the (zoom_level, tile_column, tile_row) index
+    of map or tiles, a bbox with one index range per zoom level."""
+    condition = "zoom_level>=? AND zoom_level<=?"
+    params = [min_zoom, max_zoom]
+    if bbox:
+        terms = []
+        params = []
+        for z in range(max(min_zoom, 0), min(max_zoom, max_bbox_zoom) + 1):
+            min_x, min_y, max_x, max_y = bbox_tile_range(z, bbox, xyz)
+            terms.append("(zoom_level=? AND tile_column>=? AND tile_column<=? AND tile_row>=? AND tile_row<=?)")
+            params += [z, min_x, max_x, min_y, max_y]
+        condition = "(%s)" % (" OR ".join(terms) or "0")
+    if tile_range:
+        min_x, min_y, max_x, max_y = tile_range
+        condition += " AND tile_column>=? AND tile_column<=? AND tile_row>=? AND tile_row<=?"
+        params += [min_x, max_x, min_y, max_y]
+    return condition, params
+
+
+def md5_tile_id(tile_data):
+    m = hashlib.md5()
+    m.update(tile_data)
+    return m.hexdigest()
+
+
+def blake2b_tile_id(tile_data):
+    # 16 bytes, so the tile_ids have the same length as MD5 ones
+    m = blake2b(digest_size=16)
+    m.update(tile_data)
+    return m.hexdigest()
+
+
+class BinaryTileId(str):
+    """A binary tile_id of the optimized layout. Unlike a buffer it can be
+    a dict key and sent to other processes, and it is stored as a BLOB."""
+    pass
+
+sqlite3.register_adapter(BinaryTileId, buffer)
+
+
+def read_tile_id(tile_id):
+    """Returns a tile_id read from SQLite, which returns the binary ones as
+    unhashable buffers, as a BinaryTileId."""
+    if isinstance(tile_id, buffer):
+        return BinaryTileId(tile_id)
+    return tile_id
+
+
+def md5_binary_tile_id(tile_data):
+    m = hashlib.md5()
+    m.update(tile_data)
+    return BinaryTileId(m.digest())
+
+
+def blake2b_binary_tile_id(tile_data):
+    m = blake2b(digest_size=16)
+    m.update(tile_data)
+    return BinaryTileId(m.digest())
+
+
+tile_id_hashes = {
+    'md5' : md5_tile_id,
+    'blake2b' : blake2b_tile_id
+}
+
+# The optimized layout stores the 16 byte digests as BLOBs instead of hex text
+binary_tile_id_hashes = {
+    'md5' : md5_binary_tile_id,
+    'blake2b' : blake2b_binary_tile_id
+}
+
+
+def tile_id_hash(hash_name, binary=False):
+    """Returns the function computing tile_ids with hash_name."""
+    if hash_name == 'blake2b' and blake2b is None:
+        logger.error("BLAKE2 needs python >= 3.6 or the pyblake2 module")
+        sys.exit(1)
+    return (binary_tile_id_hashes if binary else tile_id_hashes)[hash_name]
+
+
+def database_tile_id_hash(cur, default='md5'):
+    """Returns the name of the hash of the tile_ids of a database, as
+    recorded in its metadata by mbutil, or default for other databases."""
+    try:
+        row = cur.execute("""SELECT value FROM metadata WHERE name='tile_id_hash'""").fetchone()
+    except sqlite3.OperationalError:
+        return default
+    return row[0] if row and row[0] else default
+
+
 def mbtiles_connect(mbtiles_file, auto_commit=False):
     try:
         con = sqlite3.connect(mbtiles_file)
@@ -20,28 +149,63 @@ def mbtiles_connect(mbtiles_file, auto_commit=False):
 
 
 def optimize_connection(cur, exclusive_lock=True):
-    cur.execute("""PRAGMA journal_mode=WAL""")
+    # Fetch the results, an unfinished PRAGMA statement blocks later commits
+    cur.execute("""PRAGMA journal_mode=WAL""").fetchall()
     if exclusive_lock:
-        cur.execute("""PRAGMA locking_mode=EXCLUSIVE""")
-
-
-def compaction_prepare(cur):
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS images (
-        tile_data BLOB,
-        tile_id VARCHAR(256))""")
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS map (
-        zoom_level INTEGER,
-        tile_column INTEGER,
-        tile_row INTEGER,
-        tile_id VARCHAR(256))""")
+        cur.execute("""PRAGMA locking_mode=EXCLUSIVE""").fetchall()
+
+
+def storage_prepare(cur, layout='standard', page_size=None):
+    """Sets the page size, and for the optimized layout incremental
+    auto_vacuum, of a new database. Both only work before the first table
+    is created and before optimize_connection switches to WAL."""
+    if layout == 'optimized':
+        page_size = page_size or 16384
+    # The page size first, setting auto_vacuum writes the database header
+    if page_size:
+        cur.execute("""PRAGMA page_size=%d""" % (page_size))
+    if layout == 'optimized':
+        cur.execute("""PRAGMA auto_vacuum=INCREMENTAL""")
+
+
+def optimized_layout(cur):
+    """Returns True if the database uses the optimized layout: a WITHOUT
+    ROWID map clustered by (zoom_level, tile_column, tile_row) and binary
+    tile_ids."""
+    row = cur.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name='map'").fetchone()
+    return row is not None and 'WITHOUT ROWID' in row[0].upper()
+
+
+def compaction_prepare(cur, layout='standard'):
+    if layout == 'optimized':
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS images (
+            tile_data BLOB,
+            tile_id BLOB PRIMARY KEY)""")
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS map (
+            zoom_level INTEGER,
+            tile_column INTEGER,
+            tile_row INTEGER,
+            tile_id BLOB,
+            PRIMARY KEY (zoom_level, tile_column, tile_row)) WITHOUT ROWID""")
+    else:
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS images (
+            tile_data BLOB,
+            tile_id VARCHAR(256))""")
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS map (
+            zoom_level INTEGER,
+            tile_column INTEGER,
+            tile_row INTEGER,
+            tile_id VARCHAR(256))""")
     cur.execute("""
         CREATE TABLE IF NOT EXISTS metadata (
         name TEXT,
         value TEXT)""")
     cur.execute("""
-        CREATE UNIQUE INDEX name ON metadata (name)""")
+        CREATE UNIQUE INDEX IF NOT EXISTS name ON metadata (name)""")
 
 
 def compaction_finalize(cur):
@@ -56,16 +220,83 @@ def compaction_finalize(cur):
         map.tile_row AS tile_row,
         images.tile_data AS tile_data FROM
         map JOIN images ON images.tile_id = map.tile_id""")
+
+    # The primary keys of the optimized layout already are these indexes
+    if optimized_layout(cur):
+        return
     cur.execute("""
         CREATE UNIQUE INDEX map_index ON map
         (zoom_level, tile_column, tile_row)""")
     cur.execute("""
-          CREATE UNIQUE INDEX images_id ON images (tile_id)""")
+          CREATE UNIQUE INDEX IF NOT EXISTS images_id ON images (tile_id)""")
 
 
-def mbtiles_setup(cur):
-    compaction_prepare(cur)
+def mbtiles_setup(cur, layout='standard', hash_name='md5'):
+    """Creates the tables of a compacted database whose tile_ids are the
+    hash_name of the images, not recorded if None."""
+    compaction_prepare(cur, layout)
     compaction_finalize(cur)
+    if hash_name:
+        cur.execute("""REPLACE INTO metadata (name, value) VALUES ('tile_id_hash', ?)""", (hash_name, ))
+
+
+def map_key(cur):
+    """Returns the columns ordering the map table for keyset pagination:
+    the rowid, or the primary key of the optimized layout, which has no
+    rowid. Compare them as a row value, e.g. (%s) > (?, ?, ?)."""
+    if optimized_layout(cur):
+        return ['map.zoom_level', 'map.tile_column', 'map.tile_row']
+    return ['map.rowid']
+
+
+def encode_map_position(key):
+    """Returns the checkpoint position of a map_key value."""
+    return ','.join([str(v) for v in key])
+
+
+def decode_map_position(position, key_columns):
+    """Returns the map_key value of a checkpoint position, or the value
+    before the first row for None."""
+    if position is None:
+        return [-1] * len(key_columns)
+    return [int(v) for v in position.split(',')]
+
+
+def checkpoint_prepare(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS checkpoints (
+        operation TEXT,
+        source TEXT,
+        position TEXT)""")
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS checkpoints_index ON checkpoints (operation, source)""")
+
+
+def load_checkpoints(cur, operation, source):
+    """Returns the positions already committed by an interrupted run."""
+    if cur.execute("SELECT count(name) FROM sqlite_master WHERE type='table' AND name='checkpoints'").fetchone()[0] == 0:
+        return []
+    return [r[0] for r in cur.execute("""SELECT position FROM checkpoints WHERE operation=? AND source=?""",
+        (operation, source)).fetchall()]
+
+
+def add_checkpoints(cur, operation, source, positions, replace=False):
+    """Records positions, call it in the transaction writing their tiles.
+    With replace the new position overrides the old ones."""
+    if replace:
+        cur.execute("""DELETE FROM checkpoints WHERE operation=? AND source=?""",
+            (operation, source))
+    cur.executemany("""INSERT INTO checkpoints (operation, source, position) VALUES (?, ?, ?)""",
+        [(operation, source, position) for position in positions])
+
+
+def clear_checkpoints(cur, operation, source):
+    if cur.execute("SELECT count(name) FROM sqlite_master WHERE type='table' AND name='checkpoints'").fetchone()[0] == 0:
+        return
+    cur.execute("""DELETE FROM checkpoints WHERE operation=? AND source=?""",
+        (operation, source))
+    if cur.execute("""SELECT count(*) FROM checkpoints""").fetchone()[0] == 0:
+        cur.execute("""DROP TABLE checkpoints""")
 
 
 def optimize_database(cur, skip_analyze, skip_vacuum):
@@ -91,14 +322,221 @@ def mbtiles_create(mbtiles_file, **kwargs):
     logger.info("Creating empty database %s" % (mbtiles_file))
     con = mbtiles_connect(mbtiles_file)
     cur = con.cursor()
+    storage_prepare(cur, kwargs.get('layout', 'standard'), kwargs.get('page_size'))
     optimize_connection(cur)
-    mbtiles_setup(cur)
+    mbtiles_setup(cur, kwargs.get('layout', 'standard'))
     con.commit()
     con.close()
 
 
-def execute_commands_on_tile(command_list, image_format, tile_data):
-    if command_list == None or tile_data == None:
+class TileWriter(object):
+    """Buffers tiles and writes them with executemany() in transactions
+    of batch_size tiles, either into images/map or into a flat tiles table."""
+
+    def __init__(self, con, compacted=True, batch_size=1000, metrics=None):
+        self.con = con
+        self.compacted = compacted
+        self.tile_id_function = tile_id_hash(database_tile_id_hash(con.cursor()), compacted and optimized_layout(con.cursor()))
+        self.batch_size = max(1, batch_size)
+        self.metrics = metrics
+        self.bytes_written = 0
+        self.images = []
+        self.tiles = []
+        self.image_ids = set()
+        self.count = 0
+        # Called with the cursor inside every flush transaction, e.g. to save a checkpoint
+        self.on_flush = None
+
+    def add(self, z, x, y, tile_data, tile_id=None):
+        if self.compacted:
+            if tile_id is None:
+                tile_id = self.tile_id_function(tile_data)
+            # tile_data can be None for an image which was already added
+            if tile_data is not None and tile_id not in self.image_ids:
+                self.image_ids.add(tile_id)
+                self.images.append((tile_id, sqlite3.Binary(tile_data)))
+                self.bytes_written += len(tile_data)
+            self.tiles.append((z, x, y, tile_id))
+        else:
+            self.tiles.append((z, x, y, sqlite3.Binary(tile_data)))
+            self.bytes_written += len(tile_data)
+
+        if len(self.tiles) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.tiles) == 0:
+            return
+
+        start_time = time.time()
+        cur = self.con.cursor()
+        if self.con.isolation_level is None:
+            cur.execute("""BEGIN""")
+
+        if self.compacted:
+            cur.executemany("""INSERT OR IGNORE INTO images (tile_id, tile_data) VALUES (?, ?)""",
+                self.images)
+            cur.executemany("""REPLACE INTO map (zoom_level, tile_column, tile_row, tile_id) VALUES (?, ?, ?, ?)""",
+                self.tiles)
+        else:
+            cur.executemany("""REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?)""",
+                self.tiles)
+
+        if self.on_flush:
+            self.on_flush(cur)
+
+        if self.metrics:
+            start_time = self.metrics.time('write', start_time)
+
+        if self.con.isolation_level is None:
+            cur.execute("""COMMIT""")
+        else:
+            self.con.commit()
+
+        if self.metrics:
+            self.metrics.time('commit', start_time)
+            self.metrics.add('bytes_written', self.bytes_written)
+        self.bytes_written = 0
+
+        self.count += len(self.tiles)
+        self.images = []
+        self.tiles = []
+        self.image_ids = set()
+
+    def close(self):
+        self.flush()
+
+
+_transforms = {}
+
+
+def load_transform(name):
+    """Returns the function of a 'module:function' transform. Transforms
+    take the tile data as a string and return the new tile data."""
+    transform = _transforms.get(name)
+    if transform is None:
+        try:
+            module_name, function_name = name.split(':', 1)
+            transform = getattr(importlib.import_module(module_name), function_name)
+        except (ValueError, ImportError, AttributeError), e:
+            logger.error("Could not load transform %s" % (name))
+            logger.exception(e)
+            sys.exit(1)
+        _transforms[name] = transform
+    return transform
+
+
+class TileIndex(object):
+    """Answers whether a (z, x, y) tile exists in mbtiles_file, e.g. for
+    --no-overwrite. Every zoom level is loaded on first use, into a bitmap
+    over its bounding box or, for sparse zoom levels, a sorted array."""
+
+    def __init__(self, mbtiles_file):
+        self.con = sqlite3.connect(mbtiles_file, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.zoom_levels = {}
+        self.added = set()
+
+        compacted = (self.con.execute("SELECT count(name) FROM sqlite_master WHERE type='table' AND name='map'").fetchone()[0] > 0)
+        self.table = 'map' if compacted else 'tiles'
+
+    def load(self, z):
+        t = self.con.execute("""SELECT min(tile_column), max(tile_column), min(tile_row), max(tile_row), count(*) FROM %s WHERE zoom_level=?""" % (self.table),
+            (z, )).fetchone()
+        if t[4] == 0:
+            return None
+
+        min_x, max_x, min_y, max_y, total_tiles = t
+        height = max_y - min_y + 1
+        size = (max_x - min_x + 1) * height
+
+        tiles = self.con.execute("""SELECT tile_column, tile_row FROM %s WHERE zoom_level=? ORDER BY tile_column, tile_row""" % (self.table),
+            (z, ))
+
+        # A bitmap costs size bits, a sorted array 64 bits per tile
+        if size <= total_tiles * 64:
+            keys = bytearray((size + 7) / 8)
+            for x, y in tiles:
+                key = (x - min_x) * height + (y - min_y)
+                keys[key >> 3] |= 1 << (key & 7)
+        else:
+            # The index order is also the key order
+            keys = array.array('L', [(x - min_x) * height + (y - min_y) for x, y in tiles])
+
+        logger.debug("Loaded %d tiles of zoom level %d" % (total_tiles, z))
+        return (min_x, max_x, min_y, max_y, keys)
+
+    def contains(self, z, x, y):
+        if (z, x, y) in self.added:
+            return True
+
+        zoom_level = self.zoom_levels.get(z, False)
+        if zoom_level is False:
+            with self.lock:
+                zoom_level = self.zoom_levels.get(z, False)
+                if zoom_level is False:
+                    zoom_level = self.zoom_levels[z] = self.load(z)
+
+        if zoom_level is None:
+            return False
+
+        min_x, max_x, min_y, max_y, keys = zoom_level
+        if x < min_x or x > max_x or y < min_y or y > max_y:
+            return False
+
+        key = (x - min_x) * (max_y - min_y + 1) + (y - min_y)
+        if isinstance(keys, bytearray):
+            return (keys[key >> 3] >> (key & 7)) & 1 == 1
+
+        i = bisect.bisect_left(keys, key)
+        return i < len(keys) and keys[i] == key
+
+    def add(self, z, x, y):
+        zoom_level = self.zoom_levels.get(z)
+        if zoom_level is not None and isinstance(zoom_level[4], bytearray):
+            min_x, max_x, min_y, max_y, keys = zoom_level
+            if x >= min_x and x <= max_x and y >= min_y and y <= max_y:
+                key = (x - min_x) * (max_y - min_y + 1) + (y - min_y)
+                keys[key >> 3] |= 1 << (key & 7)
+                return
+
+        self.added.add((z, x, y))
+
+    def close(self):
+        self.con.close()
+
+
+def execute_pipe_on_tile(command, tile_data):
+    """Runs command (without a shell) with the tile data on stdin and
+    returns its stdout. Returns the unchanged tile data on failure."""
+    try:
+        p = subprocess.Popen(shlex.split(command), stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        new_tile_data = p.communicate(tile_data)[0]
+    except OSError, e:
+        logger.error("Could not execute %s: %s" % (command, e))
+        return tile_data
+
+    if p.returncode != 0 or len(new_tile_data) == 0:
+        logger.warning("%s exited with code %d, keeping the tile unchanged" % (command, p.returncode))
+        return tile_data
+
+    return new_tile_data
+
+
+def execute_commands_on_tile(command_list, image_format, tile_data, transform_list=None, pipe_list=None):
+    if tile_data == None:
+        return tile_data
+
+    if transform_list or pipe_list:
+        tile_data = str(tile_data)
+
+    for name in transform_list or []:
+        tile_data = load_transform(name)(tile_data)
+
+    for command in pipe_list or []:
+        tile_data = execute_pipe_on_tile(command, tile_data)
+
+    if not command_list:
         return tile_data
 
     tmp_file_fd, tmp_file_name = tempfile.mkstemp(suffix=".%s" % (image_format), prefix="tile_")
@@ -131,9 +569,7 @@ def execute_commands_on_file(command_list, image_format, image_file_path):
 
 
 def process_tile(next_tile):
-    tile_id, tile_file_path, image_format, command_list = next_tile['tile_id'], next_tile['filename'], next_tile['format'], next_tile['command_list']
-    # sys.stderr.write("%s (%s) -> %s\n" % (tile_id, image_format, tile_file_path))
-
-    tile_data = execute_commands_on_file(command_list, image_format, tile_file_path)
+    next_tile['tile_data'] = execute_commands_on_tile(next_tile['command_list'], next_tile['format'],
+        next_tile['tile_data'], next_tile.get('transform_list'), next_tile.get('pipe_list'))
 
     return next_tile
@@ -0,0 +1,361 @@
+import sqlite3, uuid, sys, logging, time, os, json, zlib, hashlib, tempfile, tarfile, zipfile, StringIO, re
+
+from util import mbtiles_connect, mbtiles_setup, storage_prepare, optimize_connection, optimize_database, execute_commands_on_tile, flip_y, tile_range_condition, TileWriter, TileIndex
+from util_import import restore_metadata
+from util_metrics import get_metrics
+from util_delete import delete_tiles
+
+logger = logging.getLogger(__name__)
+
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+archive_formats = [
+    ('.tar', 'tar'),
+    ('.tar.gz', 'tar.gz'),
+    ('.tgz', 'tar.gz'),
+    ('.tar.bz2', 'tar.bz2'),
+    ('.tbz2', 'tar.bz2'),
+    ('.tar.zst', 'tar.zst'),
+    ('.tzst', 'tar.zst'),
+    ('.zip', 'zip')
+]
+
+
+def archive_format(path):
+    """Returns the archive format ('tar', 'tar.gz', 'tar.bz2', 'tar.zst' or
+    'zip') of path from its extension, or None if path is no archive."""
+    for extension, archive_type in archive_formats:
+        if path.lower().endswith(extension):
+            return archive_type
+    return None
+
+
+def check_archive_format(archive_type):
+    if archive_type == 'tar.zst' and zstandard is None:
+        logger.error("zstd compressed archives need the zstandard module")
+        sys.exit(1)
+
+
+class ArchiveWriter(object):
+    """Writes files sequentially into a tar (optionally gzip, bzip2 or
+    zstd compressed) or zip archive, without seeking in the output."""
+
+    def __init__(self, archive_file, archive_type):
+        check_archive_format(archive_type)
+
+        self.archive_type = archive_type
+        self.mtime = time.time()
+        self.file = self.stream = None
+
+        if archive_type == 'zip':
+            self.zip = zipfile.ZipFile(archive_file, 'w', zipfile.ZIP_STORED, allowZip64=True)
+        elif archive_type == 'tar.zst':
+            self.file = open(archive_file, 'wb')
+            self.stream = zstandard.ZstdCompressor().stream_writer(self.file)
+            self.tar = tarfile.open(fileobj=self.stream, mode='w|')
+        elif archive_type == 'tar.gz':
+            self.tar = tarfile.open(archive_file, mode='w|gz')
+        elif archive_type == 'tar.bz2':
+            self.tar = tarfile.open(archive_file, mode='w|bz2')
+        else:
+            self.tar = tarfile.open(archive_file, mode='w|')
+
+    def add(self, name, data):
+        if self.archive_type == 'zip':
+            info = zipfile.ZipInfo(name, time.localtime(self.mtime)[:6])
+            info.external_attr = 0644 << 16
+            self.zip.writestr(info, data)
+        else:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = self.mtime
+            info.mode = 0644
+            self.tar.addfile(info, StringIO.StringIO(data))
+
+    def close(self):
+        if self.archive_type == 'zip':
+            self.zip.close()
+            return
+
+        self.tar.close()
+        if self.stream is not None:
+            self.stream.flush(zstandard.FLUSH_FRAME)
+        if self.file is not None:
+            self.file.close()
+
+
+def read_archive(archive_file, archive_type):
+    """Yields (name, data) for every file of the archive, in the order
+    they are stored, without extracting anything to disk."""
+    check_archive_format(archive_type)
+
+    if archive_type == 'zip':
+        archive = zipfile.ZipFile(archive_file, 'r', allowZip64=True)
+        try:
+            for info in archive.infolist():
+                if not info.filename.endswith('/'):
+                    yield (info.filename, archive.read(info))
+        finally:
+            archive.close()
+        return
+
+    f = stream = None
+    if archive_type == 'tar.zst':
+        f = open(archive_file, 'rb')
+        stream = zstandard.ZstdDecompressor().stream_reader(f)
+        archive = tarfile.open(fileobj=stream, mode='r|')
+    else:
+        archive = tarfile.open(archive_file, mode='r|*')
+
+    try:
+        for member in archive:
+            if member.isfile():
+                yield (member.name, archive.extractfile(member).read())
+    finally:
+        archive.close()
+        if f is not None:
+            f.close()
+
+
+# [prefix/]z/x/y.ext
+tile_name = re.compile(r'(?:^|/)(\d+)/(\d+)/(\d+)\.\w+$')
+
+
+def tile_format(name):
+    """Returns the image format of a tile file name or of a format name,
+    with jpeg and jpg being the same."""
+    image_format = name.rsplit('.', 1)[-1].lower()
+    return 'jpg' if image_format == 'jpeg' else image_format
+
+
+def archive_to_mbtiles(archive_file, mbtiles_file, **kwargs):
+    """Imports the tiles of a tar or zip archive like disk_to_mbtiles,
+    reading the archive sequentially and writing the tiles in batches."""
+    logger.info("Importing from archive to database: %s --> %s" % (archive_file, mbtiles_file))
+
+
+    import_into_existing_mbtiles = os.path.isfile(mbtiles_file)
+    existing_mbtiles_is_compacted = True
+
+    no_overwrite = kwargs.get('no_overwrite', False)
+    auto_commit  = kwargs.get('auto_commit', False)
+    batch_size   = kwargs.get('batch_size', 1000)
+    command_list   = kwargs.get('command_list')
+    transform_list = kwargs.get('transform_list')
+    pipe_list      = kwargs.get('pipe_list')
+
+    zoom     = kwargs.get('zoom', -1)
+    min_zoom = kwargs.get('min_zoom', 0)
+    max_zoom = kwargs.get('max_zoom', 255)
+
+    if zoom >= 0:
+        min_zoom = max_zoom = zoom
+
+    archive_type = archive_format(archive_file) or 'tar'
+    check_archive_format(archive_type)
+
+    if kwargs.get('resume', False):
+        logger.warning("Archives are always imported from the start, --resume is ignored")
+
+
+    con = mbtiles_connect(mbtiles_file, auto_commit)
+    cur = con.cursor()
+    if not import_into_existing_mbtiles:
+        storage_prepare(cur, kwargs.get('layout', 'standard'), kwargs.get('page_size'))
+    optimize_connection(cur, False)
+
+
+    if import_into_existing_mbtiles:
+        existing_mbtiles_is_compacted = (con.execute("SELECT count(name) FROM sqlite_master WHERE type='table' AND name='images'").fetchone()[0] > 0)
+    else:
+        mbtiles_setup(cur, kwargs.get('layout', 'standard'))
+
+
+    existing_tiles = None
+    if no_overwrite:
+        con.commit()
+        existing_tiles = TileIndex(mbtiles_file)
+
+
+    # metadata.json can come after the tiles, so the extension of every tile
+    # is checked before it is written, like restore_metadata does. Without a
+    # recorded format the tiles must match the first one.
+    original_format = None
+    metadata_format = None
+    first_format = None
+    if import_into_existing_mbtiles:
+        try:
+            original_format = con.execute("SELECT value FROM metadata WHERE name='format'").fetchone()[0]
+        except:
+            pass
+
+    count = 0
+    image_format = None
+    metrics = get_metrics(**kwargs)
+    metrics.start('import', None, archive_file)
+    writer = TileWriter(con, existing_mbtiles_is_compacted, batch_size, metrics)
+
+    start_time = time.time()
+    for name, tile_data in read_archive(archive_file, archive_type):
+        metrics.add('bytes_read', len(tile_data))
+        start_time = metrics.time('read', start_time)
+
+        if os.path.basename(name) == 'metadata.json':
+            metadata = json.loads(tile_data)
+            image_format = restore_metadata(con, metadata, import_into_existing_mbtiles)
+            metadata_format = metadata.get('format')
+            if metadata_format != None and first_format != None and tile_format(metadata_format) != first_format:
+                sys.stderr.write('The files to merge must use the same image format (png or jpg)\n')
+                sys.exit(1)
+            continue
+
+        match = tile_name.search(name)
+        if not match:
+            logger.debug("Ignoring %s" % (name))
+            continue
+
+        z, x, y = int(match.group(1)), int(match.group(2)), int(match.group(3))
+        if z < min_zoom or z > max_zoom:
+            continue
+
+        expected_format = original_format or metadata_format or first_format
+        if expected_format != None and tile_format(name) != tile_format(expected_format):
+            sys.stderr.write('The files to merge must use the same image format (png or jpg)\n')
+            sys.exit(1)
+        first_format = first_format or tile_format(name)
+
+        if kwargs.get('flip_y', False) == True:
+            y = flip_y(z, y)
+
+        if no_overwrite and existing_tiles.contains(z, x, y):
+            logger.debug("Ignoring tile (%d, %d, %d)" % (z, x, y))
+            continue
+
+        # Execute commands
+        if command_list or transform_list or pipe_list:
+            tile_data = execute_commands_on_tile(command_list, image_format or os.path.splitext(name)[1][1:], tile_data, transform_list, pipe_list)
+            start_time = metrics.time('transform', start_time)
+
+        tile_id = None
+        if existing_mbtiles_is_compacted:
+            tile_id = writer.tile_id_function(tile_data)
+            start_time = metrics.time('hash', start_time)
+
+        writer.add(z, x, y, tile_data, tile_id)
+        # The writer times its own flushes
+        start_time = time.time()
+
+        count = count + 1
+        metrics.tiles()
+
+
+    writer.close()
+
+    if image_format is None:
+        logger.warning('metadata.json not found')
+
+    if existing_tiles:
+        existing_tiles.close()
+
+    logger.info("%d tiles imported." % (count))
+
+    con.commit()
+    con.close()
+    metrics.finish()
+
+
+def mbtiles_to_archive(mbtiles_file, archive_file, **kwargs):
+    """Exports mbtiles_file like mbtiles_to_disk, but streams metadata.json
+    and tiles/z/x/y.ext into a tar or zip archive instead of a directory."""
+    logger.info("Exporting database to archive: %s --> %s" % (mbtiles_file, archive_file))
+
+
+    delete_after_export = kwargs.get('delete_after_export', False)
+    command_list   = kwargs.get('command_list')
+    transform_list = kwargs.get('transform_list')
+    pipe_list      = kwargs.get('pipe_list')
+
+    zoom     = kwargs.get('zoom', -1)
+    min_zoom = kwargs.get('min_zoom', 0)
+    max_zoom = kwargs.get('max_zoom', 255)
+
+    if zoom >= 0:
+        min_zoom = max_zoom = zoom
+
+    bbox = kwargs.get('bbox')
+    condition, params = tile_range_condition(min_zoom, max_zoom, bbox=bbox)
+
+    archive_type = archive_format(archive_file) or 'tar'
+    check_archive_format(archive_type)
+
+
+    con = mbtiles_connect(mbtiles_file)
+    cur = con.cursor()
+    optimize_connection(cur)
+
+    archive = ArchiveWriter(archive_file, archive_type)
+
+
+    metadata = dict(con.execute('SELECT name, value FROM metadata').fetchall())
+    archive.add('metadata.json', json.dumps(metadata, indent=4))
+
+    count = 0
+    image_format = metadata.get('format', 'png')
+    total_tiles = con.execute("""SELECT count(zoom_level) FROM tiles WHERE %s""" % (condition),
+        params).fetchone()[0]
+    sending_mbtiles_is_compacted = (con.execute("SELECT count(name) FROM sqlite_master WHERE type='table' AND name='images'").fetchone()[0] > 0)
+
+    metrics = get_metrics(**kwargs)
+    metrics.start('export', total_tiles, mbtiles_file)
+    start_time = time.time()
+
+    tiles = cur.execute("""SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles WHERE %s""" % (condition),
+        params)
+    rows = tiles.fetchmany(1000)
+    start_time = metrics.time('read', start_time)
+    while rows:
+        for t in rows:
+            z, x, y, tile_data = t[0], t[1], t[2], str(t[3])
+            metrics.add('bytes_read', len(tile_data))
+
+            if kwargs.get('flip_y', False) == True:
+                y = flip_y(z, y)
+
+            if command_list or transform_list or pipe_list:
+                tile_data = execute_commands_on_tile(command_list, image_format, tile_data, transform_list, pipe_list)
+                start_time = metrics.time('transform', start_time)
+
+            archive.add('tiles/%d/%d/%d.%s' % (z, x, y, image_format), tile_data)
+            metrics.add('bytes_written', len(tile_data))
+            start_time = metrics.time('write', start_time)
+
+
+            count = count + 1
+            metrics.tiles()
+
+        rows = tiles.fetchmany(1000)
+        start_time = metrics.time('read', start_time)
+
+    archive.close()
+    metrics.time('write', start_time)
+
+
+    logger.info("%s / %s tiles exported (100.0%%, %.1f tiles/sec)" % (count, total_tiles, metrics.snapshot()['tiles_per_sec']))
+
+
+    if delete_after_export:
+        logger.debug("WARNING: Removing exported tiles from %s" % (mbtiles_file))
+
+        delete_tiles(con, min_zoom, max_zoom, batch_size=kwargs.get('batch_size', 1000), bbox=bbox)
+
+        optimize_database(cur, kwargs.get('skip_analyze', False), kwargs.get('skip_vacuum', False))
+        con.commit()
+
+
+    con.close()
+    metrics.finish()
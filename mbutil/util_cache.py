@@ -0,0 +1,156 @@
+import sqlite3, uuid, sys, logging, time, os, json, zlib, hashlib, tempfile
+
+from util import execute_commands_on_tile, process_tile, md5_tile_id
+
+logger = logging.getLogger(__name__)
+
+
+class TileCache(object):
+    """Sidecar SQLite database remembering the processed result of every
+    input image, keyed by the MD5 of the input image (see cache_key) and the
+    processing pipeline (--execute/--execute-pipe/--transform and the image
+    format the commands see). The least recently used
+    results are evicted once the cache grows above max_size bytes. The
+    results are committed every commit_size changes, so an interrupted run
+    keeps most of them."""
+
+    def __init__(self, cache_file, command_list=None, transform_list=None, pipe_list=None, max_size=1024*1024*1024, commit_size=1000, image_format='png'):
+        self.command_list = command_list
+        self.transform_list = transform_list
+        self.pipe_list = pipe_list
+        self.image_format = image_format
+        self.max_size = max_size
+        self.commit_size = commit_size
+        self.changes = 0
+        self.hits = 0
+        self.misses = 0
+
+        m = hashlib.md5()
+        m.update(json.dumps([command_list or [], transform_list or [], pipe_list or [], image_format]))
+        self.pipeline_id = m.hexdigest()
+
+        self.con = sqlite3.connect(cache_file)
+        self.con.execute("""PRAGMA journal_mode=WAL""")
+        self.con.execute("""
+            CREATE TABLE IF NOT EXISTS results (
+            pipeline_id TEXT,
+            tile_id TEXT,
+            tile_data BLOB,
+            size INTEGER,
+            last_used REAL,
+            PRIMARY KEY (pipeline_id, tile_id))""")
+        self.con.execute("""
+            CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)""")
+        self.size = self.con.execute("""SELECT coalesce(sum(size), 0) FROM results""").fetchone()[0]
+
+    def get(self, tile_id):
+        row = self.con.execute("""SELECT tile_data FROM results WHERE pipeline_id=? AND tile_id=?""",
+            (self.pipeline_id, tile_id)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.con.execute("""UPDATE results SET last_used=? WHERE pipeline_id=? AND tile_id=?""",
+            (time.time(), self.pipeline_id, tile_id))
+        self.changed()
+        return str(row[0])
+
+    def put(self, tile_id, tile_data):
+        if tile_data is None:
+            return
+
+        # A result put again replaces the old one, which no longer counts
+        row = self.con.execute("""SELECT size FROM results WHERE pipeline_id=? AND tile_id=?""",
+            (self.pipeline_id, tile_id)).fetchone()
+        if row is not None:
+            self.size -= row[0]
+
+        self.con.execute("""REPLACE INTO results (pipeline_id, tile_id, tile_data, size, last_used) VALUES (?, ?, ?, ?, ?)""",
+            (self.pipeline_id, tile_id, sqlite3.Binary(tile_data), len(tile_data), time.time()))
+        self.size += len(tile_data)
+
+        if self.size > self.max_size:
+            self.evict()
+        self.changed()
+
+    def changed(self):
+        self.changes += 1
+        if self.changes >= self.commit_size:
+            self.con.commit()
+            self.changes = 0
+
+    def evict(self):
+        # Evict down to 90% of max_size so we don't evict on every put
+        target_size = self.max_size * 0.9
+        while self.size > target_size:
+            rows = self.con.execute("""SELECT pipeline_id, tile_id, size FROM results ORDER BY last_used LIMIT 1000""").fetchall()
+            if len(rows) == 0:
+                break
+            for pipeline_id, tile_id, size in rows:
+                self.con.execute("""DELETE FROM results WHERE pipeline_id=? AND tile_id=?""",
+                    (pipeline_id, tile_id))
+                self.size -= size
+                if self.size <= target_size:
+                    break
+        self.con.commit()
+        self.changes = 0
+
+    def execute(self, tile_data):
+        """Returns the processed tile_data, from the cache if possible."""
+        key = cache_key(tile_data)
+        new_tile_data = self.get(key)
+        if new_tile_data is None:
+            new_tile_data = execute_commands_on_tile(self.command_list, self.image_format, tile_data,
+                self.transform_list, self.pipe_list)
+            self.put(key, new_tile_data)
+        return new_tile_data
+
+    def close(self):
+        total = self.hits + self.misses
+        logger.info("Tile cache: %d hits, %d misses (%.1f%% hit rate), %.1f MB used" %
+            (self.hits, self.misses, (float(self.hits) / float(total) * 100.0) if total else 0.0, self.size / 1048576.0))
+        self.con.commit()
+        self.con.close()
+
+
+def cache_key(tile_data):
+    """Returns the key of the results of an input image. The tile_ids of
+    a database are no content keys unless mbutil computed them."""
+    return md5_tile_id(tile_data)
+
+
+def process_tiles_cached(keys, tiles_data, image_format, pool=None, cache=None, **kwargs):
+    """Returns the processed tiles_data (--execute/--execute-pipe/--transform
+    of kwargs). The results of the cache are used first, the misses are
+    processed by the pool, or here without one, and added to the cache."""
+    results = [cache.get(key) if cache else None for key in keys]
+    misses = [i for i, tile_data in enumerate(results) if tile_data is None]
+
+    tasks = [{
+        'tile_data' : tiles_data[i],
+        'format' : image_format,
+        'command_list' : kwargs.get('command_list'),
+        'transform_list' : kwargs.get('transform_list'),
+        'pipe_list' : kwargs.get('pipe_list')
+    } for i in misses]
+    processed_tiles = pool.map(process_tile, tasks) if pool else [process_tile(task) for task in tasks]
+
+    for i, next_tile in zip(misses, processed_tiles):
+        results[i] = next_tile['tile_data']
+        if cache:
+            cache.put(keys[i], results[i])
+    return results
+
+
+def open_tile_cache(image_format, **kwargs):
+    """Returns a TileCache for the --cache option and the image format of
+    the processed tiles, or None if there is no cache file or nothing to
+    process."""
+    if not kwargs.get('cache_file'):
+        return None
+    if not kwargs.get('command_list') and not kwargs.get('transform_list') and not kwargs.get('pipe_list'):
+        return None
+
+    return TileCache(kwargs['cache_file'], kwargs.get('command_list'), kwargs.get('transform_list'),
+        kwargs.get('pipe_list'), kwargs.get('cache_size', 1024) * 1024 * 1024, image_format=image_format)
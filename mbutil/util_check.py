@@ -1,9 +1,115 @@
-import sqlite3, uuid, sys, logging, time, os, json, zlib, hashlib, tempfile
+import sqlite3, uuid, sys, logging, time, os, json, zlib, hashlib, tempfile, multiprocessing, shutil
 
-from util import mbtiles_connect, optimize_connection, optimize_database, execute_commands_on_tile
+from util import mbtiles_connect, optimize_connection, optimize_database, execute_commands_on_tile, bbox_tile_range, max_bbox_zoom
+from util_metrics import get_metrics
+from multiprocessing import Pool
 
 logger = logging.getLogger(__name__)
 
+# Missing ranges kept per zoom level for the log, --check-output gets all
+logged_ranges = 10
+
+
+def check_zoom_level(args):
+    """Streams the tiles of one zoom level in index order and returns the
+    coverage of the zoom level, with the first missing tiles as
+    [tile_column, first tile_row, last tile_row] ranges. All ranges are
+    written as lines to ranges_file if given. Without a tile_range (min_x,
+    min_y, max_x, max_y), the expected tiles are the bounding box of the
+    existing ones."""
+    mbtiles_file, zoom_level, table, tile_range, ranges_file = args
+
+    con = mbtiles_connect(mbtiles_file)
+
+    if tile_range:
+        minX, minY, maxX, maxY = tile_range
+    else:
+        t = con.execute("""SELECT min(tile_column), max(tile_column), min(tile_row), max(tile_row) FROM %s WHERE zoom_level=?""" % (table),
+            (zoom_level, )).fetchone()
+        minX, maxX, minY, maxY = t[0], t[1], t[2], t[3]
+
+    logger.debug(" - Checking zoom level %d, x: %d - %d, y: %d - %d" % (zoom_level, minX, maxX, minY, maxY))
+
+    missing_ranges = []
+    # Missing tiles and ranges
+    missing = [0, 0]
+    ranges = open(ranges_file, 'w') if ranges_file else None
+
+    def add_missing(column, first_row, last_row):
+        missing[0] += last_row - first_row + 1
+        missing[1] += 1
+        if len(missing_ranges) < logged_ranges:
+            missing_ranges.append([column, first_row, last_row])
+        if ranges:
+            ranges.write('[%d, %d, %d]\n' % (column, first_row, last_row))
+
+    def add_missing_columns(first_column, last_column):
+        for column in range(first_column, last_column + 1):
+            add_missing(column, minY, maxY)
+
+    current_column = None
+    next_row = minY
+    total_tiles = 0
+
+    tiles = con.execute("""SELECT tile_column, tile_row FROM %s WHERE zoom_level=? AND tile_column>=? AND tile_column<=? AND tile_row>=? AND tile_row<=?
+        ORDER BY tile_column, tile_row""" % (table),
+        (zoom_level, minX, maxX, minY, maxY))
+    for x, y in tiles:
+        total_tiles = total_tiles + 1
+        if x != current_column:
+            if current_column is None:
+                add_missing_columns(minX, x - 1)
+            else:
+                if next_row <= maxY:
+                    add_missing(current_column, next_row, maxY)
+                add_missing_columns(current_column + 1, x - 1)
+            current_column = x
+            next_row = minY
+
+        if y > next_row:
+            add_missing(x, next_row, y - 1)
+        next_row = y + 1
+
+    if current_column is None:
+        # Only possible with a tile_range
+        add_missing_columns(minX, maxX)
+    elif next_row <= maxY:
+        add_missing(current_column, next_row, maxY)
+
+    con.close()
+    if ranges:
+        ranges.close()
+
+    return (zoom_level, {
+        'min_x' : minX,
+        'max_x' : maxX,
+        'min_y' : minY,
+        'max_y' : maxY,
+        'tiles' : total_tiles,
+        'missing' : missing[0],
+        'missing_range_count' : missing[1],
+        'missing_ranges' : missing_ranges
+    })
+
+
+def write_check_output(check_output, mbtiles_file, result, coverage, ranges_dir):
+    """Writes the --check-output JSON, streaming the missing ranges of
+    every zoom level from its file in ranges_dir."""
+    f = open(check_output, 'w')
+    f.write('{\n    "file": %s,\n    "complete": %s,\n    "zoom_levels": {' % (json.dumps(mbtiles_file), json.dumps(result)))
+    for n, zoom_level in enumerate(sorted(coverage.keys())):
+        zoom_coverage = dict(coverage[zoom_level])
+        del zoom_coverage['missing_ranges']
+        f.write('%s\n        "%d": {' % (',' if n else '', zoom_level))
+        for name in sorted(zoom_coverage.keys()):
+            f.write('\n            %s: %s,' % (json.dumps(name), json.dumps(zoom_coverage[name])))
+        f.write('\n            "missing_ranges": [')
+        for i, line in enumerate(open(os.path.join(ranges_dir, str(zoom_level)))):
+            f.write('%s\n                %s' % (',' if i else '', line.strip()))
+        f.write('\n            ]\n        }')
+    f.write('\n    }\n}\n')
+    f.close()
+
 
 def check_mbtiles(mbtiles_file, **kwargs):
     logger.info("Checking database %s" % (mbtiles_file))
@@ -14,49 +120,67 @@ def check_mbtiles(mbtiles_file, **kwargs):
     zoom     = kwargs.get('zoom', -1)
     min_zoom = kwargs.get('min_zoom', 0)
     max_zoom = kwargs.get('max_zoom', 255)
+    default_pool_size = kwargs.get('poolsize', -1)
 
     if zoom >= 0:
         min_zoom = max_zoom = zoom
 
     con = mbtiles_connect(mbtiles_file)
     cur = con.cursor()
-    optimize_connection(cur)
+    optimize_connection(cur, False)
 
-    logger.debug("Loading zoom levels")
+    # The map index covers (zoom_level, tile_column, tile_row), the tiles view would join the images
+    existing_mbtiles_is_compacted = (con.execute("SELECT count(name) FROM sqlite_master WHERE type='table' AND name='map'").fetchone()[0] > 0)
+    table = 'map' if existing_mbtiles_is_compacted else 'tiles'
 
-    zoom_levels = [int(x[0]) for x in cur.execute("SELECT distinct(zoom_level) FROM tiles").fetchall()]
-    missing_tiles = []
+    logger.debug("Loading zoom levels")
 
-    for current_zoom_level in zoom_levels:
-        if current_zoom_level < min_zoom or current_zoom_level > max_zoom:
+    zoom_levels = [int(x[0]) for x in cur.execute("SELECT distinct(zoom_level) FROM %s WHERE zoom_level>=? AND zoom_level<=?" % (table),
+        (min_zoom, max_zoom)).fetchall()]
+    con.close()
+
+    # With --bbox, every tile inside it is expected on the existing zoom levels
+    bbox = kwargs.get('bbox')
+    if bbox:
+        zoom_levels = [z for z in zoom_levels if z <= max_bbox_zoom]
+    ranges_dir = tempfile.mkdtemp(prefix='mbutil_check_') if kwargs.get('check_output') else None
+    jobs = [(mbtiles_file, current_zoom_level, table, bbox_tile_range(current_zoom_level, bbox) if bbox else None,
+        os.path.join(ranges_dir, str(current_zoom_level)) if ranges_dir else None) for current_zoom_level in zoom_levels]
+
+    metrics = get_metrics(**kwargs)
+    metrics.start('check', None, mbtiles_file)
+    start_time = time.time()
+
+    if len(jobs) > 1 and default_pool_size != 1:
+        pool = Pool(default_pool_size if default_pool_size > 0 else None)
+        coverage = dict(pool.map(check_zoom_level, jobs))
+        pool.close()
+        pool.join()
+    else:
+        coverage = dict(map(check_zoom_level, jobs))
+
+    metrics.time('read', start_time)
+    metrics.tiles(sum([c['tiles'] for c in coverage.values()]))
+    metrics.finish()
+
+
+    for current_zoom_level in sorted(coverage.keys()):
+        zoom_coverage = coverage[current_zoom_level]
+        if zoom_coverage['missing'] == 0:
             continue
 
-        logger.debug("Starting zoom level %d" % (current_zoom_level))
-
-        t = cur.execute("""SELECT min(tile_column), max(tile_column), min(tile_row), max(tile_row) FROM tiles WHERE zoom_level = ?""",
-            [current_zoom_level]).fetchone()
-
-        minX, maxX, minY, maxY = t[0], t[1], t[2], t[3]
-
-        logger.debug(" - Checking zoom level %d, x: %d - %d, y: %d - %d" % (current_zoom_level, minX, maxX, minY, maxY))
-
-        for current_row in range(minY, maxY+1):
-            logger.debug("   - Row: %d (%.1f%%)" %
-                (current_row, (float(current_row - minY) / float(maxY - minY)) * 100.0) if minY != maxY else 100.0)
-
-            mbtiles_columns = set([int(x[0]) for x in cur.execute("""SELECT tile_column FROM tiles WHERE zoom_level=? AND tile_row=?""",
-                (current_zoom_level, current_row)).fetchall()])
-
-            for current_column in range(minX, maxX+1):
-                if current_column not in mbtiles_columns:
-                    missing_tiles.append([current_zoom_level, current_column, current_row])
+        result = False
+        logger.error("Zoom level %d: %d tiles missing" % (current_zoom_level, zoom_coverage['missing']))
+        logger.error("(zoom, x, y - y)")
+        for x, first_y, last_y in zoom_coverage['missing_ranges']:
+            logger.error("(%d, %d, %d - %d)" % (current_zoom_level, x, first_y, last_y))
+        if zoom_coverage['missing_range_count'] > logged_ranges:
+            logger.error("(%d more ranges, see --check-output)" % (zoom_coverage['missing_range_count'] - logged_ranges))
 
 
-    if len(missing_tiles) > 0:
-        result = False
-        logger.error("(zoom, x, y)")
-        for current_tile in missing_tiles:
-            logger.error(current_tile)
+    if ranges_dir:
+        write_check_output(kwargs['check_output'], mbtiles_file, result, coverage, ranges_dir)
+        shutil.rmtree(ranges_dir)
 
 
     return result
@@ -2,10 +2,15 @@ import sqlite3, uuid, sys, logging, time, os, json, zlib, hashlib, tempfile
 
 logger = logging.getLogger(__name__)
 
-from util import mbtiles_connect, optimize_connection, optimize_database, execute_commands_on_tile, compaction_prepare, compaction_finalize
+from util import mbtiles_connect, optimize_connection, optimize_database, execute_commands_on_tile, compaction_prepare, compaction_finalize, optimized_layout, tile_id_hash, database_tile_id_hash, \
+    checkpoint_prepare, load_checkpoints, add_checkpoints, clear_checkpoints, tile_range_condition
+from util_cache import open_tile_cache, process_tiles_cached, cache_key
+from util_metrics import get_metrics
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 
 
-def compact_mbtiles(mbtiles_file):
+def compact_mbtiles(mbtiles_file, **kwargs):
     logger.info("Compacting database %s" % (mbtiles_file))
 
 
@@ -13,64 +18,134 @@ def compact_mbtiles(mbtiles_file):
     cur = con.cursor()
     optimize_connection(cur)
 
+    last_rowid = -1
+
     existing_mbtiles_is_compacted = (con.execute("SELECT count(name) FROM sqlite_master WHERE type='table' AND name='images'").fetchone()[0] > 0)
     if existing_mbtiles_is_compacted:
-        logger.info("The mbtiles file is already compacted")
-        return
+        # An interrupted compaction still has the tiles table
+        interrupted = (con.execute("SELECT count(name) FROM sqlite_master WHERE type='table' AND name='tiles'").fetchone()[0] > 0)
+        positions = load_checkpoints(cur, 'compact', '')
+        if not (kwargs.get('resume', False) and interrupted and positions):
+            logger.info("The mbtiles file is already compacted")
+            return
+
+        last_rowid = int(positions[0])
+        logger.info("Resuming after tile %d" % (last_rowid))
+
+
+    image_format = 'png'
+    try:
+        image_format = con.execute("SELECT value FROM metadata WHERE name='format'").fetchone()[0]
+    except:
+        pass
 
 
     overlapping = 0
     unique = 0
     count = 0
-    chunk = 100
-    start_time = time.time()
+    chunk = kwargs.get('batch_size', 1000)
+    cache = open_tile_cache(image_format, **kwargs)
+    process = kwargs.get('command_list') or kwargs.get('transform_list') or kwargs.get('pipe_list')
+    hash_name = kwargs.get('tile_id_hash') or 'md5'
+    if last_rowid >= 0:
+        # The images already compacted keep their hash
+        hash_name = database_tile_id_hash(cur)
+    # With --bbox only the tiles inside it are processed, all are compacted
+    condition, params = tile_range_condition(0, 255, bbox=kwargs.get('bbox')) if process else ("1", [])
     total_tiles = con.execute("SELECT count(zoom_level) FROM tiles").fetchone()[0]
-    max_rowid = con.execute("SELECT max(rowid) FROM tiles").fetchone()[0]
 
 
     logger.debug("%d total tiles" % total_tiles)
 
-    compaction_prepare(cur)
-
-    for i in range((max_rowid / chunk) + 1):
-        cur.execute("""SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles WHERE rowid > ? AND rowid <= ?""",
-            ((i * chunk), ((i + 1) * chunk)))
-
-        rows = cur.fetchall()
-        for r in rows:
-            z = r[0]
-            x = r[1]
-            y = r[2]
-            tile_data = r[3]
-
-            # Execute commands
-            if kwargs.get('command_list'):
-                tile_data = execute_commands_on_tile(kwargs['command_list'], "png", tile_data)
-
-            m = hashlib.md5()
-            m.update(tile_data)
-            tile_id = m.hexdigest()
-
-            try:
-                cur.execute("""INSERT INTO images (tile_id, tile_data) VALUES (?, ?)""",
-                    (tile_id, sqlite3.Binary(tile_data)))
-            except:
-                overlapping = overlapping + 1
-            else:
-                unique = unique + 1
-
-            cur.execute("""REPLACE INTO map (zoom_level, tile_column, tile_row, tile_id) VALUES (?, ?, ?, ?)""",
-                (z, x, y, tile_id))
-
-
-            count = count + 1
-            if (count % 100) == 0:
-                logger.debug("%s tiles finished, %d unique, %d duplicates (%.1f%%, %.1f tiles/sec)" %
-                    (count, unique, overlapping, (float(count) / float(total_tiles)) * 100.0, count / (time.time() - start_time)))
-
-
-    logger.info("%s tiles finished, %d unique, %d duplicates (100.0%%, %.1f tiles/sec)" % (count, unique, overlapping, count / (time.time() - start_time)))
-
+    default_pool_size = kwargs.get('poolsize', -1)
+    if default_pool_size < 1:
+        default_pool_size = None
+
+    # hashlib releases the GIL for large buffers, so threads avoid pickling every tile
+    hash_pool = ThreadPool(default_pool_size)
+    pool = Pool(default_pool_size) if process else None
+
+    compaction_prepare(cur, kwargs.get('layout', 'standard'))
+    optimized = optimized_layout(cur)
+    hash_function = tile_id_hash(hash_name, optimized)
+    if optimized:
+        # The page size of an existing file can't change, auto_vacuum changes with the next VACUUM
+        cur.execute("""PRAGMA auto_vacuum=INCREMENTAL""")
+    else:
+        # Needed now for INSERT OR IGNORE, compaction_finalize keeps it
+        cur.execute("""CREATE UNIQUE INDEX IF NOT EXISTS images_id ON images (tile_id)""")
+
+    # Lets --merge copy the images of databases with the same hash in SQL
+    cur.execute("""REPLACE INTO metadata (name, value) VALUES ('tile_id_hash', ?)""", (hash_name, ))
+
+    checkpoint_prepare(cur)
+
+    metrics = get_metrics(**kwargs)
+    metrics.start('compact', total_tiles, mbtiles_file)
+
+
+    while True:
+        # Keyset pagination, sparse rowids don't cause empty queries
+        start_time = time.time()
+        rows = cur.execute("""SELECT rowid, zoom_level, tile_column, tile_row, tile_data, %s FROM tiles WHERE rowid > ? ORDER BY rowid LIMIT ?""" % (condition),
+            params + [last_rowid, chunk]).fetchall()
+        if len(rows) == 0:
+            break
+        last_rowid = rows[-1][0]
+
+        tiles_data = [str(r[4]) for r in rows]
+        metrics.add('bytes_read', sum([len(tile_data) for tile_data in tiles_data]))
+        start_time = metrics.time('read', start_time)
+
+        # Execute commands
+        if process:
+            selected = [i for i, r in enumerate(rows) if r[5]]
+            processed_data = process_tiles_cached([cache_key(tiles_data[i]) for i in selected] if cache else [None] * len(selected),
+                [tiles_data[i] for i in selected], image_format, pool, cache, **kwargs)
+            for i, tile_data in zip(selected, processed_data):
+                tiles_data[i] = tile_data
+            start_time = metrics.time('transform', start_time)
+
+        tile_ids = hash_pool.map(hash_function, tiles_data)
+        start_time = metrics.time('hash', start_time)
+
+        images = {}
+        for tile_id, tile_data in zip(tile_ids, tiles_data):
+            images[tile_id] = sqlite3.Binary(tile_data)
+
+        cur.executemany("""INSERT OR IGNORE INTO images (tile_id, tile_data) VALUES (?, ?)""",
+            images.items())
+        inserted = cur.rowcount
+        cur.executemany("""REPLACE INTO map (zoom_level, tile_column, tile_row, tile_id) VALUES (?, ?, ?, ?)""",
+            [(r[1], r[2], r[3], tile_id) for r, tile_id in zip(rows, tile_ids)])
+
+        add_checkpoints(cur, 'compact', '', [str(last_rowid)], True)
+        start_time = metrics.time('write', start_time)
+        con.commit()
+        metrics.time('commit', start_time)
+
+        unique = unique + inserted
+        overlapping = overlapping + len(rows) - inserted
+        count = count + len(rows)
+        metrics.add('duplicates', len(rows) - inserted)
+        metrics.tiles(len(rows))
+
+
+    logger.info("%s tiles finished, %d unique, %d duplicates (100.0%%, %.1f tiles/sec)" % (count, unique, overlapping, metrics.snapshot()['tiles_per_sec']))
+
+    hash_pool.close()
+    hash_pool.join()
+    if pool:
+        pool.close()
+        pool.join()
+
+    if cache:
+        cache.close()
+
+    clear_checkpoints(cur, 'compact', '')
+    start_time = time.time()
     compaction_finalize(cur)
     con.commit()
+    metrics.time('commit', start_time)
     con.close()
+    metrics.finish()
@@ -0,0 +1,186 @@
+import sqlite3, uuid, sys, logging, time, os, json, zlib, hashlib, tempfile
+
+from util import mbtiles_connect, optimize_connection, read_tile_id, tile_range_condition
+from util_metrics import get_metrics
+
+logger = logging.getLogger(__name__)
+
+
+def prepare_tile_id_index(cur):
+    # The orphan checks look up the map rows of an image
+    cur.execute("""CREATE INDEX IF NOT EXISTS tile_id_index ON map (tile_id)""")
+
+
+def delete_tiles(con, min_zoom, max_zoom, tile_range=None, batch_size=1000, metrics=None, bbox=None, xyz=False):
+    """Deletes the tiles in the range (see tile_range_condition) and the
+    images no other tile uses, committing every batch_size tiles. Returns
+    the number of deleted tiles and images."""
+    cur = con.cursor()
+    compacted = (cur.execute("SELECT count(name) FROM sqlite_master WHERE type='table' AND name='images'").fetchone()[0] > 0)
+    condition, params = tile_range_condition(min_zoom, max_zoom, tile_range, bbox, xyz)
+
+    if compacted:
+        prepare_tile_id_index(cur)
+        con.commit()
+
+    deleted_tiles = deleted_images = 0
+    while True:
+        start_time = time.time()
+        if compacted:
+            rows = cur.execute("""SELECT zoom_level, tile_column, tile_row, tile_id FROM map WHERE %s LIMIT ?""" % (condition),
+                params + [batch_size]).fetchall()
+        else:
+            rows = cur.execute("""SELECT rowid, NULL FROM tiles WHERE %s LIMIT ?""" % (condition),
+                params + [batch_size]).fetchall()
+        if len(rows) == 0:
+            break
+        if metrics:
+            start_time = metrics.time('read', start_time)
+
+        if compacted:
+            # By primary key, the map of the optimized layout has no rowid
+            cur.executemany("""DELETE FROM map WHERE zoom_level=? AND tile_column=? AND tile_row=?""",
+                [r[:3] for r in rows])
+            # Anti-join over tile_id_index, the images of other tiles stay
+            tile_ids = set([read_tile_id(r[3]) for r in rows])
+            cur.executemany("""DELETE FROM images WHERE tile_id=? AND NOT EXISTS (SELECT 1 FROM map WHERE map.tile_id=?)""",
+                [(tile_id, tile_id) for tile_id in tile_ids])
+            deleted_images = deleted_images + max(cur.rowcount, 0)
+        else:
+            cur.executemany("""DELETE FROM tiles WHERE rowid=?""", [(r[0], ) for r in rows])
+        deleted_tiles = deleted_tiles + len(rows)
+        if metrics:
+            start_time = metrics.time('write', start_time)
+
+        con.commit()
+        if metrics:
+            metrics.time('commit', start_time)
+            metrics.tiles(len(rows))
+
+    return deleted_tiles, deleted_images
+
+
+def collect_orphan_images(con, batch_size=1000, metrics=None):
+    """Deletes the images no tile uses, walking the images table in batches
+    of batch_size rows with one transaction each. Returns the number of
+    deleted images."""
+    cur = con.cursor()
+    prepare_tile_id_index(cur)
+    con.commit()
+
+    deleted_images = 0
+    last_rowid = 0
+    while True:
+        start_time = time.time()
+        next_rowid, images = cur.execute("""SELECT max(rowid), count(*) FROM (SELECT rowid FROM images WHERE rowid > ? ORDER BY rowid LIMIT ?)""",
+            (last_rowid, batch_size)).fetchone()
+        if next_rowid is None:
+            break
+
+        cur.execute("""DELETE FROM images WHERE rowid > ? AND rowid <= ?
+            AND NOT EXISTS (SELECT 1 FROM map WHERE map.tile_id=images.tile_id)""",
+            (last_rowid, next_rowid))
+        deleted_images = deleted_images + cur.rowcount
+        if metrics:
+            start_time = metrics.time('write', start_time)
+
+        con.commit()
+        if metrics:
+            metrics.time('commit', start_time)
+            metrics.tiles(images)
+        last_rowid = next_rowid
+
+    return deleted_images
+
+
+def incremental_vacuum(con, pages=4096):
+    """Returns the free pages to the file system, pages at a time, without
+    rewriting the whole file like VACUUM. Only possible in databases with
+    auto_vacuum=INCREMENTAL."""
+    cur = con.cursor()
+    if cur.execute("""PRAGMA auto_vacuum""").fetchone()[0] != 2:
+        logger.warning("The database doesn't use auto_vacuum=INCREMENTAL, switch it once with: PRAGMA auto_vacuum=INCREMENTAL; VACUUM;")
+        return 0
+
+    freed_pages = 0
+    while True:
+        free_pages = cur.execute("""PRAGMA freelist_count""").fetchone()[0]
+        if free_pages == 0:
+            break
+        cur.execute("""PRAGMA incremental_vacuum(%d)""" % (min(free_pages, pages))).fetchall()
+        con.commit()
+        freed_pages = freed_pages + min(free_pages, pages)
+
+    page_size = cur.execute("""PRAGMA page_size""").fetchone()[0]
+    logger.info("%.1f MB returned to the file system" % (freed_pages * page_size / 1048576.0))
+    return freed_pages
+
+
+def delete_mbtiles(mbtiles_file, **kwargs):
+    logger.info("Deleting tiles from database %s" % (mbtiles_file))
+
+
+    zoom       = kwargs.get('zoom', -1)
+    min_zoom   = kwargs.get('min_zoom', 0)
+    max_zoom   = kwargs.get('max_zoom', 255)
+    tile_range = kwargs.get('tile_range')
+    bbox       = kwargs.get('bbox')
+    batch_size = kwargs.get('batch_size', 1000)
+
+    if zoom >= 0:
+        min_zoom = max_zoom = zoom
+
+
+    con = mbtiles_connect(mbtiles_file)
+    cur = con.cursor()
+    optimize_connection(cur)
+
+    condition, params = tile_range_condition(min_zoom, max_zoom, tile_range, bbox)
+    total_tiles = cur.execute("""SELECT count(*) FROM tiles WHERE %s""" % (condition), params).fetchone()[0]
+
+    metrics = get_metrics(**kwargs)
+    metrics.start('delete', total_tiles, mbtiles_file)
+
+    deleted_tiles, deleted_images = delete_tiles(con, min_zoom, max_zoom, tile_range, batch_size, metrics, bbox)
+    logger.info("%d tiles and %d images no longer used deleted" % (deleted_tiles, deleted_images))
+
+    if kwargs.get('incremental_vacuum', False):
+        start_time = time.time()
+        incremental_vacuum(con)
+        metrics.time('vacuum', start_time)
+
+    con.commit()
+    con.close()
+    metrics.finish()
+
+
+def gc_mbtiles(mbtiles_file, **kwargs):
+    logger.info("Deleting unused images from database %s" % (mbtiles_file))
+
+
+    con = mbtiles_connect(mbtiles_file)
+    cur = con.cursor()
+    optimize_connection(cur)
+
+    existing_mbtiles_is_compacted = (con.execute("SELECT count(name) FROM sqlite_master WHERE type='table' AND name='images'").fetchone()[0] > 0)
+    if not existing_mbtiles_is_compacted:
+        logger.info("The mbtiles file is not compacted, there are no images to delete")
+        con.close()
+        return
+
+    total_images = cur.execute("""SELECT count(*) FROM images""").fetchone()[0]
+
+    metrics = get_metrics(**kwargs)
+    metrics.start('gc', total_images, mbtiles_file)
+
+    deleted_images = collect_orphan_images(con, kwargs.get('batch_size', 1000), metrics)
+    logger.info("%d of %d images no longer used deleted" % (deleted_images, total_images))
+
+    if kwargs.get('incremental_vacuum', False):
+        start_time = time.time()
+        incremental_vacuum(con)
+        metrics.time('vacuum', start_time)
+
+    con.commit()
+    con.close()
+    metrics.finish()
@@ -1,16 +1,102 @@
-import sqlite3, uuid, sys, logging, time, os, json, zlib, hashlib, tempfile
+import sqlite3, uuid, sys, logging, time, os, json, zlib, hashlib, tempfile, threading, Queue, shutil, errno
 
-from util import mbtiles_connect, optimize_connection, optimize_database, execute_commands_on_tile, flip_y
+from util import mbtiles_connect, optimize_connection, optimize_database, execute_commands_on_tile, flip_y, tile_range_condition
+from util_metrics import get_metrics
+from util_delete import delete_tiles
 
 logger = logging.getLogger(__name__)
 
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# ioctl to clone a file's extents on Linux (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+
+def remove_tile(tile_file):
+    """Removes an existing tile file before it is written again, it may
+    share its inode with other tiles of a --link-duplicates export."""
+    try:
+        os.unlink(tile_file)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def link_tile(source_file, tile_file, link_mode):
+    remove_tile(tile_file)
+
+    try:
+        if link_mode == 'reflink':
+            source = open(source_file, 'rb')
+            target = open(tile_file, 'wb')
+            try:
+                fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+            finally:
+                source.close()
+                target.close()
+        else:
+            os.link(source_file, tile_file)
+    except (IOError, OSError, AttributeError, TypeError):
+        shutil.copyfile(source_file, tile_file)
+
+
+def write_tiles(tile_queue, command_list, transform_list, pipe_list, image_format, no_overwrite, link_mode, errors, metrics):
+    """Worker thread: writes the (tile_files, tile_data) pairs from
+    tile_queue to disk until it receives None. With a link_mode, the data
+    is written once and linked to the other files of the list."""
+    while True:
+        next_tile = tile_queue.get()
+        if next_tile is None:
+            return
+
+        tile_files, tile_data = next_tile
+        try:
+            start_time = time.time()
+            if no_overwrite:
+                tile_files = [f for f in tile_files if not os.path.isfile(f)]
+                if len(tile_files) == 0:
+                    continue
+
+            # Execute commands
+            if command_list or transform_list or pipe_list:
+                tile_data = execute_commands_on_tile(command_list, image_format, tile_data, transform_list, pipe_list)
+                start_time = metrics.time('transform', start_time)
+
+            if link_mode is None:
+                for tile_file in tile_files:
+                    remove_tile(tile_file)
+                    f = open(tile_file, 'wb')
+                    f.write(tile_data)
+                    f.close()
+                metrics.add('bytes_written', len(tile_data) * len(tile_files))
+                metrics.time('write', start_time)
+                continue
+
+            source_file = tile_files[0]
+            remove_tile(source_file)
+            f = open(source_file, 'wb')
+            f.write(tile_data)
+            f.close()
+
+            for tile_file in tile_files[1:]:
+                link_tile(source_file, tile_file, link_mode)
+            metrics.add('bytes_written', len(tile_data))
+            metrics.time('write', start_time)
+        except Exception, e:
+            errors.append(e)
+
+
 def mbtiles_to_disk(mbtiles_file, directory_path, **kwargs):
     logger.info("Exporting database to disk: %s --> %s" % (mbtiles_file, directory_path))
 
 
     delete_after_export = kwargs.get('delete_after_export', False)
     no_overwrite        = kwargs.get('no_overwrite', False)
+    link_mode           = kwargs.get('link_duplicates')
 
     zoom     = kwargs.get('zoom', -1)
     min_zoom = kwargs.get('min_zoom', 0)
@@ -19,6 +105,9 @@ def mbtiles_to_disk(mbtiles_file, directory_path, **kwargs):
     if zoom >= 0:
         min_zoom = max_zoom = zoom
 
+    bbox = kwargs.get('bbox')
+    condition, params = tile_range_condition(min_zoom, max_zoom, bbox=bbox)
+
 
     con = mbtiles_connect(mbtiles_file)
     cur = con.cursor()
@@ -26,7 +115,7 @@ def mbtiles_to_disk(mbtiles_file, directory_path, **kwargs):
 
 
     if not os.path.isdir(directory_path):
-        os.mkdir(directory_path)
+        os.makedirs(directory_path)
     base_path = os.path.join(directory_path, "tiles")
     if not os.path.isdir(base_path):
         os.makedirs(base_path)
@@ -36,65 +125,138 @@ def mbtiles_to_disk(mbtiles_file, directory_path, **kwargs):
     json.dump(metadata, open(os.path.join(directory_path, 'metadata.json'), 'w'), indent=4)
 
     count = 0
-    start_time = time.time()
     image_format = metadata.get('format', 'png')
-    total_tiles = con.execute("""SELECT count(zoom_level) FROM tiles WHERE zoom_level>=? AND zoom_level<=?""",
-        (min_zoom, max_zoom)).fetchone()[0]
+    total_tiles = con.execute("""SELECT count(zoom_level) FROM tiles WHERE %s""" % (condition),
+        params).fetchone()[0]
     sending_mbtiles_is_compacted = (con.execute("SELECT count(name) FROM sqlite_master WHERE type='table' AND name='images'").fetchone()[0] > 0)
 
 
-    tiles = cur.execute("""SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles WHERE zoom_level>=? AND zoom_level<=?""",
-        (min_zoom, max_zoom))
-    t = tiles.fetchone()
-    while t:
-        z = t[0]
-        x = t[1]
-        y = t[2]
-        tile_data = t[3]
+    if link_mode and not sending_mbtiles_is_compacted:
+        logger.warning("The mbtiles file is not compacted, exporting without links")
+        link_mode = None
 
-        # Execute commands
-        if kwargs.get('command_list'):
-            tile_data = execute_commands_on_tile(kwargs['command_list'], image_format, tile_data)
+    metrics = get_metrics(**kwargs)
+    metrics.start('export', total_tiles, mbtiles_file)
 
+    workers = kwargs.get('workers', -1)
+    if workers < 1:
+        workers = 4
+
+    tile_queue = Queue.Queue(workers * 64)
+    errors = []
+    threads = []
+    for i in range(workers):
+        thread = threading.Thread(target=write_tiles,
+            args=(tile_queue, kwargs.get('command_list'), kwargs.get('transform_list'), kwargs.get('pipe_list'), image_format, no_overwrite, link_mode, errors, metrics))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    created_dirs = set()
+
+    def tile_path(z, x, y):
         if kwargs.get('flip_y', False) == True:
-          y = flip_y(z, y)
+            y = flip_y(z, y)
 
         tile_dir = os.path.join(base_path, str(z), str(x))
-        if not os.path.isdir(tile_dir):
-            os.makedirs(tile_dir)
+        if tile_dir not in created_dirs:
+            if not os.path.isdir(tile_dir):
+                os.makedirs(tile_dir)
+            created_dirs.add(tile_dir)
 
-        tile_file = os.path.join(tile_dir, '%s.%s' % (y, metadata.get('format', 'png')))
+        return os.path.join(tile_dir, '%s.%s' % (y, image_format))
 
-        if no_overwrite == False or not os.path.isfile(tile_file):
-            f = open(tile_file, 'wb')
-            f.write(tile_data)
-            f.close()
 
+    # export from a compacted database, writing every image only once (--link-duplicates)
+    if link_mode:
+        unique = 0
+        image_cur = con.cursor()
+
+        tiles = cur.execute("""SELECT tile_id, zoom_level, tile_column, tile_row FROM map WHERE %s ORDER BY tile_id""" % (condition),
+            params)
+        current_tile_id = None
+        tile_files = []
+        start_time = time.time()
+        rows = tiles.fetchmany(1000)
+        metrics.time('read', start_time)
+        while rows and not errors:
+            for t in rows:
+                tile_id = t[0]
+
+                # Flush the group on a new image, or every 1000 tiles to bound memory
+                if tile_id != current_tile_id or len(tile_files) >= 1000:
+                    if tile_files:
+                        tile_queue.put((tile_files, tile_data))
+                    if tile_id != current_tile_id:
+                        start_time = time.time()
+                        tile_data = image_cur.execute("""SELECT tile_data FROM images WHERE tile_id=?""",
+                            (tile_id, )).fetchone()[0]
+                        metrics.add('bytes_read', len(tile_data))
+                        metrics.time('read', start_time)
+                        current_tile_id = tile_id
+                        unique = unique + 1
+                    tile_files = []
+                else:
+                    metrics.add('duplicates')
+
+                tile_files.append(tile_path(t[1], t[2], t[3]))
+
+
+                count = count + 1
+                metrics.tiles()
+
+            start_time = time.time()
+            rows = tiles.fetchmany(1000)
+            metrics.time('read', start_time)
+
+        if tile_files:
+            tile_queue.put((tile_files, tile_data))
 
-        count = count + 1
-        if (count % 100) == 0:
-            logger.debug("%s / %s tiles exported (%.1f%%, %.1f tiles/sec)" %
-                (count, total_tiles, (float(count) / float(total_tiles)) * 100.0, count / (time.time() - start_time)))
 
-        t = tiles.fetchone()
+    # export tile by tile
+    else:
+        tiles = cur.execute("""SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles WHERE %s""" % (condition),
+            params)
+        start_time = time.time()
+        rows = tiles.fetchmany(1000)
+        while rows and not errors:
+            for t in rows:
+                metrics.add('bytes_read', len(t[3]))
+            metrics.time('read', start_time)
 
+            for t in rows:
+                tile_queue.put(([tile_path(t[0], t[1], t[2])], t[3]))
 
-    logger.info("%s / %s tiles exported (100.0%%, %.1f tiles/sec)" % (count, total_tiles, count / (time.time() - start_time)))
+
+                count = count + 1
+                metrics.tiles()
+
+            start_time = time.time()
+            rows = tiles.fetchmany(1000)
+
+
+    for thread in threads:
+        tile_queue.put(None)
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        con.close()
+        raise errors[0]
+
+
+    logger.info("%s / %s tiles exported (100.0%%, %.1f tiles/sec)" % (count, total_tiles, metrics.snapshot()['tiles_per_sec']))
 
 
     if delete_after_export:
         logger.debug("WARNING: Removing exported tiles from %s" % (mbtiles_file))
 
-        if sending_mbtiles_is_compacted:
-            cur.execute("""DELETE FROM images WHERE tile_id IN (SELECT tile_id FROM map WHERE zoom_level>=? AND zoom_level<=?)""",
-                (min_zoom, max_zoom))
-            cur.execute("""DELETE FROM map WHERE zoom_level>=? AND zoom_level<=?""", (min_zoom, max_zoom))
-        else:
-            cur.execute("""DELETE FROM tiles WHERE zoom_level>=? AND zoom_level<=?""", (min_zoom, max_zoom))
+        delete_tiles(con, min_zoom, max_zoom, batch_size=kwargs.get('batch_size', 1000), bbox=bbox)
 
         optimize_database(cur, kwargs.get('skip_analyze', False), kwargs.get('skip_vacuum', False))
         con.commit()
 
 
     con.close()
+    metrics.finish()
 
@@ -1,9 +1,133 @@
-import sqlite3, uuid, sys, logging, time, os, json, zlib, hashlib, tempfile
+import sqlite3, uuid, sys, logging, time, os, json, zlib, hashlib, tempfile, threading, Queue
 
-from util import mbtiles_connect, mbtiles_setup, optimize_connection, optimize_database, execute_commands_on_tile, flip_y
+from util import mbtiles_connect, mbtiles_setup, storage_prepare, optimize_connection, optimize_database, execute_commands_on_tile, flip_y, TileWriter, TileIndex, \
+    checkpoint_prepare, load_checkpoints, add_checkpoints, clear_checkpoints
+from util_metrics import get_metrics
 
 logger = logging.getLogger(__name__)
 
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+def list_directory(path):
+    """Returns (name, path, is_dir) for every entry of path, using
+    scandir() when available to avoid a stat() per entry."""
+    if scandir is not None:
+        return [(e.name, e.path, e.is_dir()) for e in scandir(path)]
+
+    entries = []
+    for name in os.listdir(path):
+        entry_path = os.path.join(path, name)
+        entries.append((name, entry_path, os.path.isdir(entry_path)))
+    return entries
+
+
+def scan_tile_directories(directory_path, min_zoom=0, max_zoom=255, skip_directories=()):
+    """Yields (z, x, [(y, path), ...]) for every z/x directory below
+    directory_path/tiles, except the "z/x" names in skip_directories."""
+    base_path = os.path.join(directory_path, "tiles")
+    if not os.path.isdir(base_path):
+        return
+
+    for z_name, z_path, z_is_dir in list_directory(base_path):
+        if not z_is_dir or not z_name.isdigit():
+            continue
+        z = int(z_name)
+        if z < min_zoom or z > max_zoom:
+            continue
+
+        for x_name, x_path, x_is_dir in list_directory(z_path):
+            if not x_is_dir or not x_name.isdigit():
+                continue
+            x = int(x_name)
+            if "%d/%d" % (z, x) in skip_directories:
+                continue
+
+            tiles = []
+            for y_name, y_path, y_is_dir in list_directory(x_path):
+                y_name = y_name.split('.')[0]
+                if y_is_dir or not y_name.isdigit():
+                    continue
+                tiles.append((int(y_name), y_path))
+
+            yield (z, x, tiles)
+
+
+def scan_tile_directory(directory_path, min_zoom=0, max_zoom=255):
+    """Yields (z, x, y, path) for every tile file below directory_path/tiles."""
+    for z, x, tiles in scan_tile_directories(directory_path, min_zoom, max_zoom):
+        for y, tile_file in tiles:
+            yield (z, x, y, tile_file)
+
+
+def read_tiles(input_queue, output_queue, command_list, transform_list, pipe_list, image_format, tile_id_function, metrics):
+    """Worker thread: reads, processes and hashes (with tile_id_function,
+    None for flat databases) the tile files from input_queue until it
+    receives None."""
+    while True:
+        next_tile = input_queue.get()
+        if next_tile is None:
+            output_queue.put(None)
+            return
+
+        z, x, y, tile_file = next_tile
+        try:
+            start_time = time.time()
+            f = open(tile_file, 'rb')
+            tile_data = f.read()
+            f.close()
+            metrics.add('bytes_read', len(tile_data))
+            start_time = metrics.time('read', start_time)
+
+            # Execute commands
+            if command_list or transform_list or pipe_list:
+                tile_data = execute_commands_on_tile(command_list, image_format, tile_data, transform_list, pipe_list)
+                start_time = metrics.time('transform', start_time)
+
+            tile_id = None
+            if tile_id_function:
+                tile_id = tile_id_function(tile_data)
+                metrics.time('hash', start_time)
+        except Exception, e:
+            output_queue.put(e)
+            return
+
+        output_queue.put((z, x, y, tile_data, tile_id))
+
+
+def restore_metadata(con, metadata, import_into_existing_mbtiles):
+    """Restores the metadata of a new database, or checks that the image
+    format matches the existing database. Returns the image format."""
+    image_format = metadata.get('format', 'png')
+
+    # Check that the old and new image formats are the same
+    if import_into_existing_mbtiles:
+        original_format = None
+
+        try:
+            original_format = con.execute("SELECT value FROM metadata WHERE name='format'").fetchone()[0]
+        except:
+            pass
+
+        if original_format != None and image_format != original_format:
+            sys.stderr.write('The files to merge must use the same image format (png or jpg)\n')
+            sys.exit(1)
+
+    if not import_into_existing_mbtiles:
+        for name, value in metadata.items():
+            con.execute('INSERT OR IGNORE INTO metadata (name, value) VALUES (?, ?)',
+                    (name, value))
+        con.commit()
+        logger.info('metadata from metadata.json restored')
+
+    return image_format
+
 
 def disk_to_mbtiles(directory_path, mbtiles_file, **kwargs):
     logger.info("Importing from disk to database: %s --> %s" % (directory_path, mbtiles_file))
@@ -14,6 +138,8 @@ def disk_to_mbtiles(directory_path, mbtiles_file, **kwargs):
 
     no_overwrite = kwargs.get('no_overwrite', False)
     auto_commit  = kwargs.get('auto_commit', False)
+    batch_size   = kwargs.get('batch_size', 1000)
+    resume       = kwargs.get('resume', False)
     zoom     = kwargs.get('zoom', -1)
     min_zoom = kwargs.get('min_zoom', 0)
     max_zoom = kwargs.get('max_zoom', 255)
@@ -24,123 +150,132 @@ def disk_to_mbtiles(directory_path, mbtiles_file, **kwargs):
 
     con = mbtiles_connect(mbtiles_file, auto_commit)
     cur = con.cursor()
+    if not import_into_existing_mbtiles:
+        storage_prepare(cur, kwargs.get('layout', 'standard'), kwargs.get('page_size'))
     optimize_connection(cur, False)
 
 
     if import_into_existing_mbtiles:
         existing_mbtiles_is_compacted = (con.execute("SELECT count(name) FROM sqlite_master WHERE type='table' AND name='images'").fetchone()[0] > 0)
     else:
-        mbtiles_setup(cur)
+        mbtiles_setup(cur, kwargs.get('layout', 'standard'))
 
 
     image_format = 'png'
     try:
         metadata = json.load(open(os.path.join(directory_path, 'metadata.json'), 'r'))
-        image_format = metadata.get('format', 'png')
-
-        # Check that the old and new image formats are the same
-        if import_into_existing_mbtiles:
-            original_format = None
-
-            try:
-                original_format = cur.execute("SELECT value FROM metadata WHERE name='format'").fetchone()[0]
-            except:
-                pass
-
-            if original_format != None and image_format != original_format:
-                sys.stderr.write('The files to merge must use the same image format (png or jpg)\n')
-                sys.exit(1)
-
-        if not import_into_existing_mbtiles:
-            for name, value in metadata.items():
-                cur.execute('INSERT OR IGNORE INTO metadata (name, value) VALUES (?, ?)',
-                        (name, value))
-            con.commit()
-            logger.info('metadata from metadata.json restored')
-
+        image_format = restore_metadata(con, metadata, import_into_existing_mbtiles)
     except IOError:
         logger.warning('metadata.json not found')
 
 
-    existing_tiles = {}
-
+    existing_tiles = None
     if no_overwrite:
-        tiles = cur.execute("""SELECT zoom_level, tile_column, tile_row FROM tiles WHERE zoom_level>=? AND zoom_level<=?""",
-            (min_zoom, max_zoom))
+        con.commit()
+        existing_tiles = TileIndex(mbtiles_file)
 
-        t = tiles.fetchone()
-        while t:
-            z = str(t[0])
-            x = str(t[1])
-            y = str(t[2])
 
-            zoom = existing_tiles.get(z, None)
-            if not zoom:
-                zoom = {}
-                existing_tiles[z] = zoom
+    # Checkpoints are the z/x directories whose tiles are all committed
+    source = os.path.abspath(directory_path)
+    completed_directories = set()
+    if resume:
+        completed_directories = set(load_checkpoints(cur, 'import', source))
+        logger.info("Resuming, skipping %d directories" % (len(completed_directories)))
+    else:
+        clear_checkpoints(cur, 'import', source)
+    checkpoint_prepare(cur)
 
-            row = zoom.get(y, None)
-            if not row:
-                row = set()
-                zoom[y] = row
+    expected_tiles = {}
+    written_tiles = {}
+    finished_directories = []
 
-            row.add(x)
-            t = tiles.fetchone()
+    def save_checkpoints(cur):
+        add_checkpoints(cur, 'import', source, finished_directories)
+        del finished_directories[:]
 
 
     count = 0
-    start_time = time.time()
+    metrics = get_metrics(**kwargs)
+    metrics.start('import', None, directory_path)
+    writer = TileWriter(con, existing_mbtiles_is_compacted, batch_size, metrics)
+    writer.on_flush = save_checkpoints
+
+    workers = kwargs.get('workers', -1)
+    if workers < 1:
+        workers = 4
+
+    input_queue = Queue.Queue(workers * 64)
+    output_queue = Queue.Queue(max(batch_size, workers * 64))
+
+    def scan():
+        for z, x, tiles in scan_tile_directories(directory_path, min_zoom, max_zoom, completed_directories):
+            if no_overwrite:
+                if kwargs.get('flip_y', False) == True:
+                    tiles = [(y, tile_file) for y, tile_file in tiles if not existing_tiles.contains(z, x, flip_y(z, y))]
+                else:
+                    tiles = [(y, tile_file) for y, tile_file in tiles if not existing_tiles.contains(z, x, y)]
+
+            # Nothing will be written, the main thread records it as finished
+            if not tiles:
+                output_queue.put("%d/%d" % (z, x))
+                continue
 
+            # Set before queueing, so the writer can tell when the directory is done
+            expected_tiles["%d/%d" % (z, x)] = len(tiles)
 
-    for r1, zs, ignore in os.walk(os.path.join(directory_path, "tiles")):
-        for z in zs:
-            if int(z) < min_zoom or int(z) > max_zoom:
-                continue
+            for y, tile_file in tiles:
+                input_queue.put((z, x, y, tile_file))
+
+        for i in range(workers):
+            input_queue.put(None)
+
+    threads = [threading.Thread(target=scan)]
+    for i in range(workers):
+        threads.append(threading.Thread(target=read_tiles,
+            args=(input_queue, output_queue, kwargs.get('command_list'), kwargs.get('transform_list'), kwargs.get('pipe_list'), image_format, writer.tile_id_function if existing_mbtiles_is_compacted else None, metrics)))
 
-            for r2, xs, ignore in os.walk(os.path.join(r1, z)):
-                for x in xs:
-                    for r2, ignore, ys in os.walk(os.path.join(r1, z, x)):
-                        for y in ys:
-                            y, extension = y.split('.')
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
 
-                            if no_overwrite:
-                                if x in existing_tiles.get(z, {}).get(y, set()):
-                                    logging.debug("Ignoring tile (%s, %s, %s)" % (z, x, y))
-                                    continue
 
-                            if kwargs.get('flip_y', False) == True:
-                                y = flip_y(z, y)
+    finished_workers = 0
+    while finished_workers < workers:
+        t = output_queue.get()
+        if t is None:
+            finished_workers = finished_workers + 1
+            continue
+        if isinstance(t, Exception):
+            raise t
+        if isinstance(t, str):
+            finished_directories.append(t)
+            continue
 
-                            f = open(os.path.join(r1, z, x, y) + '.' + extension, 'rb')
-                            tile_data = f.read()
-                            f.close()
+        z, x, y, tile_data, tile_id = t
 
-                            # Execute commands
-                            if kwargs.get('command_list'):
-                                tile_data = execute_commands_on_tile(kwargs['command_list'], image_format, tile_data)
+        if kwargs.get('flip_y', False) == True:
+            y = flip_y(z, y)
 
-                            if existing_mbtiles_is_compacted:
-                                m = hashlib.md5()
-                                m.update(tile_data)
-                                tile_id = m.hexdigest()
+        writer.add(z, x, y, tile_data, tile_id)
 
-                                cur.execute("""INSERT OR IGNORE INTO images (tile_id, tile_data) VALUES (?, ?)""",
-                                    (tile_id, sqlite3.Binary(tile_data)))
+        directory = "%d/%d" % (z, x)
+        written_tiles[directory] = written_tiles.get(directory, 0) + 1
+        if written_tiles[directory] == expected_tiles.get(directory):
+            finished_directories.append(directory)
+            del written_tiles[directory]
 
-                                cur.execute("""REPLACE INTO map (zoom_level, tile_column, tile_row, tile_id) VALUES (?, ?, ?, ?)""",
-                                    (z, x, y, tile_id))
-                            else:
-                                cur.execute("""REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?)""",
-                                    (z, x, y.split('.')[0], sqlite3.Binary(tile_data)))
+        count = count + 1
+        metrics.tiles()
 
 
-                            count = count + 1
-                            if (count % 100) == 0:
-                                logger.debug("%s tiles imported (%d tiles/sec)" %
-                                    (count, count / (time.time() - start_time)))
+    writer.close()
+    clear_checkpoints(cur, 'import', source)
 
+    if existing_tiles:
+        existing_tiles.close()
 
     logger.info("%d tiles imported." % (count))
 
     con.commit()
     con.close()
+    metrics.finish()
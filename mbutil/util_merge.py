@@ -1,12 +1,61 @@
 import sqlite3, uuid, sys, logging, time, os, json, zlib, hashlib, tempfile, multiprocessing
 
-from util import mbtiles_connect, mbtiles_setup, optimize_connection, optimize_database, execute_commands_on_tile, process_tile, flip_y
+from util import mbtiles_connect, mbtiles_setup, optimize_connection, optimize_database, execute_commands_on_tile, process_tile, flip_y, tile_range_condition, TileWriter, TileIndex, \
+    tile_id_hash, database_tile_id_hash, optimized_layout, read_tile_id, map_key, encode_map_position, decode_map_position, checkpoint_prepare, load_checkpoints, add_checkpoints, clear_checkpoints
 from util_check import check_mbtiles
+from util_cache import open_tile_cache, process_tiles_cached, cache_key
+from util_metrics import get_metrics
+from util_delete import delete_tiles
 from multiprocessing import Pool
 
 logger = logging.getLogger(__name__)
 
 
+def same_tile_ids(cur1, cur2, trust_tile_ids=False):
+    """Returns True if the images of two compacted databases can be merged
+    by tile_id: both record the same hash of their tile_ids, or the user
+    trusts them with trust_tile_ids, and they use the same layout."""
+    if optimized_layout(cur1) != optimized_layout(cur2):
+        return False
+    if trust_tile_ids:
+        return True
+    hash_name = database_tile_id_hash(cur1, None)
+    return hash_name is not None and hash_name == database_tile_id_hash(cur2, None)
+
+
+def merge_mbtiles_sql(cur1, mbtiles_file2, min_zoom, max_zoom, no_overwrite, bbox=None):
+    """Merges the compacted mbtiles_file2 into the database of cur1 inside
+    SQLite, without copying any tile through python. Returns the number of
+    merged tiles."""
+    con1 = cur1.connection
+    cur1.execute("""ATTACH DATABASE ? AS source""", (mbtiles_file2, ))
+
+    condition, params = tile_range_condition(min_zoom, max_zoom, bbox=bbox)
+    sending_tiles = """SELECT s.zoom_level, s.tile_column, s.tile_row, s.tile_id FROM source.map s
+        WHERE %s""" % (condition)
+    if no_overwrite:
+        sending_tiles += """ AND NOT EXISTS (SELECT 1 FROM main.map m
+            WHERE m.zoom_level=s.zoom_level AND m.tile_column=s.tile_column AND m.tile_row=s.tile_row)"""
+
+    if con1.isolation_level is None:
+        cur1.execute("""BEGIN""")
+
+    cur1.execute("""INSERT OR IGNORE INTO images (tile_id, tile_data)
+        SELECT tile_id, tile_data FROM source.images WHERE tile_id IN (SELECT tile_id FROM (%s))""" % (sending_tiles),
+        params)
+    cur1.execute("""REPLACE INTO map (zoom_level, tile_column, tile_row, tile_id) %s""" % (sending_tiles),
+        params)
+    count = cur1.rowcount
+
+    if con1.isolation_level is None:
+        cur1.execute("""COMMIT""")
+    else:
+        con1.commit()
+
+    cur1.execute("""DETACH DATABASE source""")
+    return count
+
+
 def merge_mbtiles(mbtiles_file1, mbtiles_file2, **kwargs):
     logger.info("Merging databases: %s --> %s" % (mbtiles_file2, mbtiles_file1))
 
@@ -21,6 +70,10 @@ def merge_mbtiles(mbtiles_file1, mbtiles_file2, **kwargs):
     if zoom >= 0:
         min_zoom = max_zoom = zoom
 
+    # The sending database has XYZ rows with --flip-y
+    bbox = kwargs.get('bbox')
+    condition, params = tile_range_condition(min_zoom, max_zoom, bbox=bbox, xyz=kwargs.get('flip_y', False))
+
     check_before_merge = kwargs.get('check_before_merge', False)
     if check_before_merge and not check_mbtiles(mbtiles_file2, **kwargs):
         sys.stderr.write("The pre-merge check on %s failed\n" % (mbtiles_file2))
@@ -62,45 +115,73 @@ def merge_mbtiles(mbtiles_file1, mbtiles_file2, **kwargs):
         con1.commit()
 
 
-    existing_tiles = {}
+    # Without any processing, compacted databases with the same kind of
+    # tile_ids can be merged inside SQLite
+    tile_id_function = tile_id_hash(database_tile_id_hash(cur1), optimized_layout(cur1))
+    sql_merge = (kwargs.get('sql_merge', True) and sending_mbtiles_is_compacted
+        and not kwargs.get('flip_y', False)
+        and not kwargs.get('command_list') and not kwargs.get('transform_list') and not kwargs.get('pipe_list')
+        and same_tile_ids(cur1, cur2, kwargs.get('trust_tile_ids', False)))
 
-    if no_overwrite:
-        tiles = cur1.execute("""SELECT zoom_level, tile_column, tile_row FROM tiles WHERE zoom_level>=? AND zoom_level<=?""",
-            (min_zoom, max_zoom))
 
-        t = tiles.fetchone()
-        while t:
-            z = t[0]
-            x = t[1]
-            y = t[2]
+    existing_tiles = None
+    if no_overwrite and not sql_merge:
+        con1.commit()
+        existing_tiles = TileIndex(mbtiles_file1)
 
-            zoom = existing_tiles.get(z, None)
-            if not zoom:
-                zoom = {}
-                existing_tiles[z] = zoom
 
-            row = zoom.get(y, None)
-            if not row:
-                row = set()
-                zoom[y] = row
+    count = 0
+    chunk = 100
+    cache = open_tile_cache(new_format, **kwargs)
+
+    total_tiles = (con2.execute("""SELECT count(*) FROM tiles WHERE %s""" % (condition),
+        params).fetchone()[0])
 
-            row.add(x)
+    logger.debug("%d tiles to merge" % (total_tiles))
 
-            t = tiles.fetchone()
+    metrics = get_metrics(**kwargs)
+    metrics.start('merge', total_tiles, mbtiles_file2)
+
+
+    # The checkpoint is the last rowid (map_key for compacted databases) of
+    # the sending database which is committed
+    source = os.path.abspath(mbtiles_file2)
+    key_columns = map_key(cur2) if sending_mbtiles_is_compacted else ['rowid']
+    columns = ', '.join(key_columns)
+    key = "(%s)" % (columns)
+    key_value = "(%s)" % (', '.join(['?'] * len(key_columns)))
+    position = decode_map_position(None, key_columns)
+    positions = load_checkpoints(cur1, 'merge', source) if kwargs.get('resume', False) else []
+    if positions:
+        position = decode_map_position(positions[0], key_columns)
+        logger.info("Resuming after tile %s" % (positions[0]))
+    else:
+        clear_checkpoints(cur1, 'merge', source)
+    checkpoint_prepare(cur1)
 
+    def save_checkpoint(position):
+        start_time = time.time()
+        add_checkpoints(cur1, 'merge', source, [encode_map_position(position)], True)
+        con1.commit()
+        return metrics.time('commit', start_time)
 
-    count = 0
-    start_time = time.time()
-    chunk = 100
 
-    total_tiles = (con2.execute("""SELECT count(*) FROM tiles WHERE zoom_level>=? AND zoom_level<=?""",
-        (min_zoom, max_zoom)).fetchone()[0])
+    # merge two compacted databases in SQL (--merge)
+    if sql_merge:
+        # con2 holds an exclusive lock which would keep con1 from attaching the file
+        con2.close()
+        start_time = time.time()
+        count = merge_mbtiles_sql(cur1, mbtiles_file2, min_zoom, max_zoom, no_overwrite, bbox)
+        metrics.time('write', start_time)
+        metrics.tiles(count)
 
-    logger.debug("%d tiles to merge" % (total_tiles))
+        con2 = mbtiles_connect(mbtiles_file2)
+        cur2 = con2.cursor()
+        optimize_connection(cur2)
 
 
     # merge and process (--merge --execute)
-    if sending_mbtiles_is_compacted and kwargs['command_list']:
+    elif sending_mbtiles_is_compacted and (kwargs.get('command_list') or kwargs.get('transform_list') or kwargs.get('pipe_list')):
         default_pool_size = kwargs.get('poolsize', -1)
         if default_pool_size < 1:
             default_pool_size = None
@@ -113,44 +194,62 @@ def merge_mbtiles(mbtiles_file1, mbtiles_file2, **kwargs):
 
 
         tiles_to_process = []
+        cached_tiles = []
         known_tile_ids = {}
-        max_rowid = (con2.execute("SELECT max(rowid) FROM map").fetchone()[0])
+        chunks = 0
 
 
         # First: Merge images
-        for i in range((max_rowid / chunk) + 1):
-            cur2.execute("""SELECT map.zoom_level, map.tile_column, map.tile_row, images.tile_id, images.tile_data FROM images, map WHERE (map.rowid > ? AND map.rowid <= ?) AND (map.zoom_level>=? AND map.zoom_level<=?) AND (images.tile_id == map.tile_id)""",
-                ((i * chunk), ((i + 1) * chunk), min_zoom, max_zoom))
+        while True:
+            start_time = time.time()
+            # The chunk's keys come from map alone, so images are only read for them
+            cur2.execute("""SELECT map.zoom_level, map.tile_column, map.tile_row, images.tile_id, images.tile_data, %s FROM images, map
+                WHERE %s IN (SELECT %s FROM map WHERE %s > %s AND (%s) ORDER BY %s LIMIT ?) AND (images.tile_id == map.tile_id) ORDER BY %s""" % (columns, key, columns, key, key_value, condition, columns, columns),
+                position + params + [chunk])
 
             rows = cur2.fetchall()
+            if len(rows) == 0:
+                break
+            position = list(rows[-1][5:])
+            chunks = chunks + 1
+            metrics.add('bytes_read', sum([len(t[4]) for t in rows]))
+            start_time = metrics.time('read', start_time)
             for t in rows:
                 z = t[0]
                 x = t[1]
                 y = t[2]
-                tile_id = t[3]
+                tile_id = read_tile_id(t[3])
                 tile_data = t[4]
 
                 if kwargs.get('flip_y', False) == True:
                     y = flip_y(z, y)
 
                 if no_overwrite:
-                    if x in existing_tiles.get(z, {}).get(y, set()):
+                    if existing_tiles.contains(z, x, y):
                         logging.debug("Ignoring tile (%d, %d, %d)" % (z, x, y))
                         continue
 
 
                 new_tile_id = known_tile_ids.get(tile_id)
-                if new_tile_id is None:
-                    tmp_file_fd, tmp_file_name = tempfile.mkstemp(suffix=".%s" % (new_format), prefix="tile_")
-                    tmp_file = os.fdopen(tmp_file_fd, "w")
-                    tmp_file.write(tile_data)
-                    tmp_file.close()
-
+                data_key = cache_key(str(tile_data)) if (cache and new_tile_id is None) else None
+                cached_tile_data = cache.get(data_key) if data_key else None
+                if cached_tile_data is not None:
+                    cached_tiles.append({
+                        'tile_id':tile_id,
+                        'tile_data':cached_tile_data,
+                        'x':x,
+                        'y':y,
+                        'z':z
+                    })
+                elif new_tile_id is None:
                     tiles_to_process.append({
                         'tile_id':tile_id,
-                        'filename':tmp_file_name,
+                        'cache_key':data_key,
+                        'tile_data':str(tile_data),
                         'format':new_format,
-                        'command_list':kwargs['command_list'],
+                        'command_list':kwargs.get('command_list'),
+                        'transform_list':kwargs.get('transform_list'),
+                        'pipe_list':kwargs.get('pipe_list'),
                         'x':x,
                         'y':y,
                         'z':z
@@ -158,96 +257,111 @@ def merge_mbtiles(mbtiles_file1, mbtiles_file2, **kwargs):
                 else:
                     cur1.execute("""REPLACE INTO map (zoom_level, tile_column, tile_row, tile_id) VALUES (?, ?, ?, ?)""",
                         (z, x, y, new_tile_id))
+                    metrics.add('duplicates')
 
                     count = count + 1
-                    if (count % 100) == 0:
-                        logger.debug("%s tiles merged (%.1f%% %.1f tiles/sec)" % (count, (float(count) / float(total_tiles)) * 100.0, count / (time.time() - start_time)))
+                    metrics.tiles()
+
 
+            start_time = metrics.time('write', start_time)
 
-            if len(tiles_to_process) == 0:
+            if len(tiles_to_process) == 0 and len(cached_tiles) == 0:
                 continue
 
             # Execute commands
             processed_tiles = pool.map(process_tile, tiles_to_process)
+            start_time = metrics.time('transform', start_time)
 
+            if cache:
+                for next_tile in processed_tiles:
+                    cache.put(next_tile['cache_key'], next_tile['tile_data'])
 
-            for next_tile in processed_tiles:
-                tile_id, tile_file_path, x, y, z = next_tile['tile_id'], next_tile['filename'], next_tile['x'], next_tile['y'], next_tile['z']
+            processed_tiles.extend(cached_tiles)
 
-                tmp_file = open(tile_file_path, "r")
-                tile_data = tmp_file.read()
-                tmp_file.close()
 
-                os.remove(tile_file_path)
+            for next_tile in processed_tiles:
+                tile_id, tile_data, x, y, z = next_tile['tile_id'], next_tile['tile_data'], next_tile['x'], next_tile['y'], next_tile['z']
 
                 if tile_data and len(tile_data) > 0:
-                    m = hashlib.md5()
-                    m.update(tile_data)
-                    new_tile_id = m.hexdigest()
+                    new_tile_id = tile_id_function(tile_data)
                     known_tile_ids[tile_id] = new_tile_id
+                    start_time = metrics.time('hash', start_time)
 
                     cur1.execute("""REPLACE INTO images (tile_id, tile_data) VALUES (?, ?)""",
                         (new_tile_id, sqlite3.Binary(tile_data)))
 
                     cur1.execute("""REPLACE INTO map (zoom_level, tile_column, tile_row, tile_id) VALUES (?, ?, ?, ?)""",
                         (z, x, y, new_tile_id))
+                    metrics.add('bytes_written', len(tile_data))
+                    start_time = metrics.time('write', start_time)
 
                 count = count + 1
-                if (count % 100) == 0:
-                    logger.debug("%s tiles merged (%.1f%% %.1f tiles/sec)" % (count, (float(count) / float(total_tiles)) * 100.0, count / (time.time() - start_time)))
+                metrics.tiles()
 
 
             tiles_to_process = []
+            cached_tiles = []
             processed_tiles = []
 
+            if chunks % 10 == 0:
+                save_checkpoint(position)
+
+        pool.close()
+        pool.join()
+
 
     # merge from a compacted database (--merge)
     elif sending_mbtiles_is_compacted:
         known_tile_ids = {}
 
         # First: Merge images
-        tiles = cur2.execute("""SELECT map.zoom_level, map.tile_column, map.tile_row, images.tile_id, images.tile_data FROM images, map WHERE map.zoom_level>=? AND map.zoom_level<=? AND images.tile_id=map.tile_id""",
-            (min_zoom, max_zoom))
+        start_time = time.time()
+        tiles = cur2.execute("""SELECT map.zoom_level, map.tile_column, map.tile_row, images.tile_id, images.tile_data, %s FROM images, map WHERE (%s) AND images.tile_id=map.tile_id AND %s > %s ORDER BY %s""" % (columns, condition, key, key_value, columns),
+            params + position)
 
         t = tiles.fetchone()
         while t:
+            metrics.add('bytes_read', len(t[4]))
+            start_time = metrics.time('read', start_time)
+
             z = t[0]
             x = t[1]
             y = t[2]
-            tile_id = t[3]
+            tile_id = read_tile_id(t[3])
             tile_data = t[4]
 
             if kwargs.get('flip_y', False) == True:
                 y = flip_y(z, y)
 
             if no_overwrite:
-                if x in existing_tiles.get(z, {}).get(y, set()):
+                if existing_tiles.contains(z, x, y):
                     logging.debug("Ignoring tile (%d, %d, %d)" % (z, x, y))
                     t = tiles.fetchone()
                     continue
 
 
+            # Processing merges use the pool above
             new_tile_id = known_tile_ids.get(tile_id)
             if new_tile_id is None:
-                # Execute commands
-                if kwargs.get('command_list'):
-                    tile_data = execute_commands_on_tile(kwargs['command_list'], new_format, tile_data)
-
-                m = hashlib.md5()
-                m.update(tile_data)
-                new_tile_id = m.hexdigest()
+                new_tile_id = tile_id_function(tile_data)
                 known_tile_ids[tile_id] = new_tile_id
+                start_time = metrics.time('hash', start_time)
 
                 cur1.execute("""REPLACE INTO images (tile_id, tile_data) VALUES (?, ?)""",
                     (new_tile_id, sqlite3.Binary(tile_data)))
+                metrics.add('bytes_written', len(tile_data))
+            else:
+                metrics.add('duplicates')
 
 
             cur1.execute("""REPLACE INTO map (zoom_level, tile_column, tile_row, tile_id) VALUES (?, ?, ?, ?)""",
                 (z, x, y, new_tile_id))
+            start_time = metrics.time('write', start_time)
 
             count = count + 1
-            if (count % 100) == 0:
-                logger.debug("%s tiles merged (%.1f%% %.1f tiles/sec)" % (count, (float(count) / float(total_tiles)) * 100.0, count / (time.time() - start_time)))
+            metrics.tiles()
+            if (count % 1000) == 0:
+                start_time = save_checkpoint(t[5:])
 
             t = tiles.fetchone()
 
@@ -255,70 +369,371 @@ def merge_mbtiles(mbtiles_file1, mbtiles_file2, **kwargs):
     # merge an uncompacted database (--merge)
     else:
         known_tile_ids = set()
+        process = kwargs.get('command_list') or kwargs.get('transform_list') or kwargs.get('pipe_list')
+        pool = None
+        if process:
+            default_pool_size = kwargs.get('poolsize', -1)
+            pool = Pool(default_pool_size if default_pool_size >= 1 else None)
+
+        start_time = time.time()
+        tiles = cur2.execute("""SELECT zoom_level, tile_column, tile_row, tile_data, rowid FROM tiles WHERE (%s) AND rowid>? ORDER BY rowid""" % (condition),
+            params + position)
+
+        # Chunks of 1000 tiles, processed by the pool and committed with their checkpoint
+        rows = tiles.fetchmany(1000)
+        while rows:
+            metrics.add('bytes_read', sum([len(t[3]) for t in rows]))
+            start_time = metrics.time('read', start_time)
+
+            merged_tiles = []
+            for t in rows:
+                z, x, y = t[0], t[1], t[2]
 
-        tiles = cur2.execute("""SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles WHERE zoom_level>=? AND zoom_level<=?""",
-            (min_zoom, max_zoom))
-
-        t = tiles.fetchone()
-        while t:
-            z = t[0]
-            x = t[1]
-            y = t[2]
-            tile_data = t[3]
+                if no_overwrite:
+                    if existing_tiles.contains(z, x, y):
+                        logging.debug("Ignoring tile (%d, %d, %d)" % (z, x, y))
+                        continue
 
-            if no_overwrite:
-                if x in existing_tiles.get(z, {}).get(y, set()):
-                    logging.debug("Ignoring tile (%d, %d, %d)" % (z, x, y))
-                    t = tiles.fetchone()
-                    continue
+                if kwargs.get('flip_y', False) == True:
+                    y = flip_y(z, y)
 
-            if kwargs.get('flip_y', False) == True:
-                y = flip_y(z, y)
+                merged_tiles.append((z, x, y, str(t[3])))
 
+            tiles_data = [t[3] for t in merged_tiles]
 
             # Execute commands
-            if kwargs.get('command_list'):
-                tile_data = execute_commands_on_tile(kwargs['command_list'], new_format, tile_data)
+            if process:
+                tiles_data = process_tiles_cached([cache_key(tile_data) for tile_data in tiles_data] if cache else [None] * len(tiles_data),
+                    tiles_data, new_format, pool, cache, **kwargs)
+                start_time = metrics.time('transform', start_time)
 
-            m = hashlib.md5()
-            m.update(tile_data)
-            tile_id = m.hexdigest()
+            for (z, x, y, old_tile_data), tile_data in zip(merged_tiles, tiles_data):
+                tile_id = tile_id_function(tile_data)
 
-            if tile_id not in known_tile_ids:
-                cur1.execute("""REPLACE INTO images (tile_id, tile_data) VALUES (?, ?)""",
-                    (tile_id, sqlite3.Binary(tile_data)))
+                if tile_id not in known_tile_ids:
+                    cur1.execute("""REPLACE INTO images (tile_id, tile_data) VALUES (?, ?)""",
+                        (tile_id, sqlite3.Binary(tile_data)))
+                    metrics.add('bytes_written', len(tile_data))
+                else:
+                    metrics.add('duplicates')
 
-            cur1.execute("""REPLACE INTO map (zoom_level, tile_column, tile_row, tile_id) VALUES (?, ?, ?, ?)""",
-                (z, x, y, tile_id))
+                cur1.execute("""REPLACE INTO map (zoom_level, tile_column, tile_row, tile_id) VALUES (?, ?, ?, ?)""",
+                    (z, x, y, tile_id))
 
-            known_tile_ids.add(tile_id)
+                known_tile_ids.add(tile_id)
 
-            count = count + 1
-            if (count % 100) == 0:
-                logger.debug("%s tiles merged (%.1f%%, %.1f tiles/sec)" % (count, (float(count) / float(total_tiles)) * 100.0, count / (time.time() - start_time)))
+                count = count + 1
+                metrics.tiles()
+            start_time = metrics.time('write', start_time)
 
-            t = tiles.fetchone()
+            start_time = save_checkpoint(rows[-1][4:])
+            rows = tiles.fetchmany(1000)
+
+        if pool:
+            pool.close()
+            pool.join()
+
+
+    logger.info("%s tiles merged (100.0%%, %.1f tiles/sec)" % (count, metrics.snapshot()['tiles_per_sec']))
+
+    clear_checkpoints(cur1, 'merge', source)
 
+    if cache:
+        cache.close()
 
-    logger.info("%s tiles merged (100.0%%, %.1f tiles/sec)" % (count, count / (time.time() - start_time)))
+    if existing_tiles:
+        existing_tiles.close()
 
 
     if delete_after_export:
         logger.debug("WARNING: Removing merged tiles from %s" % (mbtiles_file2))
 
-        if sending_mbtiles_is_compacted:
-            cur2.execute("""DELETE FROM images WHERE tile_id IN (SELECT tile_id FROM map WHERE zoom_level>=? AND zoom_level<=?)""",
-                (min_zoom, max_zoom))
-            cur2.execute("""DELETE FROM map WHERE zoom_level>=? AND zoom_level<=?""",
-                (min_zoom, max_zoom))
-        else:
-            cur2.execute("""DELETE FROM tiles WHERE zoom_level>=? AND zoom_level<=?""",
-                (min_zoom, max_zoom))
+        delete_tiles(con2, min_zoom, max_zoom, batch_size=kwargs.get('batch_size', 1000), bbox=bbox, xyz=kwargs.get('flip_y', False))
 
         optimize_database(cur2, kwargs.get('skip_analyze', False), kwargs.get('skip_vacuum', False))
         con2.commit()
 
 
+    start_time = time.time()
     con1.commit()
+    metrics.time('commit', start_time)
+
     con1.close()
     con2.close()
+    metrics.finish()
+
+
+def read_mbtiles(mbtiles_file, tile_queue, options):
+    """Reader process for merge_mbtiles_many: puts chunks of
+    (z, x, y, tile_id, tile_data) of mbtiles_file into tile_queue, with
+    tile_data None for images already sent, followed by None."""
+    try:
+        con = mbtiles_connect(mbtiles_file)
+        cur = con.cursor()
+        # read_tile reads skipped images again while this process reads
+        optimize_connection(cur, False)
+
+        image_format = options['format']
+        condition, params = tile_range_condition(options['min_zoom'], options['max_zoom'], bbox=options['bbox'], xyz=options['flip_y'])
+        command_list, transform_list, pipe_list = options['command_list'], options['transform_list'], options['pipe_list']
+        process = command_list or transform_list or pipe_list
+        tile_id_function = tile_id_hash(options['tile_id_hash'], options['binary_tile_ids'])
+
+        compacted = (con.execute("SELECT count(name) FROM sqlite_master WHERE type='table' AND name='images'").fetchone()[0] > 0)
+        if compacted:
+            tiles = cur.execute("""SELECT zoom_level, tile_column, tile_row, tile_id FROM map WHERE %s""" % (condition),
+                params)
+        else:
+            tiles = cur.execute("""SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles WHERE %s""" % (condition),
+                params)
+
+        known_tile_ids = {}
+        image_cur = con.cursor()
+
+        rows = tiles.fetchmany(1000)
+        while rows:
+            chunk = []
+            for t in rows:
+                z, x, y = t[0], t[1], t[2]
+                if options['flip_y']:
+                    y = flip_y(z, y)
+
+                tile_data = None
+                if compacted:
+                    tile_id = read_tile_id(t[3])
+                    new_tile_id = known_tile_ids.get(tile_id)
+                    if new_tile_id is None:
+                        tile_data = image_cur.execute("""SELECT tile_data FROM images WHERE tile_id=?""", (t[3], )).fetchone()[0]
+                else:
+                    new_tile_id = None
+                    tile_data = t[3]
+
+                if tile_data is not None:
+                    if process:
+                        tile_data = execute_commands_on_tile(command_list, image_format, tile_data, transform_list, pipe_list)
+                    tile_data = str(tile_data)
+
+                    new_tile_id = tile_id_function(tile_data)
+
+                    if compacted:
+                        known_tile_ids[tile_id] = new_tile_id
+                    elif new_tile_id in known_tile_ids:
+                        tile_data = None
+                    else:
+                        known_tile_ids[new_tile_id] = new_tile_id
+
+                chunk.append((z, x, y, new_tile_id, tile_data))
+
+            tile_queue.put(chunk)
+            rows = tiles.fetchmany(1000)
+
+        con.close()
+        tile_queue.put(None)
+    except Exception, e:
+        tile_queue.put(str(e))
+
+
+def read_tile(con, z, x, y, options):
+    """Returns the image of tile (z, x, y) of the receiving database read
+    again from the sending database of con, processed like read_mbtiles."""
+    if options['flip_y']:
+        y = flip_y(z, y)
+    tile_data = str(con.execute("""SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?""",
+        (z, x, y)).fetchone()[0])
+    if options['command_list'] or options['transform_list'] or options['pipe_list']:
+        tile_data = execute_commands_on_tile(options['command_list'], options['format'], tile_data, options['transform_list'], options['pipe_list'])
+    return tile_data
+
+
+def merge_mbtiles_many(mbtiles_file1, mbtiles_files, **kwargs):
+    """Merges all mbtiles_files into mbtiles_file1, the later files
+    overwriting the earlier ones like consecutive merge_mbtiles calls.
+    Up to poolsize files are read, processed and hashed in parallel
+    processes while the calling process writes them in order."""
+    logger.info("Merging %d databases into %s" % (len(mbtiles_files), mbtiles_file1))
+
+    # These work on each sending database on its own
+    if kwargs.get('delete_after_export') or kwargs.get('cache_file') or kwargs.get('resume') or len(mbtiles_files) < 2:
+        for mbtiles_file2 in mbtiles_files:
+            merge_mbtiles(mbtiles_file1, mbtiles_file2, **kwargs)
+        return
+
+
+    zoom     = kwargs.get('zoom', -1)
+    min_zoom = kwargs.get('min_zoom', 0)
+    max_zoom = kwargs.get('max_zoom', 255)
+    no_overwrite = kwargs.get('no_overwrite', False)
+    auto_commit  = kwargs.get('auto_commit', False)
+    process = kwargs.get('command_list') or kwargs.get('transform_list') or kwargs.get('pipe_list')
+
+    if zoom >= 0:
+        min_zoom = max_zoom = zoom
+
+    pool_size = kwargs.get('poolsize', -1)
+    if pool_size < 1:
+        pool_size = multiprocessing.cpu_count()
+
+
+    con1 = mbtiles_connect(mbtiles_file1, auto_commit)
+    cur1 = con1.cursor()
+    optimize_connection(cur1, False)
+
+    receiving_mbtiles_is_compacted = (con1.execute("SELECT count(name) FROM sqlite_master WHERE type='table' AND name='images'").fetchone()[0] > 0)
+    if not receiving_mbtiles_is_compacted:
+        con1.close()
+        sys.stderr.write('To merge two mbtiles databases, the receiver must already be compacted\n')
+        sys.exit(1)
+
+
+    # Check the sending databases and their image formats up front
+    binary_tile_ids = optimized_layout(cur1)
+    hash_name = database_tile_id_hash(cur1)
+    image_format = None
+    try:
+        image_format = con1.execute("SELECT value FROM metadata WHERE name='format'").fetchone()[0]
+    except:
+        pass
+
+    sql_mergeable = set()
+    for mbtiles_file2 in mbtiles_files:
+        if kwargs.get('check_before_merge', False) and not check_mbtiles(mbtiles_file2, **kwargs):
+            sys.stderr.write("The pre-merge check on %s failed\n" % (mbtiles_file2))
+            sys.exit(1)
+
+        con2 = mbtiles_connect(mbtiles_file2)
+        new_format = None
+        try:
+            new_format = con2.execute("SELECT value FROM metadata WHERE name='format'").fetchone()[0]
+        except:
+            pass
+
+        if image_format != None and new_format != None and new_format != image_format:
+            sys.stderr.write('The files to merge must use the same image format (png or jpg)\n')
+            sys.exit(1)
+
+        if image_format == None and new_format != None:
+            image_format = new_format
+            con1.execute("""insert or ignore into metadata (name, value) values ("format", ?)""", [new_format])
+            con1.commit()
+
+        # Without --no-overwrite the readers don't need to see the tiles, so SQL is faster
+        if (kwargs.get('sql_merge', True) and not no_overwrite and not process and not kwargs.get('flip_y', False)
+                and con2.execute("SELECT count(name) FROM sqlite_master WHERE type='table' AND name='images'").fetchone()[0] > 0
+                and same_tile_ids(cur1, con2.cursor(), kwargs.get('trust_tile_ids', False))):
+            sql_mergeable.add(mbtiles_file2)
+        con2.close()
+
+
+    existing_tiles = None
+    if no_overwrite:
+        con1.commit()
+        existing_tiles = TileIndex(mbtiles_file1)
+
+
+    options = {
+        'format' : image_format or 'png',
+        'min_zoom' : min_zoom,
+        'max_zoom' : max_zoom,
+        'bbox' : kwargs.get('bbox'),
+        'flip_y' : kwargs.get('flip_y', False),
+        'binary_tile_ids' : binary_tile_ids,
+        'tile_id_hash' : hash_name,
+        'command_list' : kwargs.get('command_list'),
+        'transform_list' : kwargs.get('transform_list'),
+        'pipe_list' : kwargs.get('pipe_list')
+    }
+
+    readers = {}
+    pending_files = [f for f in mbtiles_files if f not in sql_mergeable]
+
+    def start_readers():
+        while pending_files and len(readers) < pool_size:
+            mbtiles_file2 = pending_files.pop(0)
+            tile_queue = multiprocessing.Queue(16)
+            reader = multiprocessing.Process(target=read_mbtiles, args=(mbtiles_file2, tile_queue, options))
+            reader.daemon = True
+            reader.start()
+            readers[mbtiles_file2] = (reader, tile_queue)
+
+
+    count = 0
+    start_time = time.time()
+    metrics = get_metrics(**kwargs)
+    writer = TileWriter(con1, True, kwargs.get('batch_size', 1000), metrics)
+
+    for n, mbtiles_file2 in enumerate(mbtiles_files):
+        start_readers()
+        logger.info("%d: Merging %s" % (n + 1, mbtiles_file2))
+        metrics.start('merge', None, mbtiles_file2)
+
+        if mbtiles_file2 in sql_mergeable:
+            writer.flush()
+            merge_start_time = time.time()
+            merged = merge_mbtiles_sql(cur1, mbtiles_file2, min_zoom, max_zoom, False, kwargs.get('bbox'))
+            metrics.time('write', merge_start_time)
+            metrics.tiles(merged)
+            count = count + merged
+            continue
+
+        reader, tile_queue = readers.pop(mbtiles_file2)
+        written_tile_ids = set()
+        skipped_tile_ids = set()
+        con2 = None
+
+        # The readers are other processes, the time waiting for them is the read phase
+        read_start_time = time.time()
+        chunk = tile_queue.get()
+        while chunk is not None:
+            metrics.time('read', read_start_time)
+
+            if isinstance(chunk, str):
+                con1.close()
+                sys.stderr.write("Could not read %s: %s\n" % (mbtiles_file2, chunk))
+                sys.exit(1)
+
+            for z, x, y, tile_id, tile_data in chunk:
+                if no_overwrite:
+                    if existing_tiles.contains(z, x, y):
+                        logger.debug("Ignoring tile (%d, %d, %d)" % (z, x, y))
+                        # The reader sends each image only once, the next tile using it reads it again
+                        if tile_data is not None:
+                            skipped_tile_ids.add(tile_id)
+                        continue
+                    existing_tiles.add(z, x, y)
+
+                    if tile_data is None and tile_id in skipped_tile_ids and tile_id not in written_tile_ids:
+                        if con2 is None:
+                            con2 = mbtiles_connect(mbtiles_file2)
+                        tile_data = read_tile(con2, z, x, y, options)
+                    skipped_tile_ids.discard(tile_id)
+                    written_tile_ids.add(tile_id)
+
+                if tile_data is None:
+                    metrics.add('duplicates')
+                else:
+                    metrics.add('bytes_read', len(tile_data))
+
+                writer.add(z, x, y, tile_data, tile_id)
+
+                count = count + 1
+                metrics.tiles()
+
+            read_start_time = time.time()
+            chunk = tile_queue.get()
+
+        reader.join()
+        if con2:
+            con2.close()
+        # Finish the batch within the metrics of this file
+        writer.flush()
+
+    writer.close()
+    metrics.finish()
+
+    logger.info("%s tiles merged (%.1f tiles/sec)" % (count, count / (time.time() - start_time)))
+
+    if existing_tiles:
+        existing_tiles.close()
+
+    con1.commit()
+    con1.close()
@@ -0,0 +1,116 @@
+import sys, logging, time, threading
+
+logger = logging.getLogger(__name__)
+
+
+class Metrics(object):
+    """Collects the counters (tiles, bytes_read, bytes_written, duplicates)
+    and the cumulative time per phase (read, hash, transform, write,
+    commit) of every operation. Pass it as metrics=... to the mbutil
+    functions. The optional callback is called with an event ('start',
+    'progress' or 'finish') and a snapshot of the current operation, at
+    most every interval seconds for 'progress'."""
+
+    def __init__(self, callback=None, interval=1.0):
+        self.callback = callback
+        self.interval = interval
+        self.operations = []
+        self.current = None
+        self.lock = threading.Lock()
+
+    def start(self, operation, total_tiles=None, source=None):
+        if self.current is not None:
+            self.finish()
+
+        now = time.time()
+        self.current = {
+            'operation' : operation,
+            'source' : source,
+            'total_tiles' : total_tiles,
+            'tiles' : 0,
+            'bytes_read' : 0,
+            'bytes_written' : 0,
+            'duplicates' : 0,
+            'phases' : {},
+            'start_time' : now
+        }
+        self.last_progress = now
+        self.next_check = 100
+        self.emit('start')
+
+    def add(self, counter, n=1):
+        with self.lock:
+            self.current[counter] = self.current.get(counter, 0) + n
+
+    def time(self, phase, since):
+        """Adds the time since 'since' to phase and returns the current time,
+        to be passed as 'since' of the next phase."""
+        now = time.time()
+        with self.lock:
+            phases = self.current['phases']
+            phases[phase] = phases.get(phase, 0.0) + (now - since)
+        return now
+
+    def tiles(self, n=1):
+        with self.lock:
+            self.current['tiles'] += n
+            if self.current['tiles'] < self.next_check:
+                return
+            self.next_check = self.current['tiles'] + 100
+
+        now = time.time()
+        if now - self.last_progress >= self.interval:
+            self.last_progress = now
+            snapshot = self.snapshot()
+            if snapshot['total_tiles']:
+                logger.debug("%s: %d / %d tiles (%.1f%%, %.1f tiles/sec)" % (snapshot['operation'], snapshot['tiles'],
+                    snapshot['total_tiles'], float(snapshot['tiles']) / snapshot['total_tiles'] * 100.0, snapshot['tiles_per_sec']))
+            else:
+                logger.debug("%s: %d tiles (%.1f tiles/sec)" % (snapshot['operation'], snapshot['tiles'], snapshot['tiles_per_sec']))
+            self.emit('progress', snapshot)
+
+    def snapshot(self):
+        with self.lock:
+            snapshot = dict(self.current)
+            snapshot['phases'] = dict(self.current['phases'])
+
+        snapshot['elapsed'] = time.time() - snapshot.pop('start_time')
+        snapshot['tiles_per_sec'] = snapshot['tiles'] / snapshot['elapsed'] if snapshot['elapsed'] > 0 else 0.0
+        return snapshot
+
+    def finish(self):
+        if self.current is None:
+            return
+
+        snapshot = self.snapshot()
+        self.operations.append(snapshot)
+        self.current = None
+
+        logger.debug("%s: %.2f sec, %s" % (snapshot['operation'], snapshot['elapsed'],
+            ', '.join(["%s %.2f sec" % (phase, seconds) for phase, seconds in sorted(snapshot['phases'].items())])))
+        self.emit('finish', snapshot)
+
+    def emit(self, event, snapshot=None):
+        if self.callback:
+            self.callback(event, snapshot or self.snapshot())
+
+    def report(self):
+        """Returns the finished operations and their totals."""
+        self.finish()
+
+        totals = {'tiles' : 0, 'bytes_read' : 0, 'bytes_written' : 0, 'duplicates' : 0, 'elapsed' : 0.0, 'phases' : {}}
+        for operation in self.operations:
+            for counter in ('tiles', 'bytes_read', 'bytes_written', 'duplicates', 'elapsed'):
+                totals[counter] += operation.get(counter, 0)
+            for phase, seconds in operation['phases'].items():
+                totals['phases'][phase] = totals['phases'].get(phase, 0.0) + seconds
+
+        return {
+            'operations' : self.operations,
+            'totals' : totals
+        }
+
+
+def get_metrics(**kwargs):
+    """Returns the metrics=... object of kwargs, or one nobody reads."""
+    return kwargs.get('metrics') or Metrics()
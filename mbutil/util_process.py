@@ -1,16 +1,24 @@
-import sqlite3, uuid, sys, logging, time, os, json, zlib, hashlib, tempfile, multiprocessing
+import sqlite3, uuid, sys, logging, time, os, json, zlib, hashlib, tempfile, multiprocessing, threading, collections
 
-from util import mbtiles_connect, mbtiles_setup, optimize_connection, optimize_database, process_tile
+from util import mbtiles_connect, mbtiles_setup, optimize_connection, optimize_database, process_tile, tile_id_hash, database_tile_id_hash, optimized_layout, read_tile_id, tile_range_condition, \
+    map_key, encode_map_position, decode_map_position, checkpoint_prepare, load_checkpoints, add_checkpoints, clear_checkpoints
+from util_cache import open_tile_cache, cache_key
+from util_metrics import get_metrics
 from multiprocessing import Pool
+from multiprocessing.pool import AsyncResult
 
 logger = logging.getLogger(__name__)
 
 
+def process_tiles(tiles):
+    return [process_tile(next_tile) for next_tile in tiles]
+
+
 def execute_commands_on_mbtiles(mbtiles_file, **kwargs):
     logger.info("Executing commands on database %s" % (mbtiles_file))
 
 
-    if kwargs.get('command_list') == None or len(kwargs['command_list']) == 0:
+    if not kwargs.get('command_list') and not kwargs.get('transform_list') and not kwargs.get('pipe_list'):
         return
 
     auto_commit = kwargs.get('auto_commit', False)
@@ -43,19 +51,40 @@ def execute_commands_on_mbtiles(mbtiles_file, **kwargs):
     count = 0
     duplicates = 0
     chunk = 1000
-    start_time = time.time()
     processed_tile_ids = set()
+    cache = open_tile_cache(image_format, **kwargs)
 
-    max_rowid = (con.execute("select max(rowid) from map").fetchone()[0])
-    total_tiles = (con.execute("""select count(distinct(tile_id)) from map where zoom_level>=? and zoom_level<=?""",
-        (min_zoom, max_zoom)).fetchone()[0])
+    tile_id_function = tile_id_hash(database_tile_id_hash(cur), optimized_layout(cur))
+    key_columns = map_key(cur)
+    columns = ', '.join(key_columns)
+    key = "(%s)" % (columns)
+    key_value = "(%s)" % (', '.join(['?'] * len(key_columns)))
+    condition, params = tile_range_condition(min_zoom, max_zoom, bbox=kwargs.get('bbox'))
+    total_tiles = (con.execute("""select count(distinct(tile_id)) from map where %s""" % (condition),
+        params).fetchone()[0])
 
     logger.debug("%d tiles to process" % (total_tiles))
 
 
-    logger.debug("Creating an index for the tile_id column...")
-    con.execute("""CREATE INDEX IF NOT EXISTS tile_id_index ON map (tile_id)""")
-    logger.debug("...done")
+    # The checkpoint is the map_key of the last row whose chunk is committed
+    position = decode_map_position(None, key_columns)
+    positions = load_checkpoints(cur, 'process', '') if kwargs.get('resume', False) else []
+    if positions:
+        position = decode_map_position(positions[0], key_columns)
+        logger.info("Resuming after tile %s" % (positions[0]))
+    else:
+        clear_checkpoints(cur, 'process', '')
+        clear_checkpoints(cur, 'process_remap', '')
+        cur.execute("""drop table if exists tile_id_remap""")
+    checkpoint_prepare(cur)
+
+    # The new tile_id of every processed image. The map keeps the old ones
+    # until all images are processed and is then updated in one pass.
+    cur.execute("""create table if not exists tile_id_remap (
+        old_tile_id TEXT PRIMARY KEY,
+        new_tile_id TEXT)""")
+    if positions:
+        processed_tile_ids = set([read_tile_id(r[0]) for r in con.execute("""select old_tile_id from tile_id_remap""")])
 
 
     if default_pool_size < 1:
@@ -67,91 +96,181 @@ def execute_commands_on_mbtiles(mbtiles_file, **kwargs):
     pool = Pool(default_pool_size)
     multiprocessing.log_to_stderr(logger.level)
 
+    metrics = get_metrics(**kwargs)
+    metrics.start('process', total_tiles, mbtiles_file)
+
+    # Tiles sent to the pool per task, like the chunksize of pool.map
+    task_size = max(1, chunk / ((default_pool_size or multiprocessing.cpu_count()) * 4))
+    max_in_flight = max(kwargs.get('in_flight', 4 * chunk), task_size)
+
+    # Tasks in read order: (checkpoint position of the chunk or None, AsyncResult or list of tiles)
+    pending = collections.deque()
+    in_flight = [0]
+    task_done = threading.Event()
+    def write_next_task(start_time):
+        chunk_end, result = pending.popleft()
+        processed_tiles = result.get() if isinstance(result, AsyncResult) else result
+        in_flight[0] -= len(processed_tiles)
+        start_time = metrics.time('transform', start_time)
+
+        images = {}
+        remap = []
+        for next_tile in processed_tiles:
+            tile_id, tile_data = next_tile['tile_id'], next_tile['tile_data']
+            if cache and not next_tile.get('cached'):
+                cache.put(next_tile['cache_key'], tile_data)
+
+            # Empty results keep the old image
+            new_tile_id = tile_id
+            if tile_data and len(tile_data) > 0:
+                new_tile_id = tile_id_function(tile_data)
+                images[new_tile_id] = sqlite3.Binary(tile_data)
+                metrics.add('bytes_written', len(tile_data))
+            remap.append((tile_id, new_tile_id))
+
+            metrics.tiles()
+
+        start_time = metrics.time('hash', start_time)
+        cur.executemany("""insert or ignore into images (tile_id, tile_data) values (?, ?)""",
+            images.items())
+        cur.executemany("""insert or replace into tile_id_remap (old_tile_id, new_tile_id) values (?, ?)""",
+            remap)
+        start_time = metrics.time('write', start_time)
+
+        # The last task of a chunk commits it with its checkpoint
+        if chunk_end is not None:
+            add_checkpoints(cur, 'process', '', [str(chunk_end)], True)
+            con.commit()
+            start_time = metrics.time('commit', start_time)
+
+        return len(processed_tiles), start_time
 
-    for i in range((max_rowid / chunk) + 1):
-        # logger.debug("Starting range %d-%d" % (i*chunk, (i+1)*chunk))
-        tiles = cur.execute("""select images.tile_id, images.tile_data, map.zoom_level, map.tile_column, map.tile_row
+    def submit(chunk_end, tiles_to_process):
+        if len(tiles_to_process) == 0:
+            pending.append((chunk_end, []))
+            return
+        for j in range(0, len(tiles_to_process), task_size):
+            task = tiles_to_process[j:j + task_size]
+            in_flight[0] += len(task)
+            pending.append((chunk_end if j + task_size >= len(tiles_to_process) else None,
+                pool.apply_async(process_tiles, (task, ), callback=lambda r: task_done.set())))
+
+
+    # The chunks are read while the pool processes the previous ones, and the
+    # results are written in read order as soon as they are ready. Reading
+    # only stops while more than max_in_flight tiles are read but not written.
+    while True:
+        start_time = time.time()
+        # The chunk's keys come from map alone, so images are only read for them
+        rows = cur.execute("""select images.tile_id, images.tile_data, %s
             from map, images
-            where (map.rowid > ? and map.rowid <= ?)
-            and (map.zoom_level>=? and map.zoom_level<=?)
-            and (images.tile_id == map.tile_id)""",
-            ((i * chunk), ((i + 1) * chunk), min_zoom, max_zoom))
+            where %s in (select %s from map where %s > %s and (%s) order by %s limit ?)
+            and (images.tile_id == map.tile_id)
+            order by %s""" % (columns, key, columns, key, key_value, condition, columns, columns),
+            position + params + [chunk]).fetchall()
+        if len(rows) == 0:
+            break
+        position = list(rows[-1][2:])
 
 
         tiles_to_process = []
 
-        t = tiles.fetchone()
-
-        while t:
-            tile_id = t[0]
+        for t in rows:
+            tile_id = read_tile_id(t[0])
             tile_data = t[1]
-            # tile_z = t[2]
-            # tile_x = t[3]
-            # tile_y = t[4]
-            # logging.debug("Working on tile (%d, %d, %d)" % (tile_z, tile_x, tile_y))
+
+            metrics.add('bytes_read', len(tile_data))
 
             if tile_id in processed_tile_ids:
                 duplicates = duplicates + 1
+                metrics.add('duplicates')
             else:
                 processed_tile_ids.add(tile_id)
 
-                tmp_file_fd, tmp_file_name = tempfile.mkstemp(suffix=".%s" % (image_format), prefix="tile_")
-                tmp_file = os.fdopen(tmp_file_fd, "w")
-                tmp_file.write(tile_data)
-                tmp_file.close()
+                data_key = cache_key(str(tile_data)) if cache else None
+                cached_tile_data = cache.get(data_key) if cache else None
+                if cached_tile_data is not None:
+                    # Keeps the read order, written like a finished task
+                    pending.append((None, [{
+                        'tile_id' : tile_id,
+                        'tile_data' : cached_tile_data,
+                        'cached' : True
+                    }]))
+                    continue
 
                 tiles_to_process.append({
                     'tile_id' : tile_id,
-                    'filename' : tmp_file_name,
+                    'cache_key' : data_key,
+                    'tile_data' : str(tile_data),
                     'format' : image_format,
-                    'command_list' : kwargs.get('command_list', [])
+                    'command_list' : kwargs.get('command_list'),
+                    'transform_list' : kwargs.get('transform_list'),
+                    'pipe_list' : kwargs.get('pipe_list')
                 })
 
-            t = tiles.fetchone()
-
+        submit(encode_map_position(position), tiles_to_process)
+        start_time = metrics.time('read', start_time)
 
-        if len(tiles_to_process) == 0:
-            continue
-
-        # Execute commands in parallel
-        # logger.debug("Starting multiprocessing...")
-        processed_tiles = pool.map(process_tile, tiles_to_process)
-
-	# logger.debug("Starting reimport...")
-        for next_tile in processed_tiles:
-            tile_id, tile_file_path = next_tile['tile_id'], next_tile['filename']
-
-            tmp_file = open(tile_file_path, "r")
-            tile_data = tmp_file.read()
-            tmp_file.close()
-
-            os.remove(tile_file_path)
-
-            if tile_data and len(tile_data) > 0:
-                m = hashlib.md5()
-                m.update(tile_data)
-                new_tile_id = m.hexdigest()
-
-                cur.execute("""insert or ignore into images (tile_id, tile_data) values (?, ?)""",
-                    (new_tile_id, sqlite3.Binary(tile_data)))
-                cur.execute("""update map set tile_id=? where tile_id=?""",
-                    (new_tile_id, tile_id))
-                if tile_id != new_tile_id:
-                    cur.execute("""delete from images where tile_id=?""",
-                    [tile_id])
-
-                # logger.debug("Tile %s done\n" % (tile_id, ))
-
-
-            count = count + 1
-            if (count % 100) == 0:
-                logger.debug("%s tiles finished (%.1f%%, %.1f tiles/sec)" %
-                    (count, (float(count) / float(total_tiles)) * 100.0, count / (time.time() - start_time)))
+        # Write the finished tasks, wait for them only while too many tiles are in flight
+        while pending:
+            if not (isinstance(pending[0][1], list) or pending[0][1].ready()):
+                if in_flight[0] < max_in_flight:
+                    break
+                task_done.wait(0.1)
+                task_done.clear()
+                continue
+            tasks_count, start_time = write_next_task(start_time)
+            count = count + tasks_count
 
+    start_time = time.time()
+    while pending:
+        tasks_count, start_time = write_next_task(start_time)
+        count = count + tasks_count
+
+
+    # Point the map to the new images, in transactions of remap_chunk rows.
+    # Every row is updated at most once, even when the new tile_id of one
+    # image is the old tile_id of another.
+    logger.debug("Updating the map to the processed images...")
+    remap_chunk = chunk * 100
+    positions = load_checkpoints(cur, 'process_remap', '')
+    position = decode_map_position(positions[0] if positions else None, key_columns)
+    while True:
+        end = cur.execute("""select %s from map where %s > %s order by %s limit 1 offset ?""" % (columns, key, key_value, columns),
+            position + [remap_chunk - 1]).fetchone()
+        cur.execute("""update map set tile_id=(select new_tile_id from tile_id_remap where old_tile_id=map.tile_id)
+            where %s > %s %s
+            and exists (select 1 from tile_id_remap where old_tile_id=map.tile_id and new_tile_id!=old_tile_id)""" % (key, key_value, ('and %s <= %s' % (key, key_value)) if end else ''),
+            position + (list(end) if end else []))
+        if end is None:
+            break
+
+        position = list(end)
+        add_checkpoints(cur, 'process_remap', '', [encode_map_position(position)], True)
+        start_time = metrics.time('write', start_time)
+        con.commit()
+        start_time = metrics.time('commit', start_time)
+
+    # The old images are not used any more, unless they are the result of
+    # another image. Committed together with the last rows of the map.
+    cur.execute("""delete from images where tile_id in
+        (select old_tile_id from tile_id_remap where new_tile_id!=old_tile_id
+        and old_tile_id not in (select new_tile_id from tile_id_remap))""")
+    cur.execute("""delete from tile_id_remap""")
+    clear_checkpoints(cur, 'process_remap', '')
+    clear_checkpoints(cur, 'process', '')
+    start_time = metrics.time('write', start_time)
+    con.commit()
+    cur.execute("""drop table tile_id_remap""")
+    start_time = metrics.time('commit', start_time)
 
     logger.info("%s tiles finished, %d duplicates ignored (100.0%%, %.1f tiles/sec)" %
-        (count, duplicates, count / (time.time() - start_time)))
+        (count, duplicates, metrics.snapshot()['tiles_per_sec']))
+
+    if cache:
+        cache.close()
 
     pool.close()
-    con.commit()
+    pool.join()
     con.close()
+    metrics.finish()
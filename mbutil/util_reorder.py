@@ -0,0 +1,193 @@
+import sqlite3, uuid, sys, logging, time, os, json, zlib, hashlib, tempfile
+
+from util import mbtiles_connect, mbtiles_setup, storage_prepare, optimize_connection, optimized_layout, read_tile_id, tile_range_condition, TileWriter
+from util_metrics import get_metrics
+
+logger = logging.getLogger(__name__)
+
+
+def hilbert_key(z, x, y):
+    """Returns the position of tile (x, y) on the Hilbert curve filling
+    zoom level z. Neighbouring positions are always neighbouring tiles."""
+    n = 1 << z
+    d = 0
+    s = n >> 1
+    while s > 0:
+        rx = 1 if (x & s) else 0
+        ry = 1 if (y & s) else 0
+        d += s * s * ((3 * rx) ^ ry)
+        # Rotate the quadrant, only the bits below s matter from here on
+        if ry == 0:
+            if rx == 1:
+                x = n - 1 - x
+                y = n - 1 - y
+            x, y = y, x
+        s >>= 1
+    return d
+
+
+def zorder_key(z, x, y):
+    """Returns the position of tile (x, y) on the Z-order (Morton) curve,
+    the bits of x and y interleaved."""
+    d = 0
+    for i in range(z):
+        d |= ((x >> i) & 1) << (2 * i) | ((y >> i) & 1) << (2 * i + 1)
+    return d
+
+
+curve_keys = {
+    'hilbert' : hilbert_key,
+    'zorder' : zorder_key
+}
+
+
+def count_page_reads(mbtiles_file, query, params):
+    """Runs query on a new connection and returns the number of pages
+    SQLite read from the database file, or None where /proc/self/io is
+    not available. Without mmap every page not in the connection's cache
+    is one read() of page_size bytes."""
+    def read_bytes():
+        try:
+            for line in open('/proc/self/io'):
+                if line.startswith('rchar:'):
+                    return int(line.split()[1])
+        except IOError:
+            pass
+        return None
+
+    con = sqlite3.connect(mbtiles_file)
+    con.execute("""PRAGMA mmap_size=0""")
+    page_size = con.execute("""PRAGMA page_size""").fetchone()[0]
+    # Loads the schema before measuring
+    con.execute("""SELECT count(*) FROM sqlite_master""").fetchone()
+
+    start_bytes = read_bytes()
+    for row in con.execute(query, params):
+        pass
+    end_bytes = read_bytes()
+    con.close()
+
+    if start_bytes is None or end_bytes is None:
+        return None
+    return (end_bytes - start_bytes) / page_size
+
+
+def sample_tile_range(con, zoom=None, size=16):
+    """Returns (zoom, (min_x, min_y, max_x, max_y)) of a size x size tiles
+    bounding box around the middle tile of the highest zoom level, or None
+    if there are no tiles."""
+    if zoom is None:
+        zoom = con.execute("""SELECT max(zoom_level) FROM map""").fetchone()[0]
+    total_tiles = con.execute("""SELECT count(*) FROM map WHERE zoom_level=?""", (zoom, )).fetchone()[0]
+    if total_tiles == 0:
+        return None
+
+    x, y = con.execute("""SELECT tile_column, tile_row FROM map WHERE zoom_level=? ORDER BY tile_column, tile_row LIMIT 1 OFFSET ?""",
+        (zoom, total_tiles / 2)).fetchone()
+    return zoom, (x - size / 2, y - size / 2, x + size / 2 - 1, y + size / 2 - 1)
+
+
+def reorder_mbtiles(mbtiles_file, output_file, **kwargs):
+    """Rewrites mbtiles_file into the new output_file with the tiles of
+    every zoom level sorted along a Hilbert (or Z-order) curve and the
+    images in the order of their first tile, so that neighbouring tiles
+    share pages. Returns the pages read by a sample bounding box query
+    before and after (None if they can't be counted)."""
+    logger.info("Reordering database: %s --> %s" % (mbtiles_file, output_file))
+
+
+    curve = kwargs.get('curve', 'hilbert')
+    batch_size = kwargs.get('batch_size', 1000)
+
+    con1 = mbtiles_connect(mbtiles_file)
+    cur1 = con1.cursor()
+    optimize_connection(cur1)
+    con1.create_function('curve_key', 3, curve_keys[curve])
+
+    compacted = (con1.execute("SELECT count(name) FROM sqlite_master WHERE type='table' AND name='images'").fetchone()[0] > 0)
+    if not compacted:
+        con1.close()
+        sys.stderr.write('To reorder a mbtiles database, it must be compacted\n')
+        sys.exit(1)
+
+    layout = 'optimized' if optimized_layout(cur1) else 'standard'
+    page_size = con1.execute("""PRAGMA page_size""").fetchone()[0]
+    total_tiles = con1.execute("""SELECT count(*) FROM tiles""").fetchone()[0]
+
+
+    # The same layout and page size as the original
+    con2 = mbtiles_connect(output_file)
+    cur2 = con2.cursor()
+    storage_prepare(cur2, layout, page_size)
+    optimize_connection(cur2, False)
+    # The tile_ids are copied, so is their hash if the original records it
+    mbtiles_setup(cur2, layout, None)
+    cur2.executemany("""INSERT INTO metadata (name, value) VALUES (?, ?)""",
+        con1.execute("""SELECT name, value FROM metadata""").fetchall())
+    con2.commit()
+
+
+    metrics = get_metrics(**kwargs)
+    metrics.start('reorder', total_tiles, mbtiles_file)
+    writer = TileWriter(con2, True, batch_size, metrics)
+
+    # SQLite sorts by the curve, spilling to temporary files for large databases
+    tiles = cur1.execute("""SELECT zoom_level, tile_column, tile_row, tile_id FROM map
+        ORDER BY zoom_level, curve_key(zoom_level, tile_column, tile_row)""")
+
+    copied_tile_ids = set()
+    image_cur = con1.cursor()
+
+    start_time = time.time()
+    rows = tiles.fetchmany(1000)
+    start_time = metrics.time('read', start_time)
+    while rows:
+        for t in rows:
+            # The images in the order of their first tile
+            tile_id, tile_data = read_tile_id(t[3]), None
+            if tile_id not in copied_tile_ids:
+                copied_tile_ids.add(tile_id)
+                tile_data = str(image_cur.execute("""SELECT tile_data FROM images WHERE tile_id=?""", (t[3], )).fetchone()[0])
+                metrics.add('bytes_read', len(tile_data))
+            else:
+                metrics.add('duplicates')
+            start_time = metrics.time('read', start_time)
+
+            writer.add(t[0], t[1], t[2], tile_data, tile_id)
+            # The writer times its own flushes
+            start_time = time.time()
+            metrics.tiles()
+
+        rows = tiles.fetchmany(1000)
+        start_time = metrics.time('read', start_time)
+
+    writer.close()
+    con2.commit()
+    con2.close()
+    con1.close()
+    metrics.finish()
+
+    logger.info("%d tiles reordered along the %s curve" % (writer.count, curve))
+
+
+    # Page reads of a bounding box query, the same one on both files
+    con = sqlite3.connect(output_file)
+    sample = sample_tile_range(con, kwargs.get('zoom') if kwargs.get('zoom', -1) >= 0 else None)
+    con.close()
+    if sample is None:
+        return None, None
+
+    zoom, tile_range = sample
+    tile_range = kwargs.get('tile_range') or tile_range
+    condition, params = tile_range_condition(zoom, zoom, tile_range)
+    query = """SELECT tile_data FROM tiles WHERE %s""" % (condition)
+
+    pages_before = count_page_reads(mbtiles_file, query, params)
+    pages_after = count_page_reads(output_file, query, params)
+    if pages_before is None or pages_after is None:
+        logger.info("Page reads can't be counted on this system")
+    else:
+        logger.info("Zoom level %d, tiles %s: %d pages read before, %d after reordering" % (zoom,
+            ','.join([str(v) for v in tile_range]), pages_before, pages_after))
+
+    return pages_before, pages_after
@@ -0,0 +1,244 @@
+import sqlite3, uuid, sys, logging, time, os, json, zlib, hashlib, tempfile, threading, Queue, re, collections
+import BaseHTTPServer, SocketServer
+
+from util import flip_y, md5_tile_id
+
+logger = logging.getLogger(__name__)
+
+
+content_types = {
+    'png' : 'image/png',
+    'jpg' : 'image/jpeg',
+    'jpeg' : 'image/jpeg',
+    'webp' : 'image/webp',
+    'pbf' : 'application/x-protobuf',
+    'mvt' : 'application/x-protobuf'
+}
+
+
+def printable_tile_id(tile_id):
+    """Returns tile_id usable in an ETag, hex encoding the binary tile_ids
+    of the optimized layout."""
+    if isinstance(tile_id, buffer):
+        return str(tile_id).encode('hex')
+    return tile_id
+
+
+class TileLRUCache(object):
+    """In-memory cache of the most recently served tiles, holding at most
+    max_size bytes of tile data."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.tiles = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            tile = self.tiles.pop(key, None)
+            if tile is not None:
+                self.tiles[key] = tile
+            return tile
+
+    def put(self, key, tile):
+        tile_size = len(tile[1])
+        if tile_size > self.max_size:
+            return
+
+        with self.lock:
+            old_tile = self.tiles.pop(key, None)
+            if old_tile is not None:
+                self.size -= len(old_tile[1])
+
+            self.tiles[key] = tile
+            self.size += tile_size
+
+            while self.size > self.max_size:
+                ignore, old_tile = self.tiles.popitem(last=False)
+                self.size -= len(old_tile[1])
+
+
+class TileStore(object):
+    """Looks up the tiles of mbtiles_file through a pool of read-only
+    connections, with an in-memory LRU cache in front of them."""
+
+    def __init__(self, mbtiles_file, connections=4, cache_size=64*1024*1024, flip_y=False):
+        self.mbtiles_file = mbtiles_file
+        self.flip_y = flip_y
+        self.cache = TileLRUCache(cache_size)
+        self.connections = Queue.Queue()
+
+        for i in range(connections):
+            con = sqlite3.connect(mbtiles_file, check_same_thread=False, cached_statements=16)
+            con.execute("""PRAGMA query_only=ON""").fetchall()
+            self.connections.put(con)
+
+        con = self.connections.get()
+        try:
+            self.compacted = (con.execute("SELECT count(name) FROM sqlite_master WHERE type='table' AND name='map'").fetchone()[0] > 0)
+            self.metadata = dict(con.execute('SELECT name, value FROM metadata').fetchall())
+        finally:
+            self.connections.put(con)
+
+        self.image_format = self.metadata.get('format', 'png')
+
+        # The statements are the same for every lookup, so sqlite3 keeps them prepared
+        if self.compacted:
+            self.tile_sql = """SELECT images.tile_id, images.tile_data FROM map, images WHERE map.zoom_level=? AND map.tile_column=? AND map.tile_row=? AND images.tile_id=map.tile_id"""
+            self.tile_id_sql = """SELECT tile_id FROM map WHERE zoom_level=? AND tile_column=? AND tile_row=?"""
+        else:
+            self.tile_sql = """SELECT NULL, tile_data FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?"""
+            self.tile_id_sql = None
+
+    def execute(self, sql, args):
+        con = self.connections.get()
+        try:
+            return con.execute(sql, args).fetchone()
+        finally:
+            self.connections.put(con)
+
+    def get_tile_id(self, z, x, y):
+        """Returns the tile_id of a tile without reading its image, or None
+        if the database has no tile_ids or no such tile."""
+        tile = self.cache.get((z, x, y))
+        if tile is not None:
+            return tile[0]
+
+        if self.tile_id_sql is None:
+            return None
+
+        if self.flip_y:
+            y = flip_y(z, y)
+
+        row = self.execute(self.tile_id_sql, (z, x, y))
+        return printable_tile_id(row[0]) if row else None
+
+    def get_tile(self, z, x, y):
+        """Returns (tile_id, tile_data) or None if there is no such tile."""
+        tile = self.cache.get((z, x, y))
+        if tile is not None:
+            return tile
+
+        row = self.execute(self.tile_sql, (z, x, flip_y(z, y) if self.flip_y else y))
+        if row is None:
+            return None
+
+        tile_data = str(row[1])
+        tile = (printable_tile_id(row[0]) or md5_tile_id(tile_data), tile_data)
+        self.cache.put((z, x, y), tile)
+        return tile
+
+    def close(self):
+        while not self.connections.empty():
+            self.connections.get().close()
+
+
+class TileRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    # Send the headers and the tile in one packet, keep-alive responses otherwise wait for delayed ACKs
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    tile_path = re.compile(r'^/(\d+)/(\d+)/(\d+)\.(\w+)$')
+
+    def do_GET(self):
+        store = self.server.store
+        path = self.path.split('?', 1)[0]
+
+        if path == '/metadata.json':
+            self.send_data(200, 'application/json', json.dumps(store.metadata))
+            return
+
+        match = self.tile_path.match(path)
+        if not match:
+            self.send_data(404, 'text/plain', 'Not found\n')
+            return
+
+        z, x, y = int(match.group(1)), int(match.group(2)), int(match.group(3))
+
+        # The tiles only exist in the format of the database, .jpeg is also a .jpg
+        extension = match.group(4).lower()
+        if content_types.get(extension, extension) != content_types.get(store.image_format, store.image_format):
+            self.send_data(404, 'text/plain', 'Not found\n')
+            return
+
+        # A client revalidating its copy doesn't need the image to be read
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match:
+            tile_id = store.get_tile_id(z, x, y)
+            if tile_id and self.etag_matches(if_none_match, tile_id):
+                self.send_not_modified(tile_id)
+                return
+
+        tile = store.get_tile(z, x, y)
+        if tile is None:
+            self.send_data(404, 'text/plain', 'Tile not found\n')
+            return
+
+        tile_id, tile_data = tile
+        if if_none_match and self.etag_matches(if_none_match, tile_id):
+            self.send_not_modified(tile_id)
+            return
+
+        headers = {'ETag' : '"%s"' % (tile_id)}
+        if tile_data[:2] == '\x1f\x8b':
+            headers['Content-Encoding'] = 'gzip'
+        self.send_data(200, content_types.get(store.image_format, 'application/octet-stream'), tile_data, headers)
+
+    def etag_matches(self, if_none_match, tile_id):
+        etags = [etag.strip() for etag in if_none_match.split(',')]
+        return '*' in etags or ('"%s"' % (tile_id)) in etags or ('W/"%s"' % (tile_id)) in etags
+
+    def send_not_modified(self, tile_id):
+        self.send_response(304)
+        self.send_header('ETag', '"%s"' % (tile_id))
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def send_data(self, status, content_type, data, headers={}):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s" % (self.client_address[0], format % args))
+
+
+class TileServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, server_address, store):
+        BaseHTTPServer.HTTPServer.__init__(self, server_address, TileRequestHandler)
+        self.store = store
+
+
+def create_tile_server(mbtiles_file, **kwargs):
+    """Returns a TileServer for mbtiles_file, call serve_forever() on it to
+    serve the tiles."""
+    workers = kwargs.get('workers', -1)
+    if workers < 1:
+        workers = 4
+
+    store = TileStore(mbtiles_file, workers, kwargs.get('serve_cache_size', 64) * 1024 * 1024, kwargs.get('flip_y', False))
+    return TileServer((kwargs.get('host', '127.0.0.1'), kwargs.get('port', 8000)), store)
+
+
+def serve_mbtiles(mbtiles_file, **kwargs):
+    server = create_tile_server(mbtiles_file, **kwargs)
+    host, port = server.server_address[:2]
+    logger.info("Serving %s on http://%s:%d/{z}/{x}/{y}.%s" % (mbtiles_file, host, port, server.store.image_format))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+    server.server_close()
+    server.store.close()
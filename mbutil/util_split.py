@@ -0,0 +1,335 @@
+import sqlite3, uuid, sys, logging, time, os, json, zlib, hashlib, tempfile, multiprocessing, collections, Queue
+
+from util import mbtiles_connect, storage_prepare, optimize_connection, optimized_layout, compaction_prepare, compaction_finalize, \
+    tile_id_hash, database_tile_id_hash, read_tile_id, tile_range_condition, TileWriter
+from util_metrics import get_metrics
+
+logger = logging.getLogger(__name__)
+
+
+def shard_name(band, cell):
+    """Returns the file name of the shard of a zoom band (min_zoom,
+    max_zoom) and a grid cell (zoom, x, y), either of them can be None."""
+    parts = []
+    if band is not None:
+        parts.append('z%d-%d' % band)
+    if cell is not None:
+        parts.append('%d-%d-%d' % cell)
+    return '_'.join(parts) + '.mbtiles'
+
+
+# Shard files a writer process keeps open, the others are closed and
+# opened again for their next chunk
+open_shards_per_writer = 16
+
+
+class ShardFile(object):
+    """A shard written by write_shards, opened again after being closed."""
+
+    def __init__(self, mbtiles_file, options):
+        self.mbtiles_file = mbtiles_file
+        self.options = options
+        self.con = None
+        self.writer = None
+        self.created = False
+        self.count = 0
+
+    def open(self):
+        self.con = mbtiles_connect(self.mbtiles_file)
+        cur = self.con.cursor()
+        if not self.created:
+            storage_prepare(cur, self.options['layout'], self.options['page_size'])
+        optimize_connection(cur, False)
+        if not self.created:
+            # The indexes are created after the tiles, see compaction_finalize
+            compaction_prepare(cur, self.options['layout'])
+            cur.executemany("""INSERT INTO metadata (name, value) VALUES (?, ?)""",
+                self.options['metadata'])
+            self.con.commit()
+            self.created = True
+        self.writer = TileWriter(self.con, True, self.options['batch_size'])
+
+    def close(self):
+        if self.con is None:
+            return
+        con, writer = self.con, self.writer
+        self.con = self.writer = None
+        try:
+            writer.close()
+            self.count += writer.count
+        finally:
+            con.close()
+
+    def finish(self):
+        con = mbtiles_connect(self.mbtiles_file)
+        cur = con.cursor()
+        compaction_finalize(cur)
+        # The zoom levels of this shard only
+        min_zoom, max_zoom = cur.execute("""SELECT min(zoom_level), max(zoom_level) FROM map""").fetchone()
+        for name, value in (('minzoom', min_zoom), ('maxzoom', max_zoom)):
+            cur.execute("""REPLACE INTO metadata (name, value) VALUES (?, ?)""", (name, str(value)))
+        con.commit()
+        con.close()
+
+
+def write_shards(tile_queue, result_queue, options):
+    """Writer process for split_mbtiles: writes the chunks of (z, x, y,
+    tile_id, tile_data) of (mbtiles_file, chunk) from tile_queue until None,
+    with tile_data None for images already sent, keeping at most
+    open_shards_per_writer files open. Puts the list of (mbtiles_file, count,
+    error) of its shards into result_queue."""
+    shards = collections.OrderedDict()
+    errors = {}
+
+    def write(mbtiles_file, chunk):
+        shard = shards.pop(mbtiles_file, None)
+        if shard is None:
+            shard = ShardFile(mbtiles_file, options)
+        # The most recently used last
+        shards[mbtiles_file] = shard
+        if shard.con is None:
+            open_shards = [s for s in shards.values() if s.con is not None]
+            for s in open_shards[:max(0, len(open_shards) - open_shards_per_writer + 1)]:
+                close(s)
+            shard.open()
+        for z, x, y, tile_id, tile_data in chunk:
+            shard.writer.add(z, x, y, tile_data, tile_id)
+
+    def close(shard):
+        try:
+            shard.close()
+        except Exception, e:
+            errors.setdefault(shard.mbtiles_file, str(e))
+
+    # Keep reading after an error, the splitting process must never block on a shard
+    item = tile_queue.get()
+    while item is not None:
+        if item[0] not in errors:
+            try:
+                write(*item)
+            except Exception, e:
+                errors[item[0]] = str(e)
+                close(shards[item[0]])
+        item = tile_queue.get()
+
+    results = []
+    for shard in shards.values():
+        if shard.mbtiles_file not in errors:
+            try:
+                shard.close()
+                shard.finish()
+            except Exception, e:
+                errors[shard.mbtiles_file] = str(e)
+        results.append((shard.mbtiles_file, shard.count, errors.get(shard.mbtiles_file)))
+    result_queue.put(results)
+
+
+def split_mbtiles(mbtiles_file, directory_path, **kwargs):
+    """Splits mbtiles_file into compacted shards in directory_path, one per
+    zoom band (list of (min_zoom, max_zoom)) and/or per tile of grid_zoom,
+    reading mbtiles_file once. A shard of a grid tile also gets the tiles of
+    lower zoom levels overlapping it. The shards are written by poolsize
+    processes and only get the images their tiles use. Returns a dict of
+    the shard files and their number of tiles."""
+    logger.info("Splitting database: %s --> %s" % (mbtiles_file, directory_path))
+
+
+    zoom_bands = kwargs.get('zoom_bands')
+    grid_zoom  = kwargs.get('grid_zoom', -1)
+    batch_size = kwargs.get('batch_size', 1000)
+
+    zoom     = kwargs.get('zoom', -1)
+    min_zoom = kwargs.get('min_zoom', 0)
+    max_zoom = kwargs.get('max_zoom', 255)
+
+    if zoom >= 0:
+        min_zoom = max_zoom = zoom
+
+    if not zoom_bands and grid_zoom < 0:
+        sys.stderr.write('To split a mbtiles database, it needs zoom bands or a grid zoom level\n')
+        sys.exit(1)
+
+    if zoom_bands:
+        min_zoom = max(min_zoom, min([band[0] for band in zoom_bands]))
+        max_zoom = min(max_zoom, max([band[1] for band in zoom_bands]))
+
+    condition, params = tile_range_condition(min_zoom, max_zoom, bbox=kwargs.get('bbox'))
+
+
+    con = mbtiles_connect(mbtiles_file)
+    cur = con.cursor()
+    optimize_connection(cur)
+
+    metadata = con.execute("""SELECT name, value FROM metadata""").fetchall()
+    compacted = (con.execute("SELECT count(name) FROM sqlite_master WHERE type='table' AND name='images'").fetchone()[0] > 0)
+    if compacted:
+        # Copying the tile_ids keeps the input's layout, page size and recorded hash
+        layout = 'optimized' if optimized_layout(cur) else 'standard'
+        page_size = con.execute("""PRAGMA page_size""").fetchone()[0]
+    else:
+        layout = kwargs.get('layout', 'standard')
+        page_size = kwargs.get('page_size')
+        hash_name = database_tile_id_hash(cur)
+        tile_id_function = tile_id_hash(hash_name, layout == 'optimized')
+        metadata = [(name, value) for name, value in metadata if name != 'tile_id_hash'] + [('tile_id_hash', hash_name)]
+
+    options = {
+        'layout' : layout,
+        'page_size' : page_size,
+        'batch_size' : batch_size,
+        'metadata' : metadata
+    }
+
+    total_tiles = con.execute("""SELECT count(*) FROM tiles WHERE %s""" % (condition),
+        params).fetchone()[0]
+
+    if not os.path.isdir(directory_path):
+        os.makedirs(directory_path)
+
+
+    pool_size = kwargs.get('poolsize', -1)
+    if pool_size < 1:
+        pool_size = multiprocessing.cpu_count()
+
+    # The writer processes and their queues, started when a shard is routed to them
+    writers = [None] * pool_size
+    result_queue = multiprocessing.Queue()
+
+    def check_writers():
+        for writer in writers:
+            if writer is not None and writer[0].exitcode not in (None, 0):
+                sys.stderr.write("A shard writer exited with code %s\n" % (writer[0].exitcode))
+                sys.exit(1)
+
+    def send(writer, item):
+        # A writer which died would never empty its queue
+        while True:
+            try:
+                writer[1].put(item, timeout=1)
+                return
+            except Queue.Full:
+                check_writers()
+
+    shards = {}
+
+    def shard(key):
+        s = shards.get(key)
+        if s is None:
+            shard_file = os.path.join(directory_path, shard_name(*key))
+            i = (zlib.crc32(shard_file) & 0xffffffff) % pool_size
+            if writers[i] is None:
+                tile_queue = multiprocessing.Queue(16)
+                writer = multiprocessing.Process(target=write_shards, args=(tile_queue, result_queue, options))
+                writer.daemon = True
+                writer.start()
+                writers[i] = (writer, tile_queue)
+            # The writer, the file, the pending chunk and the tile_ids it already got
+            s = shards[key] = [writers[i], shard_file, [], set()]
+        return s
+
+    # The grid tiles with tiles at grid_zoom or above, lower tiles are
+    # routed to the ones they overlap
+    cells = set()
+    overlapping_cells = {}
+
+    def tile_shards(z, x, y):
+        bands = [band for band in zoom_bands if band[0] <= z <= band[1]] if zoom_bands else [None]
+        if grid_zoom < 0:
+            return [(band, None) for band in bands]
+        if z >= grid_zoom:
+            cell = (grid_zoom, x >> (z - grid_zoom), y >> (z - grid_zoom))
+            if bands:
+                cells.add(cell)
+            return [(band, cell) for band in bands]
+        if z not in overlapping_cells:
+            overlapping_cells[z] = {}
+            for cell in cells:
+                overlapping_cells[z].setdefault((cell[1] >> (grid_zoom - z), cell[2] >> (grid_zoom - z)), []).append(cell)
+        return [(band, cell) for band in bands for cell in overlapping_cells[z].get((x, y), [])]
+
+
+    metrics = get_metrics(**kwargs)
+    metrics.start('split', total_tiles, mbtiles_file)
+
+    # With a grid, the highest zoom levels first so that all grid tiles are
+    # known before the lower tiles
+    order = "ORDER BY zoom_level DESC" if grid_zoom >= 0 else ""
+    if compacted:
+        tiles = cur.execute("""SELECT zoom_level, tile_column, tile_row, tile_id FROM map WHERE %s %s""" % (condition, order),
+            params)
+    else:
+        tiles = cur.execute("""SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles WHERE %s %s""" % (condition, order),
+            params)
+
+    image_cur = con.cursor()
+    start_time = time.time()
+    rows = tiles.fetchmany(1000)
+    start_time = metrics.time('read', start_time)
+    while rows:
+        for t in rows:
+            z, x, y = t[0], t[1], t[2]
+            targets = [shard(key) for key in tile_shards(z, x, y)]
+            if not targets:
+                continue
+
+            if compacted:
+                tile_id, tile_data = read_tile_id(t[3]), None
+            else:
+                tile_data = str(t[3])
+                tile_id = tile_id_function(tile_data)
+
+            # The image is read once for all shards which don't have it yet
+            for s in targets:
+                data = None
+                if tile_id not in s[3]:
+                    s[3].add(tile_id)
+                    if tile_data is None:
+                        tile_data = str(image_cur.execute("""SELECT tile_data FROM images WHERE tile_id=?""", (t[3], )).fetchone()[0])
+                        metrics.add('bytes_read', len(tile_data))
+                    data = tile_data
+                else:
+                    metrics.add('duplicates')
+
+                s[2].append((z, x, y, tile_id, data))
+                if len(s[2]) >= batch_size:
+                    send(s[0], (s[1], s[2]))
+                    s[2] = []
+
+            metrics.tiles()
+
+        rows = tiles.fetchmany(1000)
+        start_time = metrics.time('read', start_time)
+
+    con.close()
+
+    for s in shards.values():
+        if s[2]:
+            send(s[0], (s[1], s[2]))
+    running = [writer for writer in writers if writer is not None]
+    for writer in running:
+        send(writer, None)
+
+    counts = {}
+    errors = []
+    received = 0
+    while received < len(running):
+        try:
+            results = result_queue.get(timeout=1)
+        except Queue.Empty:
+            check_writers()
+            continue
+        received += 1
+        for shard_file, count, error in results:
+            if error:
+                errors.append("%s: %s" % (shard_file, error))
+            counts[shard_file] = count
+    for writer in running:
+        writer[0].join()
+    metrics.finish()
+
+    if errors:
+        sys.stderr.write("Could not write the shards:\n%s\n" % ('\n'.join(errors)))
+        sys.exit(1)
+
+    logger.info("%d tiles split into %d shards" % (sum(counts.values()), len(counts)))
+    return counts
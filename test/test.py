@@ -1,6 +1,8 @@
-import os, shutil
+import os, shutil, sqlite3, zlib, hashlib, json, threading, httplib, tarfile, zipfile, signal, multiprocessing, StringIO
 from nose import with_setup
-from mbutil import mbtiles_to_disk, disk_to_mbtiles
+from mbutil import mbtiles_to_disk, disk_to_mbtiles, execute_commands_on_mbtiles, TileCache, mbtiles_create, merge_mbtiles, merge_mbtiles_many, check_mbtiles, compact_mbtiles, checkpoint_prepare, add_checkpoints, compaction_prepare, TileIndex, create_tile_server, mbtiles_to_archive, archive_to_mbtiles, Metrics, delete_mbtiles, gc_mbtiles, reorder_mbtiles, hilbert_key, bbox_tile_range, split_mbtiles, database_tile_id_hash
+from mbutil.util import blake2b
+import mbutil.util_split
 
 def clear_data():
     try: shutil.rmtree('test/output')
@@ -22,3 +24,648 @@ def test_mbtiles_to_disk_and_back():
     disk_to_mbtiles('test/output', 'test/output/one.mbtiles')
     assert os.path.exists('test/output/one.mbtiles')
 
+
+@with_setup(clear_data, clear_data)
+def test_mbtiles_to_archive():
+    os.mkdir('test/output')
+    mbtiles_to_disk('test/data/one_tile.mbtiles', 'test/output/dir', flip_y=True)
+    expected = dict([('tiles/%s' % (os.path.relpath(os.path.join(root, f), 'test/output/dir/tiles')), open(os.path.join(root, f), 'rb').read())
+        for root, dirs, files in os.walk('test/output/dir/tiles') for f in files])
+    for archive_file in ('test/output/tiles.tar', 'test/output/tiles.tar.gz', 'test/output/tiles.tbz2', 'test/output/tiles.zip'):
+        mbtiles_to_archive('test/data/one_tile.mbtiles', archive_file, flip_y=True)
+        if archive_file.endswith('.zip'):
+            archive = zipfile.ZipFile(archive_file)
+            files = dict([(name, archive.read(name)) for name in archive.namelist()])
+        else:
+            archive = tarfile.open(archive_file)
+            files = dict([(member.name, archive.extractfile(member).read()) for member in archive.getmembers()])
+        archive.close()
+        if archive_file.endswith('.tbz2'):
+            assert open(archive_file, 'rb').read(3) == 'BZh'
+        assert json.loads(files.pop('metadata.json'))['name'] == 'shadowplay'
+        assert files == expected
+
+@with_setup(clear_data, clear_data)
+def test_archive_to_mbtiles():
+    os.mkdir('test/output')
+    con = sqlite3.connect('test/data/one_tile.mbtiles')
+    tiles = con.execute("SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles ORDER BY 1, 2, 3").fetchall()
+    con.close()
+    for archive_file in ('test/output/tiles.tar.gz', 'test/output/tiles.tar.bz2', 'test/output/tiles.zip'):
+        mbtiles_to_archive('test/data/one_tile.mbtiles', archive_file, flip_y=True)
+        mbtiles_file = archive_file + '.mbtiles'
+        archive_to_mbtiles(archive_file, mbtiles_file, flip_y=True, batch_size=1)
+        con = sqlite3.connect(mbtiles_file)
+        assert con.execute("SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles ORDER BY 1, 2, 3").fetchall() == tiles
+        assert con.execute("SELECT value FROM metadata WHERE name='name'").fetchone()[0] == 'shadowplay'
+        con.close()
+
+@with_setup(clear_data, clear_data)
+def test_archive_to_mbtiles_format_mismatch():
+    os.mkdir('test/output')
+    shutil.copy('test/data/one_tile.mbtiles', 'test/output/one.mbtiles')
+    con = sqlite3.connect('test/output/one.mbtiles')
+    con.execute("INSERT INTO metadata (name, value) VALUES ('format', 'png')")
+    con.commit()
+    con.close()
+    archive = tarfile.open('test/output/tiles.tar', 'w')
+    # metadata.json after the tiles
+    for name, data in (('tiles/2/0/0.jpg', 'jpg'), ('metadata.json', json.dumps({'format' : 'jpg'}))):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        archive.addfile(info, StringIO.StringIO(data))
+    archive.close()
+    try:
+        archive_to_mbtiles('test/output/tiles.tar', 'test/output/one.mbtiles', batch_size=1)
+        assert False
+    except SystemExit:
+        pass
+    con = sqlite3.connect('test/output/one.mbtiles')
+    assert con.execute("SELECT count(*) FROM tiles").fetchone()[0] == 2
+    # A fresh database checks the tiles against metadata.json and each other
+    for i, members in enumerate([
+            (('tiles/2/0/0.png', 'png'), ('tiles/2/0/1.jpg', 'jpg')),
+            (('metadata.json', json.dumps({'format' : 'jpg'})), ('tiles/2/0/0.png', 'png')),
+            (('tiles/2/0/0.png', 'png'), ('metadata.json', json.dumps({'format' : 'jpg'})))]):
+        archive_file = 'test/output/fresh_%d.tar' % (i)
+        archive = tarfile.open(archive_file, 'w')
+        for name, data in members:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            archive.addfile(info, StringIO.StringIO(data))
+        archive.close()
+        try:
+            archive_to_mbtiles(archive_file, 'test/output/fresh_%d.mbtiles' % (i))
+            assert False
+        except SystemExit:
+            pass
+
+@with_setup(clear_data, clear_data)
+def test_disk_to_mbtiles_batched():
+    mbtiles_to_disk('test/data/one_tile.mbtiles', 'test/output')
+    disk_to_mbtiles('test/output', 'test/output/one.mbtiles', batch_size=1, auto_commit=True)
+    source_tiles = sqlite3.connect('test/data/one_tile.mbtiles').execute("SELECT count(*) FROM tiles").fetchone()[0]
+    con = sqlite3.connect('test/output/one.mbtiles')
+    assert con.execute("SELECT count(*) FROM tiles").fetchone()[0] == source_tiles
+
+@with_setup(clear_data, clear_data)
+def test_disk_to_mbtiles_flip_y():
+    mbtiles_to_disk('test/data/one_tile.mbtiles', 'test/output', flip_y=True)
+    disk_to_mbtiles('test/output', 'test/output/one.mbtiles', flip_y=True, workers=2)
+    source = sqlite3.connect('test/data/one_tile.mbtiles').execute("SELECT zoom_level, tile_column, tile_row FROM tiles ORDER BY 1, 2, 3").fetchall()
+    con = sqlite3.connect('test/output/one.mbtiles')
+    assert con.execute("SELECT zoom_level, tile_column, tile_row FROM tiles ORDER BY 1, 2, 3").fetchall() == source
+
+@with_setup(clear_data, clear_data)
+def test_mbtiles_to_disk_workers():
+    mbtiles_to_disk('test/data/one_tile.mbtiles', 'test/output', workers=3)
+    con = sqlite3.connect('test/data/one_tile.mbtiles')
+    for z, x, y, tile_data in con.execute("SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles"):
+        assert open('test/output/tiles/%d/%d/%d.png' % (z, x, y), 'rb').read() == str(tile_data)
+
+@with_setup(clear_data, clear_data)
+def test_mbtiles_to_disk_link_duplicates():
+    mbtiles_to_disk('test/data/one_tile.mbtiles', 'test/output/plain')
+    disk_to_mbtiles('test/output/plain', 'test/output/one.mbtiles')
+    con = sqlite3.connect('test/output/one.mbtiles')
+    con.execute("INSERT INTO map (zoom_level, tile_column, tile_row, tile_id) SELECT 1, 1, 1, tile_id FROM map WHERE zoom_level=0")
+    con.commit()
+    con.close()
+    mbtiles_to_disk('test/output/one.mbtiles', 'test/output/linked', link_duplicates='hardlink')
+    assert os.path.samefile('test/output/linked/tiles/0/0/0.png', 'test/output/linked/tiles/1/1/1.png')
+    assert open('test/output/linked/tiles/1/0/1.png', 'rb').read() == open('test/output/plain/tiles/1/0/1.png', 'rb').read()
+    # Writing a linked tile again must not change the tiles sharing its inode
+    mbtiles_to_disk('test/output/one.mbtiles', 'test/output/linked', zoom=0, transform_list=['zlib:compress'])
+    assert open('test/output/linked/tiles/0/0/0.png', 'rb').read() == zlib.compress(open('test/output/plain/tiles/0/0/0.png', 'rb').read())
+    assert open('test/output/linked/tiles/1/1/1.png', 'rb').read() == open('test/output/plain/tiles/0/0/0.png', 'rb').read()
+
+@with_setup(clear_data, clear_data)
+def test_execute_transform_on_mbtiles():
+    mbtiles_to_disk('test/data/one_tile.mbtiles', 'test/output')
+    disk_to_mbtiles('test/output', 'test/output/one.mbtiles')
+    execute_commands_on_mbtiles('test/output/one.mbtiles', transform_list=['zlib:compress'], poolsize=2)
+    source = sqlite3.connect('test/data/one_tile.mbtiles').execute("SELECT tile_data FROM tiles WHERE zoom_level=0").fetchone()[0]
+    con = sqlite3.connect('test/output/one.mbtiles')
+    assert str(con.execute("SELECT tile_data FROM tiles WHERE zoom_level=0").fetchone()[0]) == zlib.compress(str(source))
+
+@with_setup(clear_data, clear_data)
+def test_execute_pipe_on_mbtiles():
+    mbtiles_to_disk('test/data/one_tile.mbtiles', 'test/output')
+    disk_to_mbtiles('test/output', 'test/output/one.mbtiles')
+    execute_commands_on_mbtiles('test/output/one.mbtiles', pipe_list=['head -c 10'], poolsize=2)
+    source = sqlite3.connect('test/data/one_tile.mbtiles').execute("SELECT tile_data FROM tiles WHERE zoom_level=0").fetchone()[0]
+    con = sqlite3.connect('test/output/one.mbtiles')
+    assert str(con.execute("SELECT tile_data FROM tiles WHERE zoom_level=0").fetchone()[0]) == str(source)[:10]
+
+@with_setup(clear_data, clear_data)
+def test_tile_cache():
+    mbtiles_to_disk('test/data/one_tile.mbtiles', 'test/output')
+    disk_to_mbtiles('test/output', 'test/output/one.mbtiles')
+    execute_commands_on_mbtiles('test/output/one.mbtiles', transform_list=['zlib:compress'], cache_file='test/output/cache.db')
+    cache = TileCache('test/output/cache.db', transform_list=['zlib:compress'], max_size=1)
+    tile_data = str(sqlite3.connect('test/data/one_tile.mbtiles').execute("SELECT tile_data FROM tiles LIMIT 1").fetchone()[0])
+    tile_id = hashlib.md5(tile_data).hexdigest()
+    assert cache.get(tile_id) == zlib.compress(str(tile_data))
+    cache.evict()
+    assert cache.get(tile_id) is None
+    cache.close()
+
+@with_setup(clear_data, clear_data)
+def test_tile_cache_key():
+    os.mkdir('test/output')
+    # Two databases recording different images under the same tile_id
+    for name, tile_data in (('x', 'x'), ('y', 'y')):
+        mbtiles_file = 'test/output/%s.mbtiles' % (name)
+        create_mbtiles_with_tile(mbtiles_file, 0, 0, 0, tile_data)
+        con = sqlite3.connect(mbtiles_file)
+        con.execute("UPDATE images SET tile_id='same'")
+        con.execute("UPDATE map SET tile_id='same'")
+        con.commit()
+        con.close()
+        execute_commands_on_mbtiles(mbtiles_file, transform_list=['zlib:compress'], cache_file='test/output/cache.db')
+        con = sqlite3.connect(mbtiles_file)
+        assert str(con.execute("SELECT tile_data FROM tiles").fetchone()[0]) == zlib.compress(tile_data)
+    assert TileCache('test/output/cache2.db', transform_list=['zlib:compress']).pipeline_id != \
+        TileCache('test/output/cache2.db', transform_list=['zlib:compress'], image_format='jpg').pipeline_id
+
+@with_setup(clear_data, clear_data)
+def test_compact_mbtiles_cache():
+    os.mkdir('test/output')
+    tiles = [(1, x, y, 'tile %d %d' % (x, y)) for x in range(2) for y in range(2)]
+    create_flat_mbtiles('test/output/flat.mbtiles', tiles)
+    compact_mbtiles('test/output/flat.mbtiles', transform_list=['zlib:compress'], cache_file='test/output/cache.db', poolsize=2)
+    con = sqlite3.connect('test/output/flat.mbtiles')
+    assert [(z, x, y, str(tile_data)) for z, x, y, tile_data in con.execute("SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles ORDER BY 1, 2, 3")] == \
+        [(z, x, y, zlib.compress(tile_data)) for z, x, y, tile_data in tiles]
+    # Committed without closing the cache
+    cache = TileCache('test/output/cache2.db', transform_list=['zlib:compress'], commit_size=2)
+    cache.put('a', 'x')
+    cache.put('b', 'y')
+    assert sqlite3.connect('test/output/cache2.db').execute("SELECT count(*) FROM results").fetchone()[0] == 2
+    # Putting a result again replaces its size
+    cache.put('a', 'xx')
+    assert cache.size == 3
+    cache.close()
+    assert sqlite3.connect('test/output/cache.db').execute("SELECT count(*) FROM results").fetchone()[0] == 4
+
+@with_setup(clear_data, clear_data)
+def test_merge_mbtiles_sql():
+    os.mkdir('test/output')
+    # Merging switches the sending database to WAL
+    shutil.copy('test/data/one_tile.mbtiles', 'test/output/one_tile.mbtiles')
+    results = []
+    for sql_merge in (True, False):
+        mbtiles_file = 'test/output/merged_%s.mbtiles' % (sql_merge)
+        mbtiles_create(mbtiles_file)
+        con = sqlite3.connect(mbtiles_file)
+        con.execute("INSERT INTO images (tile_id, tile_data) VALUES (?, ?)", (hashlib.md5('x').hexdigest(), sqlite3.Binary('x')))
+        con.execute("INSERT INTO map (zoom_level, tile_column, tile_row, tile_id) VALUES (0, 0, 0, ?)", (hashlib.md5('x').hexdigest(), ))
+        con.commit()
+        con.close()
+        # The fixture doesn't record the hash of its tile_ids
+        merge_mbtiles(mbtiles_file, 'test/output/one_tile.mbtiles', no_overwrite=True, sql_merge=sql_merge, trust_tile_ids=sql_merge, command_list=None)
+        con = sqlite3.connect(mbtiles_file)
+        results.append(con.execute("SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles ORDER BY 1, 2, 3").fetchall())
+    assert len(results[0]) == 2
+    assert str(results[0][0][3]) == 'x'
+    assert results[0] == results[1]
+
+@with_setup(clear_data, clear_data)
+def test_merge_mbtiles_foreign_tile_ids():
+    os.mkdir('test/output')
+    create_mbtiles_with_tile('test/output/merged.mbtiles', 0, 0, 0, 'x')
+    # A tile_id which isn't the hash of its image clashes with the receiver's 'x'
+    mbtiles_create('test/output/foreign.mbtiles')
+    con = sqlite3.connect('test/output/foreign.mbtiles')
+    con.execute("DELETE FROM metadata WHERE name='tile_id_hash'")
+    con.execute("INSERT INTO images (tile_id, tile_data) VALUES (?, ?)", (hashlib.md5('x').hexdigest(), sqlite3.Binary('y')))
+    con.execute("INSERT INTO map (zoom_level, tile_column, tile_row, tile_id) VALUES (1, 0, 0, ?)", (hashlib.md5('x').hexdigest(), ))
+    con.commit()
+    con.close()
+    shutil.copy('test/output/merged.mbtiles', 'test/output/merged_many.mbtiles')
+    shutil.copy('test/output/foreign.mbtiles', 'test/output/foreign2.mbtiles')
+    merge_mbtiles('test/output/merged.mbtiles', 'test/output/foreign.mbtiles')
+    merge_mbtiles_many('test/output/merged_many.mbtiles', ['test/output/foreign.mbtiles', 'test/output/foreign2.mbtiles'], poolsize=2)
+    for mbtiles_file in ('test/output/merged.mbtiles', 'test/output/merged_many.mbtiles'):
+        con = sqlite3.connect(mbtiles_file)
+        assert [(z, x, y, str(tile_data)) for z, x, y, tile_data in con.execute("SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles ORDER BY 1, 2, 3")] == \
+            [(0, 0, 0, 'x'), (1, 0, 0, 'y')]
+        con.close()
+
+def create_mbtiles_with_tile(mbtiles_file, z, x, y, tile_data):
+    mbtiles_create(mbtiles_file)
+    con = sqlite3.connect(mbtiles_file)
+    con.execute("INSERT INTO images (tile_id, tile_data) VALUES (?, ?)", (hashlib.md5(tile_data).hexdigest(), sqlite3.Binary(tile_data)))
+    con.execute("INSERT INTO map (zoom_level, tile_column, tile_row, tile_id) VALUES (?, ?, ?, ?)", (z, x, y, hashlib.md5(tile_data).hexdigest()))
+    con.commit()
+    con.close()
+
+@with_setup(clear_data, clear_data)
+def test_merge_mbtiles_many():
+    os.mkdir('test/output')
+    create_mbtiles_with_tile('test/output/x.mbtiles', 0, 0, 0, 'x')
+    # Reading switches the sending databases to WAL
+    shutil.copy('test/data/one_tile.mbtiles', 'test/output/one_tile.mbtiles')
+    for sources, kwargs, expected in [
+            (['test/output/one_tile.mbtiles', 'test/output/x.mbtiles'], {}, 'x'),
+            (['test/output/x.mbtiles', 'test/output/one_tile.mbtiles'], {'sql_merge': False}, None),
+            (['test/output/x.mbtiles', 'test/output/one_tile.mbtiles'], {'no_overwrite': True}, 'x')]:
+        mbtiles_create('test/output/merged.mbtiles')
+        merge_mbtiles_many('test/output/merged.mbtiles', sources, poolsize=2, **kwargs)
+        con = sqlite3.connect('test/output/merged.mbtiles')
+        tiles = con.execute("SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles ORDER BY 1, 2, 3").fetchall()
+        con.close()
+        os.remove('test/output/merged.mbtiles')
+        assert len(tiles) == 2
+        assert (str(tiles[0][3]) == 'x') == (expected == 'x')
+
+@with_setup(clear_data, clear_data)
+def test_merge_mbtiles_many_skipped_image():
+    os.mkdir('test/output')
+    create_mbtiles_with_tile('test/output/x.mbtiles', 0, 0, 0, 'x')
+    create_mbtiles_with_tile('test/output/merged.mbtiles', 1, 0, 0, 'old')
+    # Both tiles use one image, which comes with the skipped (1, 0, 0)
+    create_flat_mbtiles('test/output/flat.mbtiles', [(1, 0, 1, 'y'), (1, 1, 1, 'y')])
+    merge_mbtiles_many('test/output/merged.mbtiles', ['test/output/flat.mbtiles', 'test/output/x.mbtiles'], poolsize=2,
+        no_overwrite=True, flip_y=True, transform_list=['zlib:compress'])
+    con = sqlite3.connect('test/output/merged.mbtiles')
+    assert [(z, x, y, str(tile_data)) for z, x, y, tile_data in con.execute("SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles ORDER BY 1, 2, 3")] == \
+        [(0, 0, 0, zlib.compress('x')), (1, 0, 0, 'old'), (1, 1, 0, zlib.compress('y'))]
+    con.close()
+
+@with_setup(clear_data, clear_data)
+def test_tile_index():
+    os.mkdir('test/output')
+    # Zoom level 3 is dense (bitmap), zoom level 20 sparse (sorted array)
+    tiles = [(3, x, y, 'x') for x in range(8) for y in range(8) if (x + y) % 3] + [(20, 5, 1000000, 'x'), (20, 900000, 7, 'x')]
+    create_flat_mbtiles('test/output/index.mbtiles', tiles)
+    index = TileIndex('test/output/index.mbtiles')
+    for z, x, y in [(3, x, y) for x in range(-1, 10) for y in range(-1, 10)] + [(20, 5, 1000000), (20, 900000, 7), (20, 5, 7), (4, 0, 0)]:
+        assert index.contains(z, x, y) == ((z, x, y, 'x') in tiles)
+    index.add(3, 0, 0)
+    index.add(20, 5, 7)
+    index.add(5, 1, 1)
+    assert index.contains(3, 0, 0) and index.contains(20, 5, 7) and index.contains(5, 1, 1)
+    assert not index.contains(5, 1, 2)
+    index.close()
+
+@with_setup(clear_data, clear_data)
+def test_check_mbtiles():
+    os.mkdir('test/output')
+    assert check_mbtiles('test/data/one_tile.mbtiles')
+    create_mbtiles_with_tile('test/output/gaps.mbtiles', 2, 0, 0, 'x')
+    con = sqlite3.connect('test/output/gaps.mbtiles')
+    con.executemany("INSERT INTO map (zoom_level, tile_column, tile_row, tile_id) VALUES (2, ?, ?, ?)",
+        [(0, 3, hashlib.md5('x').hexdigest()), (3, 1, hashlib.md5('x').hexdigest())])
+    con.commit()
+    con.close()
+    assert not check_mbtiles('test/output/gaps.mbtiles', check_output='test/output/check.json')
+    coverage = json.load(open('test/output/check.json'))['zoom_levels']['2']
+    assert coverage['missing'] == 13
+    assert coverage['missing_ranges'] == [[0, 1, 2], [1, 0, 3], [2, 0, 3], [3, 0, 0], [3, 2, 3]]
+    # The log only gets the first ranges, --check-output all of them
+    create_flat_mbtiles('test/output/sparse.mbtiles', [(8, x, 0, 'x') for x in range(0, 60, 2)])
+    assert not check_mbtiles('test/output/sparse.mbtiles', check_output='test/output/sparse.json')
+    coverage = json.load(open('test/output/sparse.json'))['zoom_levels']['8']
+    assert coverage['missing'] == 29 and coverage['missing_range_count'] == 29
+    assert coverage['missing_ranges'] == [[x, 0, 0] for x in range(1, 58, 2)]
+
+def create_flat_mbtiles(mbtiles_file, tiles):
+    con = sqlite3.connect(mbtiles_file)
+    con.execute("CREATE TABLE metadata (name TEXT, value TEXT)")
+    con.execute("CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB)")
+    con.executemany("INSERT INTO tiles (zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?)",
+        [(z, x, y, sqlite3.Binary(tile_data)) for z, x, y, tile_data in tiles])
+    con.commit()
+    con.close()
+
+@with_setup(clear_data, clear_data)
+def test_compact_mbtiles():
+    os.mkdir('test/output')
+    tiles = [(1, x, y, 'x' if x == y else 'tile %d %d' % (x, y)) for x in range(2) for y in range(2)]
+    create_flat_mbtiles('test/output/flat.mbtiles', tiles)
+    compact_mbtiles('test/output/flat.mbtiles', batch_size=3)
+    con = sqlite3.connect('test/output/flat.mbtiles')
+    assert con.execute("SELECT count(*) FROM images").fetchone()[0] == 3
+    assert [(z, x, y, str(tile_data)) for z, x, y, tile_data in con.execute("SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles ORDER BY 1, 2, 3")] == tiles
+    assert all([tile_id == hashlib.md5(str(tile_data)).hexdigest() for tile_id, tile_data in con.execute("SELECT tile_id, tile_data FROM images")])
+
+@with_setup(clear_data, clear_data)
+def test_compact_mbtiles_hash():
+    os.mkdir('test/output')
+    create_flat_mbtiles('test/output/flat.mbtiles', [(0, 0, 0, 'x')])
+    con = sqlite3.connect('test/output/flat.mbtiles')
+    assert database_tile_id_hash(con.cursor()) == 'md5'
+    assert database_tile_id_hash(sqlite3.connect(':memory:').cursor()) == 'md5'
+    con.close()
+    if blake2b is None:
+        return
+    # Tiles merged or processed later use the hash of the database
+    compact_mbtiles('test/output/flat.mbtiles', tile_id_hash='blake2b')
+    create_flat_mbtiles('test/output/other.mbtiles', [(1, 0, 0, 'y')])
+    merge_mbtiles('test/output/flat.mbtiles', 'test/output/other.mbtiles')
+    con = sqlite3.connect('test/output/flat.mbtiles')
+    assert database_tile_id_hash(con.cursor()) == 'blake2b'
+    assert all([tile_id == blake2b(str(tile_data), digest_size=16).hexdigest() for tile_id, tile_data in con.execute("SELECT tile_id, tile_data FROM images")])
+
+@with_setup(clear_data, clear_data)
+def test_execute_transform_in_flight():
+    os.mkdir('test/output')
+    tiles = [(2, x, y, 'x' if x == y else 'tile %d %d' % (x, y)) for x in range(4) for y in range(4)]
+    # Already the result of processing 'x'
+    tiles.append((3, 0, 0, zlib.compress('x')))
+    create_flat_mbtiles('test/output/flat.mbtiles', tiles)
+    compact_mbtiles('test/output/flat.mbtiles')
+    execute_commands_on_mbtiles('test/output/flat.mbtiles', transform_list=['zlib:compress'], poolsize=2, in_flight=1)
+    con = sqlite3.connect('test/output/flat.mbtiles')
+    assert [(z, x, y, str(tile_data)) for z, x, y, tile_data in con.execute("SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles ORDER BY 1, 2, 3")] == \
+        [(z, x, y, zlib.compress(tile_data)) for z, x, y, tile_data in tiles]
+    assert con.execute("SELECT count(*) FROM images").fetchone()[0] == 14
+    assert con.execute("SELECT count(*) FROM sqlite_master WHERE name IN ('tile_id_remap', 'checkpoints')").fetchone()[0] == 0
+
+@with_setup(clear_data, clear_data)
+def test_delete_mbtiles():
+    os.mkdir('test/output')
+    tiles = [(1, x, y, 'x' if x == y else 'tile %d %d' % (x, y)) for x in range(2) for y in range(2)] + [(2, 0, 0, 'x')]
+    create_flat_mbtiles('test/output/flat.mbtiles', tiles)
+    compact_mbtiles('test/output/flat.mbtiles')
+    delete_mbtiles('test/output/flat.mbtiles', zoom=1, tile_range=(0, 0, 1, 0), batch_size=1)
+    con = sqlite3.connect('test/output/flat.mbtiles')
+    assert con.execute("SELECT zoom_level, tile_column, tile_row FROM tiles ORDER BY 1, 2, 3").fetchall() == [(1, 0, 1), (1, 1, 1), (2, 0, 0)]
+    # 'x' is still used by (1, 1, 1) and (2, 0, 0)
+    assert sorted([str(r[0]) for r in con.execute("SELECT tile_data FROM images")]) == ['tile 0 1', 'x']
+
+@with_setup(clear_data, clear_data)
+def test_bbox():
+    os.mkdir('test/output')
+    # The north-east quarter of the world
+    bbox = (1.0, 1.0, 179.0, 80.0)
+    assert bbox_tile_range(2, bbox) == (2, 2, 3, 3)
+    assert bbox_tile_range(2, bbox, xyz=True) == (2, 0, 3, 1)
+    inside = [(2, x, y) for x in range(2, 4) for y in range(2, 4)]
+    tiles = [(2, x, y, 'tile %d %d' % (x, y)) for x in range(4) for y in range(4)]
+    create_flat_mbtiles('test/output/flat.mbtiles', tiles)
+    compact_mbtiles('test/output/flat.mbtiles')
+    mbtiles_to_disk('test/output/flat.mbtiles', 'test/output/dir', bbox=bbox)
+    assert sorted([os.path.join(root, f) for root, dirs, files in os.walk('test/output/dir/tiles') for f in files]) == \
+        ['test/output/dir/tiles/%d/%d/%d.png' % t for t in inside]
+    execute_commands_on_mbtiles('test/output/flat.mbtiles', transform_list=['zlib:compress'], bbox=bbox)
+    con = sqlite3.connect('test/output/flat.mbtiles')
+    assert [(z, x, y, str(tile_data)) for z, x, y, tile_data in con.execute("SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles ORDER BY 1, 2, 3")] == \
+        [(z, x, y, zlib.compress(tile_data) if (z, x, y) in inside else tile_data) for z, x, y, tile_data in tiles]
+    con.close()
+    assert check_mbtiles('test/output/flat.mbtiles', bbox=bbox)
+    delete_mbtiles('test/output/flat.mbtiles', bbox=(1.0, 1.0, 80.0, 60.0))
+    con = sqlite3.connect('test/output/flat.mbtiles')
+    assert con.execute("SELECT count(*) FROM tiles WHERE zoom_level=2 AND tile_column=2 AND tile_row=2").fetchone()[0] == 0
+    assert con.execute("SELECT count(*) FROM tiles").fetchone()[0] == 15
+    con.close()
+    assert not check_mbtiles('test/output/flat.mbtiles', bbox=bbox)
+
+@with_setup(clear_data, clear_data)
+def test_gc_mbtiles():
+    os.mkdir('test/output')
+    tiles = [(1, x, y, 'tile %d %d' % (x, y)) for x in range(2) for y in range(2)]
+    create_flat_mbtiles('test/output/flat.mbtiles', tiles)
+    compact_mbtiles('test/output/flat.mbtiles')
+    con = sqlite3.connect('test/output/flat.mbtiles')
+    con.executemany("INSERT INTO images (tile_id, tile_data) VALUES (?, ?)", [('orphan %d' % (i), sqlite3.Binary('o' * 10000)) for i in range(10)])
+    con.commit()
+    con.isolation_level = None
+    con.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    con.execute("VACUUM")
+    con.close()
+    gc_mbtiles('test/output/flat.mbtiles', batch_size=3, incremental_vacuum=True)
+    con = sqlite3.connect('test/output/flat.mbtiles')
+    assert con.execute("SELECT count(*) FROM images").fetchone()[0] == 4
+    assert con.execute("SELECT count(*) FROM tiles").fetchone()[0] == 4
+    assert con.execute("PRAGMA freelist_count").fetchone()[0] == 0
+
+@with_setup(clear_data, clear_data)
+def test_optimized_layout():
+    os.mkdir('test/output')
+    tiles = [(1, x, y, 'x' if x == y else 'tile %d %d' % (x, y)) for x in range(2) for y in range(2)]
+    create_flat_mbtiles('test/output/flat.mbtiles', tiles)
+    mbtiles_to_disk('test/output/flat.mbtiles', 'test/output/dir')
+    disk_to_mbtiles('test/output/dir', 'test/output/optimized.mbtiles', layout='optimized')
+    con = sqlite3.connect('test/output/optimized.mbtiles')
+    assert 'WITHOUT ROWID' in con.execute("SELECT sql FROM sqlite_master WHERE name='map'").fetchone()[0]
+    assert (con.execute("PRAGMA page_size").fetchone()[0], con.execute("PRAGMA auto_vacuum").fetchone()[0]) == (16384, 2)
+    assert con.execute("SELECT tile_id FROM images WHERE tile_data=?", (sqlite3.Binary('x'), )).fetchone()[0] == buffer(hashlib.md5('x').digest())
+    con.close()
+    merge_mbtiles('test/output/optimized.mbtiles', 'test/data/one_tile.mbtiles', transform_list=['zlib:compress'])
+    delete_mbtiles('test/output/optimized.mbtiles', zoom=1, tile_range=(0, 0, 0, 1))
+    con = sqlite3.connect('test/output/optimized.mbtiles')
+    result = con.execute("SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles ORDER BY 1, 2, 3").fetchall()
+    assert [(z, x, y, str(tile_data)) for z, x, y, tile_data in result[1:]] == [t for t in tiles if t[1] == 1]
+    assert result[0][:3] == (0, 0, 0)
+    # The image of (1, 0, 1) replaced by the merge is left for --gc
+    assert con.execute("SELECT count(*) FROM images").fetchone()[0] == 4
+    con.close()
+    execute_commands_on_mbtiles('test/output/optimized.mbtiles', transform_list=['zlib:compress'], min_zoom=1)
+    con = sqlite3.connect('test/output/optimized.mbtiles')
+    result = con.execute("SELECT tile_data FROM tiles WHERE zoom_level=1 ORDER BY tile_column, tile_row").fetchall()
+    assert [zlib.decompress(t[0]) for t in result] == [t[3] for t in tiles if t[1] == 1]
+    con.close()
+    mbtiles_create('test/output/standard.mbtiles')
+    merge_mbtiles('test/output/standard.mbtiles', 'test/output/optimized.mbtiles', transform_list=['zlib:decompress'], min_zoom=1)
+    con = sqlite3.connect('test/output/standard.mbtiles')
+    result = con.execute("SELECT tile_column, tile_row, tile_id, tile_data FROM map JOIN images USING (tile_id) ORDER BY 1, 2").fetchall()
+    assert [(x, y, tile_id, str(tile_data)) for x, y, tile_id, tile_data in result] == [(x, y, hashlib.md5(tile_data).hexdigest(), tile_data) for z, x, y, tile_data in tiles if x == 1]
+
+@with_setup(clear_data, clear_data)
+def test_reorder_mbtiles():
+    os.mkdir('test/output')
+    tiles = [(2, x, y, 'x' if (x + y) % 3 == 0 else 'tile %d %d' % (x, y)) for x in range(4) for y in range(4)]
+    create_flat_mbtiles('test/output/flat.mbtiles', sorted(tiles, key=lambda t: hashlib.md5(t[3]).hexdigest()))
+    compact_mbtiles('test/output/flat.mbtiles')
+    pages_before, pages_after = reorder_mbtiles('test/output/flat.mbtiles', 'test/output/sorted.mbtiles')
+    assert pages_before is None or pages_after <= pages_before
+    con = sqlite3.connect('test/output/sorted.mbtiles')
+    result = con.execute("SELECT zoom_level, tile_column, tile_row, tile_data FROM map JOIN images USING (tile_id) ORDER BY map.rowid").fetchall()
+    assert [(z, x, y, str(tile_data)) for z, x, y, tile_data in result] == sorted(tiles, key=lambda t: hilbert_key(t[0], t[1], t[2]))
+    images = [str(t[0]) for t in con.execute("SELECT tile_data FROM images ORDER BY rowid")]
+    assert images == sorted(set(images), key=[str(t[3]) for t in result].index)
+
+@with_setup(clear_data, clear_data)
+def test_split_mbtiles():
+    os.mkdir('test/output')
+    tiles = [(0, 0, 0, 'x')] + [(1, x, y, 'x' if x == y else 'tile 1 %d %d' % (x, y)) for x in range(2) for y in range(2)] + \
+        [(2, x, y, 'tile 2 %d %d' % (x, y)) for x in range(2) for y in range(2)]
+    create_flat_mbtiles('test/output/flat.mbtiles', tiles)
+    compact_mbtiles('test/output/flat.mbtiles')
+    # One writer keeping two files open closes and opens them again
+    open_shards_per_writer = mbutil.util_split.open_shards_per_writer
+    for poolsize in (4, 1):
+        shards_path = 'test/output/shards_%d' % (poolsize)
+        mbutil.util_split.open_shards_per_writer = 2
+        try:
+            counts = split_mbtiles('test/output/flat.mbtiles', shards_path, zoom_bands=[(0, 0), (1, 2)], grid_zoom=1, poolsize=poolsize, batch_size=1)
+        finally:
+            mbutil.util_split.open_shards_per_writer = open_shards_per_writer
+        # Zoom level 0 overlaps every zoom level 1 tile
+        assert sorted([(os.path.basename(f), c) for f, c in counts.items()]) == \
+            [('z0-0_1-0-0.mbtiles', 1), ('z0-0_1-0-1.mbtiles', 1), ('z0-0_1-1-0.mbtiles', 1), ('z0-0_1-1-1.mbtiles', 1),
+             ('z1-2_1-0-0.mbtiles', 5), ('z1-2_1-0-1.mbtiles', 1), ('z1-2_1-1-0.mbtiles', 1), ('z1-2_1-1-1.mbtiles', 1)]
+        con = sqlite3.connect(os.path.join(shards_path, 'z1-2_1-0-0.mbtiles'))
+        assert [(z, x, y, str(tile_data)) for z, x, y, tile_data in con.execute("SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles ORDER BY 1, 2, 3")] == \
+            [t for t in tiles if t[0] == 1 and (t[1], t[2]) == (0, 0) or t[0] == 2]
+        # Only the images of its own tiles
+        assert con.execute("SELECT count(*) FROM images").fetchone()[0] == 5
+        assert con.execute("SELECT count(*) FROM sqlite_master WHERE name IN ('map_index', 'images_id')").fetchone()[0] == 2
+        assert con.execute("SELECT name, value FROM metadata WHERE name IN ('minzoom', 'maxzoom') ORDER BY 1").fetchall() == [('maxzoom', '2'), ('minzoom', '1')]
+        con.close()
+
+@with_setup(clear_data, clear_data)
+def test_metrics():
+    os.mkdir('test/output')
+    tiles = [(1, x, y, 'x' if x == y else 'tile %d %d' % (x, y)) for x in range(2) for y in range(2)]
+    create_flat_mbtiles('test/output/flat.mbtiles', tiles)
+    events = []
+    metrics = Metrics(lambda event, snapshot: events.append((event, snapshot['operation'])))
+    compact_mbtiles('test/output/flat.mbtiles', batch_size=3, metrics=metrics)
+    mbtiles_to_disk('test/output/flat.mbtiles', 'test/output/dir', metrics=metrics)
+    report = metrics.report()
+    assert events == [('start', 'compact'), ('finish', 'compact'), ('start', 'export'), ('finish', 'export')]
+    compact, export = report['operations']
+    assert (compact['tiles'], compact['duplicates'], compact['bytes_read']) == (4, 1, sum([len(t[3]) for t in tiles]))
+    assert set(compact['phases'].keys()) == set(['read', 'hash', 'write', 'commit'])
+    assert (export['tiles'], export['total_tiles'], export['bytes_written']) == (4, 4, sum([len(t[3]) for t in tiles]))
+    assert report['totals']['tiles'] == 8
+
+@with_setup(clear_data, clear_data)
+def test_disk_to_mbtiles_resume():
+    mbtiles_to_disk('test/data/one_tile.mbtiles', 'test/output')
+    mbtiles_create('test/output/one.mbtiles')
+    con = sqlite3.connect('test/output/one.mbtiles')
+    checkpoint_prepare(con.cursor())
+    add_checkpoints(con.cursor(), 'import', os.path.abspath('test/output'), ['1/0'])
+    con.commit()
+    con.close()
+    disk_to_mbtiles('test/output', 'test/output/one.mbtiles', resume=True)
+    con = sqlite3.connect('test/output/one.mbtiles')
+    assert con.execute("SELECT zoom_level, tile_column, tile_row FROM tiles").fetchall() == [(0, 0, 0)]
+    assert con.execute("SELECT count(*) FROM sqlite_master WHERE name='checkpoints'").fetchone()[0] == 0
+
+@with_setup(clear_data, clear_data)
+def test_compact_mbtiles_resume():
+    os.mkdir('test/output')
+    tiles = [(1, x, y, 'tile %d %d' % (x, y)) for x in range(2) for y in range(2)]
+    create_flat_mbtiles('test/output/flat.mbtiles', tiles)
+    con = sqlite3.connect('test/output/flat.mbtiles')
+    compaction_prepare(con.cursor())
+    checkpoint_prepare(con.cursor())
+    add_checkpoints(con.cursor(), 'compact', '', ['2'])
+    con.commit()
+    con.close()
+    compact_mbtiles('test/output/flat.mbtiles', resume=True)
+    con = sqlite3.connect('test/output/flat.mbtiles')
+    assert [(z, x, y, str(tile_data)) for z, x, y, tile_data in con.execute("SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles ORDER BY 1, 2, 3")] == tiles[2:]
+
+def compress_unless_killed(tile_data):
+    # Kills the process running the pool, like an interrupted mb-util
+    if tile_data == 'kill' and os.path.exists('test/output/kill'):
+        os.kill(os.getppid(), signal.SIGKILL)
+    return zlib.compress(tile_data)
+
+def run_killed(target, *args, **kwargs):
+    open('test/output/kill', 'w').close()
+    process = multiprocessing.Process(target=target, args=args, kwargs=kwargs)
+    process.start()
+    process.join()
+    os.remove('test/output/kill')
+    assert process.exitcode == -signal.SIGKILL
+
+class KillAfterCommit(Metrics):
+    def time(self, phase, since):
+        if phase == 'commit':
+            os.kill(os.getpid(), signal.SIGKILL)
+        return Metrics.time(self, phase, since)
+
+@with_setup(clear_data, clear_data)
+def test_disk_to_mbtiles_resume_filtered():
+    mbtiles_to_disk('test/data/one_tile.mbtiles', 'test/output/tiles')
+    shutil.copy('test/data/one_tile.mbtiles', 'test/output/one.mbtiles')
+    con = sqlite3.connect('test/output/one.mbtiles')
+    con.execute("DELETE FROM map WHERE zoom_level=0")
+    con.commit()
+    con.close()
+    # Killed after the first commit, 1/0 has no tile to import
+    run_killed(disk_to_mbtiles, 'test/output/tiles', 'test/output/one.mbtiles', no_overwrite=True, metrics=KillAfterCommit())
+    con = sqlite3.connect('test/output/one.mbtiles')
+    assert sorted([r[0] for r in con.execute("SELECT position FROM checkpoints WHERE operation='import'")]) == ['0/0', '1/0']
+    assert con.execute("SELECT count(*) FROM tiles").fetchone()[0] == 2
+
+@with_setup(clear_data, clear_data)
+def test_merge_mbtiles_kill_resume():
+    os.mkdir('test/output')
+    # The killing tile is in the second chunk of 1000 tiles
+    tiles = [(5, x, y, 'tile %d %d' % (x, y)) for x in range(32) for y in range(32)]
+    tiles[-1] = (5, 31, 31, 'kill')
+    create_flat_mbtiles('test/output/flat.mbtiles', tiles)
+    mbtiles_create('test/output/merged.mbtiles')
+    transform_list = ['%s:compress_unless_killed' % (__name__)]
+    run_killed(merge_mbtiles, 'test/output/merged.mbtiles', 'test/output/flat.mbtiles', transform_list=transform_list, poolsize=2)
+    con = sqlite3.connect('test/output/merged.mbtiles')
+    assert con.execute("SELECT count(*) FROM map").fetchone()[0] == 1000
+    assert con.execute("SELECT position FROM checkpoints WHERE operation='merge'").fetchall() == [('1000', )]
+    con.close()
+    merge_mbtiles('test/output/merged.mbtiles', 'test/output/flat.mbtiles', transform_list=transform_list, poolsize=2, resume=True)
+    con = sqlite3.connect('test/output/merged.mbtiles')
+    assert [(z, x, y, str(tile_data)) for z, x, y, tile_data in con.execute("SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles ORDER BY 1, 2, 3")] == \
+        [(z, x, y, zlib.compress(tile_data)) for z, x, y, tile_data in tiles]
+    assert con.execute("SELECT count(*) FROM sqlite_master WHERE name='checkpoints'").fetchone()[0] == 0
+
+@with_setup(clear_data, clear_data)
+def test_execute_commands_kill_resume():
+    os.mkdir('test/output')
+    tiles = [(5, x, y, 'tile %d %d' % (x, y)) for x in range(32) for y in range(32)]
+    tiles[-1] = (5, 31, 31, 'kill')
+    create_flat_mbtiles('test/output/flat.mbtiles', tiles)
+    compact_mbtiles('test/output/flat.mbtiles')
+    transform_list = ['%s:compress_unless_killed' % (__name__)]
+    run_killed(execute_commands_on_mbtiles, 'test/output/flat.mbtiles', transform_list=transform_list, poolsize=2, in_flight=1)
+    con = sqlite3.connect('test/output/flat.mbtiles')
+    # The first chunk is processed, the map still has the old tile_ids
+    assert con.execute("SELECT count(*) FROM tile_id_remap").fetchone()[0] == 1000
+    assert con.execute("SELECT position FROM checkpoints WHERE operation='process'").fetchall() == [('1000', )]
+    assert str(con.execute("SELECT tile_data FROM tiles WHERE zoom_level=5 AND tile_column=0 AND tile_row=0").fetchone()[0]) == 'tile 0 0'
+    con.close()
+    execute_commands_on_mbtiles('test/output/flat.mbtiles', transform_list=transform_list, poolsize=2, resume=True)
+    con = sqlite3.connect('test/output/flat.mbtiles')
+    assert [(z, x, y, str(tile_data)) for z, x, y, tile_data in con.execute("SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles ORDER BY 1, 2, 3")] == \
+        [(z, x, y, zlib.compress(tile_data)) for z, x, y, tile_data in tiles]
+    assert con.execute("SELECT count(*) FROM images").fetchone()[0] == len(tiles)
+    assert con.execute("SELECT count(*) FROM sqlite_master WHERE name IN ('tile_id_remap', 'checkpoints')").fetchone()[0] == 0
+
+def test_serve_mbtiles():
+    server = create_tile_server('test/data/one_tile.mbtiles', port=0)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        con = httplib.HTTPConnection('127.0.0.1', server.server_address[1])
+        tile_data = str(sqlite3.connect('test/data/one_tile.mbtiles').execute("SELECT tile_data FROM tiles WHERE zoom_level=1 AND tile_column=0 AND tile_row=1").fetchone()[0])
+        for i in range(2):
+            con.request('GET', '/1/0/1.png')
+            response = con.getresponse()
+            assert response.status == 200
+            assert response.read() == tile_data
+            assert response.getheader('ETag') == '"f115b5a3877534f4c2160091b7b28b90"'
+        con.request('GET', '/1/0/1.png', headers={'If-None-Match': '"f115b5a3877534f4c2160091b7b28b90"'})
+        response = con.getresponse()
+        assert response.status == 304 and response.read() == ''
+        con.request('GET', '/1/1/1.png')
+        response = con.getresponse()
+        assert response.status == 404
+        response.read()
+        con.request('GET', '/1/0/1.jpg')
+        response = con.getresponse()
+        assert response.status == 404
+        response.read()
+        con.request('GET', '/metadata.json')
+        assert json.loads(con.getresponse().read())['name'] == 'shadowplay'
+        con.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+        server.store.close()